@@ -2,12 +2,12 @@
 import os
 import awkward as ak
 import numpy as np
-import json
 
 import hist
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 import mplhep as hep
+from tamalero.event_io import read_events, event_file
 plt.style.use(hep.style.CMS)
 
 here = os.path.dirname(os.path.abspath(__file__))
@@ -22,10 +22,9 @@ if __name__ == '__main__':
     #for i in range(6307,6506):
     #for i in range(5707,6500):
     #for i in range(5707,5708):
-        in_file = f"{here}/../ETROC_output/{i}_merged.json"
+        in_file = event_file(f"{here}/../ETROC_output/{i}_merged")
         if os.path.isfile(in_file):
-            with open(in_file, "r") as f:
-                all_events.append(ak.from_json(json.load(f)))
+            all_events.append(read_events(in_file))
         else:
             print(f'Missing file: {in_file}')
 
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
 import os
-import json
 import awkward as ak
 import numpy as np
 import argparse
 import hist
+from tamalero.event_io import read_events, write_events, event_file
 
 if __name__ == '__main__':
 
@@ -28,14 +28,12 @@ fail_list=[]
 #TODO: reconfigure to work with glob for better flexibility in names
 if args.specific_runs:
     for run in args.specific_runs:
-        with open("{}/../ETROC_output/output_run_{}_rb{}.json".format(here, run, args.rb), "r") as f:
-            files_to_stack.append(ak.from_json(json.load(f)))
+        files_to_stack.append(read_events(event_file("{}/../ETROC_output/output_run_{}_rb{}".format(here, run, args.rb))))
         print("Run {} contains {} events".format(run,len(files_to_stack[-1])))
 else:
     for run in range(args.first_run, args.last_run+1):
         try:
-            with open("{}/../ETROC_output/output_run_{}_rb{}.json".format(here, run, args.rb), "r") as f:
-                files_to_stack.append(ak.from_json(json.load(f)))
+            files_to_stack.append(read_events(event_file("{}/../ETROC_output/output_run_{}_rb{}".format(here, run, args.rb))))
             print("Run {} contains {} events".format(run,len(files_to_stack[-1])))
         except:
             print("Run {} failed to be added to the stack, will continue without it".format(run))
@@ -50,12 +48,10 @@ if args.specific_runs:
     for run in args.specific_runs:
         specific_name+=(str(run)+"_")
     specific_name+="stacked"
-    with open(specific_name+".json", "w") as f:
-            json.dump(ak.to_json(stacked), f)
+    write_events(stacked, specific_name+".parquet")
 else:
     stacked_name="{}/../ETROC_output/module_{}_output_run_{}_to_{}_stacked".format(here, args.module, args.first_run,args.last_run)+fail_string
-    with open(stacked_name+".json", "w") as f:
-            json.dump(ak.to_json(stacked), f)
+    write_events(stacked, stacked_name+".parquet")
 
 # make some plots
 import matplotlib.pyplot as plt
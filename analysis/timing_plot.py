@@ -1,5 +1,4 @@
 #!/usr/bin/env python3
-import json
 import awkward as ak
 import argparse
 import numpy as np
@@ -7,6 +6,7 @@ import hist
 import os
 import matplotlib.pyplot as plt
 import mplhep as hep
+from tamalero.event_io import read_events, event_file
 plt.style.use(hep.style.CMS)
 
 if __name__ == '__main__':
@@ -16,9 +16,7 @@ if __name__ == '__main__':
     args = argParser.parse_args()
 
     # with open(f"../output/{args.input}.json", "r") as f:
-    with open(f"../ETROC_output/{args.input}.json", "r") as f:
-        res = json.load(f)
-    events = ak.from_json(res)
+    events = read_events(event_file(f"../ETROC_output/{args.input}"))
 
     plot_dir = f"../results/{args.input.replace('.','p')}"
 
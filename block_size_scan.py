@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+'''
+Measure the FIFO readout throughput of a KCU for different block and batch sizes,
+and store the best setting in configs/daq_tuning.yaml, where the DAQ loads it from.
+'''
+import argparse
+import time
+try:
+    import uhal
+except ModuleNotFoundError:
+    # only the emulated KCU (--kcu mock) works without uhal
+    from tamalero import uhal_mock as uhal
+from tamalero.utils import get_kcu
+from tamalero.block_size import AdaptiveBlockSize, max_block, load_tuning, save_tuning
+from daq import get_occupancy
+
+
+def measure(kcu, rb, block, batch, run_time=5):
+    '''
+    read the FIFO of rb for run_time seconds with fixed block and batch size.
+    returns the throughput in Mbps, the number of failed dispatches and the number of lost words.
+    '''
+    hw = kcu.hw
+    sizer = AdaptiveBlockSize(block=block, batch=batch, adaptive=False)
+
+    hw.getClient().write(hw.getNode(f"READOUT_BOARD_{rb}.FIFO_RESET").getAddress(), 0x1)
+    kcu.dispatch()  # with retries, only the FIFO reads are measured
+    lost_start = kcu.read_node(f"READOUT_BOARD_{rb}.RX_FIFO_LOST_WORD_CNT").value()
+
+    n_words = 0
+    start = time.time()
+    while start + run_time > time.time():
+        occupancy = get_occupancy(hw, rb)
+        for sizes in sizer.dispatches(occupancy, remainder=False):
+            reads = [hw.getNode(f"DAQ_RB{rb}").readBlock(size) for size in sizes]
+            try:
+                hw.dispatch()
+            except uhal._core.exception:
+                sizer.failure()
+                continue
+            sizer.success()
+            n_words += sum(len(read.value()) for read in reads)
+    timediff = time.time() - start
+
+    lost = kcu.read_node(f"READOUT_BOARD_{rb}.RX_FIFO_LOST_WORD_CNT").value() - lost_start
+    return 32*n_words / timediff / 1E6, sizer.n_failed, lost
+
+
+if __name__ == '__main__':
+
+    argParser = argparse.ArgumentParser(description = "Argument parser")
+    argParser.add_argument('--kcu', action='store', default='192.168.0.10', help="KCU address, or mock://?l1a_rate=...&occupancy=... for the emulated KCU")
+    argParser.add_argument('--rb', action='store', default=0, type=int, help="RB number (default 0)")
+    argParser.add_argument('--l1a_rate', action='store', default=1000000, type=int, help="L1A rate in Hz used for the scan")
+    argParser.add_argument('--run_time', action='store', default=5, type=int, help="Time in [s] to take data for every setting")
+    argParser.add_argument('--blocks', action='store', default='32,64,128,255', help="Comma separated list of block sizes, the largest one that fits into an IPbus packet is always added")
+    argParser.add_argument('--batches', action='store', default='1,2,4,8,16,64', help="Comma separated list of batch sizes, in units of blocks")
+    argParser.add_argument('--no_control_hub', action='store_true', help="Talk to the KCU directly instead of using the control hub")
+    argParser.add_argument('--dry_run', action='store_true', help="Don't store the result")
+    args = argParser.parse_args()
+
+    kcu = get_kcu(args.kcu, control_hub=not args.no_control_hub)
+    hw = kcu.hw
+
+    blocks = sorted(set([int(x) for x in args.blocks.split(',') if x] + [max_block(kcu.ipb_path)]))
+    batches = [int(x) for x in args.batches.split(',') if x]
+    print(f"Current setting: {load_tuning(kcu.ipb_path)}")
+
+    hw.getNode("SYSTEM.L1A_RATE").write(int(args.l1a_rate / 25E-9 / (0xffffffff) * 10000))
+    kcu.dispatch()
+
+    results = []
+    try:
+        for block in blocks:
+            for n_blocks in batches:
+                speed, failed, lost = measure(kcu, args.rb, block, block*n_blocks, run_time=args.run_time)
+                print(f"block = {block:4d}, batch = {block*n_blocks:6d}: {speed:8.2f} Mbps, {failed} failed dispatches, {lost} lost words")
+                results.append({'block': block, 'batch': block*n_blocks, 'speed': speed, 'failed': failed, 'lost': lost})
+    finally:
+        hw.getNode("SYSTEM.L1A_RATE").write(0)
+        kcu.dispatch()
+
+    # prefer settings without errors, then the highest throughput
+    best = max(results, key=lambda x: (x['failed'] == 0, -x['lost'], x['speed']))
+    print(f"Best setting: block = {best['block']}, batch = {best['batch']} with {best['speed']:.2f} Mbps")
+
+    if not args.dry_run:
+        save_tuning(kcu.ipb_path, {'block': best['block'], 'batch': best['batch'], 'throughput': round(best['speed'], 2)})
+        print(f"Stored the setting for {kcu.ipb_path}")
@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
-import struct
 import numpy as np
 import aiofiles
 import asyncio
 import os
 import random  # For randint
-import uhal
+try:
+    import uhal
+except ModuleNotFoundError:
+    # only the emulated KCU (--kcu mock) works without uhal
+    from tamalero import uhal_mock as uhal
 import argparse
 import sys
 import time
 import pdb
+from queue import Queue, Full
+from threading import Thread, Event
 from time import sleep
 from tamalero.utils import get_kcu
+from tamalero.block_size import AdaptiveBlockSize
+from tamalero.ring_buffer import RingBuffer
 from yaml import load, dump
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
@@ -36,13 +43,14 @@ class MultiThread:
             time.sleep(sleep)
 
     def run_limited(self, iterations=1):
-        for it in range(iterations):
-            self.fun(**self.args)
-        self._running = False
+        try:
+            for it in range(iterations):
+                self.fun(**self.args)
+        finally:
+            self._running = False
 
 
 def stream_daq_multi(fun, args):
-    from threading import Thread
     mon = MultiThread(fun, args)
     t = Thread(target = mon.run_limited, args=(1,))
     t.start()
@@ -70,7 +78,169 @@ def get_occupancy(hw, rb):
         occ = 0
     return occ * 4  # not sure where the factor of 4 comes from, but it's needed
 
-def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superblock=100, block=128, run=1, ext_l1a=False, lock=None, verbose=False):
+class LockWatcher(Thread):
+    '''
+    watches the lock file of an external acquisition in a background thread.
+    the file is only read again when its modification time or size changes,
+    and the DAQ loop just checks the in memory flag `running`.
+    wait_start and wait_stop block without using any CPU.
+    '''
+    def __init__(self, lock, interval=0.05):
+        super().__init__(daemon=True)
+        self.lock = lock
+        self.interval = interval
+        # stat first: if the file changes while it's read, the next poll sees a new stat and reads it again
+        self.stat = self.get_stat()
+        self.flag = get_kcu_flag(lock=lock)
+        self.n_reads = 1
+        self.start_event = Event()
+        self.stop_event = Event()
+        self.terminate_event = Event()
+        self.update()
+
+    def get_stat(self):
+        try:
+            stat = os.stat(self.lock)
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def update(self):
+        if self.flag.lower() == "false" or self.flag.lower() == "stop":
+            self.start_event.clear()
+            self.stop_event.set()
+        else:
+            self.stop_event.clear()
+            self.start_event.set()
+
+    @property
+    def running(self):
+        return self.start_event.is_set()
+
+    def wait_start(self, timeout=None):
+        return self.start_event.wait(timeout)
+
+    def wait_stop(self, timeout=None):
+        return self.stop_event.wait(timeout)
+
+    def run(self):
+        while not self.terminate_event.wait(self.interval):
+            stat = self.get_stat()
+            if stat is None or stat == self.stat:
+                continue
+            self.stat = stat
+            try:
+                flag = get_kcu_flag(lock=self.lock)
+            except FileNotFoundError:
+                continue
+            self.n_reads += 1
+            if flag == "":
+                # the file is being written, wait for the next change
+                self.stat = None
+                continue
+            self.flag = flag
+            self.update()
+
+    def terminate(self):
+        self.terminate_event.set()
+        self.join()
+
+class DAQWriter(Thread):
+    '''
+    writes the blocks read from the FIFO to disk in a separate thread.
+    the reader puts lists of readBlock results in a bounded queue,
+    the writer converts them to numpy arrays and writes them to f_out.
+    the file is synced to disk every `checkpoint` seconds, so that a crash only loses the last few seconds.
+    if ring is the name of a shared memory ring buffer, the words are also published there for online consumers.
+    '''
+    def __init__(self, f_out, max_queue=1000, checkpoint=5, ring=None, ring_size=2**24):
+        super().__init__()
+        self.f_out = f_out
+        self.ring = RingBuffer(ring, capacity=ring_size) if ring is not None else None
+        self.queue = Queue(maxsize=max_queue)
+        self.checkpoint = checkpoint
+        self.n_words = 0
+        self.n_checkpoints = 0
+        self.error = None
+        # backpressure and queue statistics
+        self.n_put = 0
+        self.n_blocked = 0
+        self.blocked_time = 0
+        self.max_depth = 0
+        self.sum_depth = 0
+
+    def put(self, reads):
+        '''
+        queue a list of reads, blocks if the queue is full
+        '''
+        if self.error is not None:
+            raise self.error
+        depth = self.queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        self.sum_depth += depth
+        self.n_put += 1
+        try:
+            self.queue.put_nowait(reads)
+        except Full:
+            start = time.time()
+            self.n_blocked += 1
+            self.queue.put(reads)
+            self.blocked_time += time.time() - start
+
+    def sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+        self.n_checkpoints += 1
+
+    def run(self):
+        try:
+            with open(self.f_out, mode="wb") as f:
+                last_sync = time.time()
+                while True:
+                    reads = self.queue.get()
+                    if reads is None:
+                        break
+                    for read in reads:
+                        data = np.array(read.value(), dtype='<u4')
+                        data.tofile(f)
+                        self.n_words += len(data)
+                        if self.ring is not None:
+                            self.ring.publish_raw(data)
+                    if time.time() - last_sync > self.checkpoint:
+                        self.sync(f)
+                        last_sync = time.time()
+                self.sync(f)
+        except Exception as e:
+            self.error = e
+            # keep draining, so that the reader doesn't block forever
+            while self.queue.get() is not None:
+                pass
+
+    def close(self):
+        '''
+        write what is left in the queue and wait for the writer to finish.
+        doesn't raise, so that it can be called while an exception is handled:
+        check self.error afterwards.
+        '''
+        self.queue.put(None)
+        self.join()
+        if self.ring is not None:
+            self.ring.close()
+
+    def stats(self):
+        return {
+            'words_written': self.n_words,
+            'checkpoints': self.n_checkpoints,
+            'queue_size': self.queue.maxsize,
+            'queue_max_depth': self.max_depth,
+            'queue_mean_depth': self.sum_depth / self.n_put if self.n_put else 0,
+            'queue_puts': self.n_put,
+            'queue_blocked': self.n_blocked,
+            'queue_blocked_time': self.blocked_time,
+            'ring_words': self.ring.pos if self.ring is not None else 0,
+        }
+
+def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superblock=100, block=None, batch=None, run=1, ext_l1a=False, lock=None, verbose=False, max_queue=1000, checkpoint=5, ring=None):
 
     uhal.disableLogging()
     hw = kcu.hw
@@ -106,30 +276,45 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
     start = time.time()
     log['start_time'] = start
 
-    len_data = 0
-    data = []
-
     occupancy = 0
     f_out = f"ETROC_output/output_run_{run}_rb{rb}.dat"
     log_out = f"ETROC_output/log_run_{run}_rb{rb}.yaml"
     #f_out = f"output/output_rb_{rb}_run_{run}_time_{start}.dat"  # USED TO BE THIS, keeping for reference and debugging
     occupancy_block = []
-    reads = []
-    with open(f_out, mode="wb") as f:
+
+    # the reader (this thread) only does the IPbus reads, the writer thread writes them to disk
+    writer = DAQWriter(f_out, max_queue=max_queue, checkpoint=checkpoint, ring=f"{ring}_rb{rb}" if ring is not None else None)
+    writer.start()
+
+    # block and batch size are loaded from configs/daq_tuning.yaml if not given
+    sizer = AdaptiveBlockSize(block=block, batch=batch, ipb_path=getattr(kcu, 'ipb_path', None))
+    block = sizer.block
+
+    def read_blocks(occupancy, remainder=False):
+        reads = []
+        for sizes in sizer.dispatches(occupancy, remainder=remainder):
+            queued = [hw.getNode(f"DAQ_RB{rb}").readBlock(size) for size in sizes]
+            try:
+                hw.dispatch()
+            except uhal._core.exception:
+                print("uhal UDP error in reading FIFO")
+                sizer.failure()
+                continue
+            sizer.success()
+            reads += queued
+        writer.put(reads)
+
+    try:
         if lock is not None:
             # External lock file based DAQ
-            iteration = 0
-            Running = get_kcu_flag(lock=lock)
-            while (Running.lower() == "false" or Running.lower() == "stop"):
-                if iteration == 0:
-                    print("Waiting for the start command.")
-                Running = get_kcu_flag(lock=lock)
-                iteration += 1
+            watcher = LockWatcher(lock)
+            watcher.start()
+            if not watcher.running:
+                print("Waiting for the start command.")
+                watcher.wait_start()
 
             print("Start data taking")
-            Running = get_kcu_flag(lock=lock)
-            while (Running.lower() != "false" and Running.lower() != "stop"):
-                Running = get_kcu_flag(lock=lock)
+            while watcher.running:
                 num_blocks_to_read = 0
                 occupancy = get_occupancy(hw, rb)
                 num_blocks_to_read = occupancy // block
@@ -137,18 +322,12 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
 
                 # read the blocks
                 if (num_blocks_to_read)>0:
-                    try:
-                        for x in range(num_blocks_to_read):
-                            reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(block)]
-                            hw.dispatch()  # NOTE this is necessary
-                    except uhal._core.exception:
-                        print("uhal UDP error in reading FIFO")
+                    read_blocks(occupancy)
+            watcher.terminate()
 
         else:
             while (start + run_time > time.time()):
                 # Time based DAQ
-                # We read the data into memory (small)
-                # and write to disk once we're done
                 num_blocks_to_read = 0
                 occupancy = get_occupancy(hw, rb)
                 num_blocks_to_read = occupancy // block
@@ -158,85 +337,56 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
                 if (num_blocks_to_read)>0:
                     #if num_blocks_to_read>1 and verbose:
                     #    print(occupancy, num_blocks_to_read)
-                    try:
-                        for x in range(num_blocks_to_read):
-                            reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(block)]
-                            hw.dispatch()  # NOTE this is necessary
-                    except uhal._core.exception:
-                        print("uhal UDP error in reading FIFO")
+                    read_blocks(occupancy)
 
 
         print("Resetting L1A rate back to 0")
         hw.getNode("SYSTEM.L1A_RATE").write(0)
         hw.dispatch()
         print(f"Done with data taking with rb {rb}")
-        
+
         # Read data that might still be in the FIFO
         occupancy = get_occupancy(hw, rb)
         print(f"Occupancy before last read: {occupancy}")
-        num_blocks_to_read = occupancy // block
-        remainder = occupancy % block
-        if (num_blocks_to_read)>0:
-            for x in range(num_blocks_to_read):
-                reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(block)]
-                hw.dispatch()
-            reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(remainder)]
-        else:
-            reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(occupancy)]
-
-        hw.dispatch()
-        for i, read in enumerate(reads):
-            data+= read.value()
-
-        len_data += len(data)
-        # The two prints below can be useful to check if we miss the first or last event
-        # when we convert in the following steps
-        #print(data[:10])
-        #print(data[-10:])
+        read_blocks(occupancy, remainder=True)
 
         # The FIFO should be empty by now, but we do check another time
         occupancy = get_occupancy(hw, rb)
         while occupancy>0:
             print("Found stuff in FIFO. This should not have happened!")
-            num_blocks_to_read = occupancy // block
-            last_block = occupancy % block
-            if (num_blocks_to_read or last_block):
-                reads = []
-                for x in range(num_blocks_to_read):
-                    reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(block)]
-                    hw.dispatch()
-                reads += [hw.getNode(f"DAQ_RB{rb}").readBlock(last_block)]
-                hw.dispatch()
-                for read in reads:
-                    data += read.value()
+            read_blocks(occupancy, remainder=True)
             occupancy = get_occupancy(hw, rb)
 
-        len_data += len(data)
+    finally:
+        # write everything that has been read, also if the DAQ crashed
+        writer.close()
 
-        # Get some stats
-        timediff = time.time() - start
-        speed = 32*len_data  / timediff / 1E6
-        occupancy = hw.getNode(f"READOUT_BOARD_{rb}.RX_FIFO_OCCUPANCY").read()
-        lost = hw.getNode(f"READOUT_BOARD_{rb}.RX_FIFO_LOST_WORD_CNT").read()
-        rate = hw.getNode(f"READOUT_BOARD_{rb}.PACKET_RX_RATE").read()
-        l1a_rate_cnt = hw.getNode("SYSTEM.L1A_RATE_CNT").read()
-        hw.dispatch()
+    if writer.error is not None:
+        raise writer.error
 
-        nevents = kcu.read_node(f"READOUT_BOARD_{rb}.EVENT_CNT").value()
+    len_data = writer.n_words
 
-        l1a_rate = l1a_rate_cnt.value()/1000.0
-        occ = occupancy.value()
-        lost_events = lost.value()
-        rate_log = rate.value()
-        print("L1A rate = %f kHz" % (l1a_rate))
-        print("Occupancy = %d words" % occ)
-        print("Number of events = %d"%nevents)
-        print("Lost events = %d events" % lost_events)
-        print("Packet rate = %d Hz" % rate_log)
-        print("Speed = %f Mbps" % speed)
+    # Get some stats
+    timediff = time.time() - start
+    speed = 32*len_data  / timediff / 1E6
+    occupancy = hw.getNode(f"READOUT_BOARD_{rb}.RX_FIFO_OCCUPANCY").read()
+    lost = hw.getNode(f"READOUT_BOARD_{rb}.RX_FIFO_LOST_WORD_CNT").read()
+    rate = hw.getNode(f"READOUT_BOARD_{rb}.PACKET_RX_RATE").read()
+    l1a_rate_cnt = hw.getNode("SYSTEM.L1A_RATE_CNT").read()
+    hw.dispatch()
 
-        # Actually write to disk
-        f.write(struct.pack('<{}I'.format(len(data)), *data))
+    nevents = kcu.read_node(f"READOUT_BOARD_{rb}.EVENT_CNT").value()
+
+    l1a_rate = l1a_rate_cnt.value()/1000.0
+    occ = occupancy.value()
+    lost_events = lost.value()
+    rate_log = rate.value()
+    print("L1A rate = %f kHz" % (l1a_rate))
+    print("Occupancy = %d words" % occ)
+    print("Number of events = %d"%nevents)
+    print("Lost events = %d events" % lost_events)
+    print("Packet rate = %d Hz" % rate_log)
+    print("Speed = %f Mbps" % speed)
 
     hw.getClient().write(hw.getNode(f"READOUT_BOARD_{rb}.FIFO_RESET").getAddress(), 0x1)
     hw.dispatch()
@@ -253,6 +403,8 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
     log['rate'] = rate_log
     log['speed'] = speed
     log['stop_time'] = time.time()
+    log['writer'] = writer.stats()
+    log['block_size'] = sizer.stats()
 
     with open(log_out, 'w') as f:
         dump(log, f)
@@ -264,10 +416,221 @@ def stream_daq(kcu=None, rb=0, l1a_rate=0, run_time=10, n_events=1000, superbloc
     return f_out
 
 
+def get_occupancies(hw, rbs):
+    '''
+    read the occupancy of the FIFOs of all rbs in a single dispatch
+    '''
+    try:
+        occupancy = {rb: hw.getNode(f"READOUT_BOARD_{rb}.RX_FIFO_OCCUPANCY").read() for rb in rbs}
+        hw.dispatch()
+        occ = {rb: occupancy[rb].value() for rb in rbs}
+    except uhal._core.exception:
+        print("uhal UPDP error when trying to get occupancies. Returning 0.")
+        occ = {rb: 0 for rb in rbs}
+    return {rb: occ[rb] * 4 for rb in rbs}  # same factor of 4 as in get_occupancy
+
+class DAQEngine:
+    '''
+    DAQ for several RBs that owns the uhal connection, instead of one stream_daq thread per RB.
+    every cycle the occupancies of all RBs are read in one dispatch, then the block reads
+    of all RBs are scheduled in as few dispatches as the batch size allows.
+    the words of every RB go to its own DAQWriter.
+    '''
+    def __init__(self, kcu, rbs, run=1, block=None, batch=None, max_queue=1000, checkpoint=5, ring=None):
+        self.kcu = kcu
+        self.hw = kcu.hw
+        self.rbs = rbs
+        self.run = run
+        # block and batch size are loaded from configs/daq_tuning.yaml if not given
+        self.sizer = AdaptiveBlockSize(block=block, batch=batch, ipb_path=getattr(kcu, 'ipb_path', None))
+        self.max_queue = max_queue
+        self.checkpoint = checkpoint
+        self.ring = ring  # shared memory ring buffers {ring}_rb{rb}, if given
+        self.f_out = {rb: f"ETROC_output/output_run_{run}_rb{rb}.dat" for rb in rbs}
+        self.log_out = {rb: f"ETROC_output/log_run_{run}_rb{rb}.yaml" for rb in rbs}
+        self.n_cycles = 0
+
+    def reset(self):
+        hw = self.hw
+        for rb in self.rbs:
+            hw.getClient().write(hw.getNode(f"READOUT_BOARD_{rb}.FIFO_RESET").getAddress(), 0x1)
+        hw.dispatch()
+
+    def read(self, occupancies, remainder=False):
+        '''
+        read the FIFOs of all RBs, given their occupancies.
+        only full blocks are read, unless remainder is set.
+        returns the reads for every RB, in order.
+        '''
+        blocks = []
+        for rb in self.rbs:
+            for sizes in self.sizer.dispatches(occupancies[rb], remainder=remainder):
+                blocks += [(rb, size) for size in sizes]
+
+        reads = {rb: [] for rb in self.rbs}
+        while blocks:
+            # fill one dispatch with as many blocks as fit in the batch
+            n_words = 0
+            n_blocks = 0
+            while n_blocks < len(blocks) and n_words + blocks[n_blocks][1] <= self.sizer.batch:
+                n_words += blocks[n_blocks][1]
+                n_blocks += 1
+            n_blocks = max(n_blocks, 1)
+            queued = [(rb, self.hw.getNode(f"DAQ_RB{rb}").readBlock(size)) for rb, size in blocks[:n_blocks]]
+            blocks = blocks[n_blocks:]
+            try:
+                self.hw.dispatch()
+            except uhal._core.exception:
+                print("uhal UDP error in reading FIFO")
+                self.sizer.failure()
+                continue
+            self.sizer.success()
+            for rb, read in queued:
+                reads[rb].append(read)
+        return reads
+
+    def cycle(self, remainder=False):
+        occupancies = get_occupancies(self.hw, self.rbs)
+        reads = self.read(occupancies, remainder=remainder)
+        for rb in self.rbs:
+            if reads[rb]:
+                self.writers[rb].put(reads[rb])
+        self.n_cycles += 1
+        return occupancies
+
+    def stream(self, l1a_rate=0, run_time=10, ext_l1a=False, lock=None):
+        '''
+        take data until run_time is over, or until the lock file says stop if lock is given.
+        returns the output files of all RBs.
+        '''
+        uhal.disableLogging()
+        kcu = self.kcu
+        hw = self.hw
+
+        rate_setting = l1a_rate / 25E-9 / (0xffffffff) * 10000
+
+        print(f"Start data taking with rbs {self.rbs}")
+
+        self.reset()
+        kcu.write_node("SYSTEM.L1A_PULSE", 2)
+        time.sleep(0.05)
+        self.reset()
+
+        for rb in self.rbs:
+            hw.getNode(f"READOUT_BOARD_{rb}.EVENT_CNT_RESET").write(0x1)
+        hw.getNode("SYSTEM.L1A_RATE").write(int(rate_setting))
+        hw.dispatch()
+
+        time.sleep(0.05)
+
+        if ext_l1a:
+            # enable external trigger
+            hw.getNode("SYSTEM.EN_EXT_TRIGGER").write(0x1)
+            hw.dispatch()
+
+        start = time.time()
+
+        self.writers = {
+            rb: DAQWriter(
+                self.f_out[rb],
+                max_queue = self.max_queue,
+                checkpoint = self.checkpoint,
+                ring = f"{self.ring}_rb{rb}" if self.ring is not None else None,
+            ) for rb in self.rbs
+        }
+        for writer in self.writers.values():
+            writer.start()
+
+        try:
+            if lock is not None:
+                # External lock file based DAQ
+                watcher = LockWatcher(lock)
+                watcher.start()
+                if not watcher.running:
+                    print("Waiting for the start command.")
+                    watcher.wait_start()
+
+                print("Start data taking")
+                while watcher.running:
+                    self.cycle()
+                watcher.terminate()
+            else:
+                while (start + run_time > time.time()):
+                    self.cycle()
+
+            print("Resetting L1A rate back to 0")
+            hw.getNode("SYSTEM.L1A_RATE").write(0)
+            hw.dispatch()
+            print(f"Done with data taking with rbs {self.rbs}")
+
+            # Read data that might still be in the FIFOs
+            occupancies = self.cycle(remainder=True)
+            print(f"Occupancy before last read: {occupancies}")
+
+            # The FIFOs should be empty by now, but we do check another time
+            while any(self.cycle(remainder=True).values()):
+                print("Found stuff in FIFO. This should not have happened!")
+
+        finally:
+            # write everything that has been read, also if the DAQ crashed
+            for writer in self.writers.values():
+                writer.close()
+
+        for writer in self.writers.values():
+            if writer.error is not None:
+                raise writer.error
+
+        timediff = time.time() - start
+
+        # Get some stats, for all RBs at once
+        regs = {}
+        for rb in self.rbs:
+            for reg in ['RX_FIFO_OCCUPANCY', 'RX_FIFO_LOST_WORD_CNT', 'PACKET_RX_RATE', 'EVENT_CNT']:
+                regs[(rb, reg)] = hw.getNode(f"READOUT_BOARD_{rb}.{reg}").read()
+        l1a_rate_cnt = hw.getNode("SYSTEM.L1A_RATE_CNT").read()
+        hw.dispatch()
+        l1a_rate = l1a_rate_cnt.value()/1000.0
+        print("L1A rate = %f kHz" % (l1a_rate))
+
+        for rb in self.rbs:
+            hw.getClient().write(hw.getNode(f"READOUT_BOARD_{rb}.FIFO_RESET").getAddress(), 0x1)
+        if ext_l1a:
+            # disable external trigger again
+            hw.getNode("SYSTEM.EN_EXT_TRIGGER").write(0x0)
+        hw.dispatch()
+
+        for rb in self.rbs:
+            speed = 32*self.writers[rb].n_words / timediff / 1E6
+            log = {
+                'start_time': start,
+                'l1a_rate': l1a_rate,
+                'occupancy': regs[(rb, 'RX_FIFO_OCCUPANCY')].value(),
+                'nevents': regs[(rb, 'EVENT_CNT')].value(),
+                'lost_events': regs[(rb, 'RX_FIFO_LOST_WORD_CNT')].value(),
+                'rate': regs[(rb, 'PACKET_RX_RATE')].value(),
+                'speed': speed,
+                'stop_time': time.time(),
+                'writer': self.writers[rb].stats(),
+                'engine': {
+                    'rbs': self.rbs,
+                    'cycles': self.n_cycles,
+                },
+                'block_size': self.sizer.stats(),
+            }
+            print(f"RB {rb}: number of events = {log['nevents']}, lost events = {log['lost_events']}, speed = {speed:.3f} Mbps")
+            with open(self.log_out[rb], 'w') as f:
+                dump(log, f)
+            print(f"Data stored in {self.f_out[rb]}")
+
+        write_run_done(run=self.run)
+
+        return [self.f_out[rb] for rb in self.rbs]
+
+
 if __name__ == '__main__':
 
     argParser = argparse.ArgumentParser(description = "Argument parser")
-    argParser.add_argument('--kcu', action='store', default='192.168.0.10', help="KCU address")
+    argParser.add_argument('--kcu', action='store', default='192.168.0.10', help="KCU address, or mock://?l1a_rate=...&occupancy=... for the emulated KCU")
     argParser.add_argument('--rb', action='store', default=0, help="RB numbers (default 0)")
     argParser.add_argument('--l1a_rate', action='store', default=0, type=int, help="L1A rate in Hz")
     argParser.add_argument('--ext_l1a', action='store_true', help="Enable external trigger input")
@@ -275,6 +638,8 @@ if __name__ == '__main__':
     argParser.add_argument('--n_events', action='store', default=1000, type=int, help="N events")
     argParser.add_argument('--lock', action='store', default=None, help="Lock file for the scope acquisition status (relative or absolute path)")
     argParser.add_argument('--run', action='store', default=1, type=int, help="Run number")
+    argParser.add_argument('--ring', action='store', default=None, help="Also publish the data to shared memory ring buffers <ring>_rb<rb> for online consumers")
+    argParser.add_argument('--multi_thread', action='store_true', help="Use one stream_daq thread per RB instead of a single DAQ engine for all RBs")
     args = argParser.parse_args()
 
     start_time = time.time()
@@ -305,35 +670,43 @@ if __name__ == '__main__':
     #kcu.write_node(f"READOUT_BOARD_{rb}.EVENT_CNT_RESET", 0x1)
 
 
-    print(f"Preparing DAQ streams.\n ...")
-
-    streams = []
-    for rb in rbs:
-
-        streams.append(
-            stream_daq_multi(
-                stream_daq,
-                {
-                    'kcu':kcu,
-                    'rb':rb,
-                    'l1a_rate':args.l1a_rate,
-                    'run_time':args.run_time,
-                    'run':args.run,
-                    'ext_l1a':args.ext_l1a,
-                    'lock': args.lock,
-                    'verbose': True,
-                },
+    if args.multi_thread:
+        print(f"Preparing DAQ streams.\n ...")
+
+        streams = []
+        for rb in rbs:
+
+            streams.append(
+                stream_daq_multi(
+                    stream_daq,
+                    {
+                        'kcu':kcu,
+                        'rb':rb,
+                        'l1a_rate':args.l1a_rate,
+                        'run_time':args.run_time,
+                        'run':args.run,
+                        'ext_l1a':args.ext_l1a,
+                        'lock': args.lock,
+                        'verbose': True,
+                        'ring': args.ring,
+                    },
+                )
             )
-        )
-
-    init_time = time.time()
-    print(f"Init of ETROC DAQ took {round(init_time-start_time, 1)}s")
-    print("Taking data now")
 
-    while any([stream._running for stream in streams]):
-       # stream_0._running or stream_1._running:
-        time.sleep(1)
-    print("Done with all streams")
+        init_time = time.time()
+        print(f"Init of ETROC DAQ took {round(init_time-start_time, 1)}s")
+        print("Taking data now")
+
+        while any([stream._running for stream in streams]):
+           # stream_0._running or stream_1._running:
+            time.sleep(1)
+        print("Done with all streams")
+    else:
+        engine = DAQEngine(kcu, rbs, run=args.run, ring=args.ring)
+        init_time = time.time()
+        print(f"Init of ETROC DAQ took {round(init_time-start_time, 1)}s")
+        print("Taking data now")
+        engine.stream(l1a_rate=args.l1a_rate, run_time=args.run_time, ext_l1a=args.ext_l1a, lock=args.lock)
 
     print(f"Run {args.run} has ended.")
     ## NOTE this would be the place to also dump the ETROC configs
@@ -1,19 +1,13 @@
 #!/usr/bin/env python3
-import struct
 import argparse
+import time
 import numpy as np
 import pandas as pd
 import awkward as ak
-# from tamalero.FIFO import merge_words
 from tamalero.DataFrame import DataFrame
-
-def merge_words(res):
-    empty_frame_mask = np.array(res[0::2]) > (2**8)  # masking empty fifo entries
-    len_cut = min(len(res[0::2]), len(res[1::2]))  # ensuring equal length of arrays downstream
-    if len(res) > 0:
-        return list (np.array(res[0::2])[:len_cut][empty_frame_mask[:len_cut]] | (np.array(res[1::2]) << 32)[:len_cut][empty_frame_mask[:len_cut]])
-    else:
-        return []
+from tamalero.raw_data import iter_raw, chunk_size
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 def event_merger(window_df,merged_idx):
     # Removing events that have been merged already from current window
@@ -52,23 +46,14 @@ def merge_datatype(data_string):
         tr= ['trailer']
         return hd+datas+tr
 
-if __name__ == '__main__':
-
-    argParser = argparse.ArgumentParser(description = "Argument parser")
-    argParser.add_argument('--input', action='store', default='output/output_example.dat', help="Binary file to read from")
-    args = argParser.parse_args() 
-
-    df = DataFrame('ETROC2')
-
-    with open(args.input, 'rb') as f:
-        print("Reading from {}".format(args.input))
-        bin_data = f.read()
-        raw_data = struct.unpack('<{}I'.format(int(len(bin_data)/4)), bin_data)
 
-    merged_data = merge_words(raw_data)
+def convert(merged_data, df):
+    '''
+    unpack and merge the events of an array of merged words, and run the consistency checks.
+    returns the dataframe of the merged events
+    '''
     unpacked_data = [ df.read(x) for x in merged_data ]
 
-    import time
     start = time.process_time()
     #TODO: this is a bit convoluted, at some point it should be cleaned
     # gymnastic to get an awkward array with header,[datas],trailer per each row
@@ -134,6 +119,7 @@ if __name__ == '__main__':
     window = 100
     overlap = 10
     old_idx = pd.Series([i<-1 for i in range(window)]) #First dummy set of merged indeces
+    last = 0
  
     for i in range(0, len(event_df) - window, window - overlap) :
        
@@ -182,6 +168,70 @@ if __name__ == '__main__':
     merged_df["valid"] = total_check
     print ( "time for consistency checks {} cumulative {}".format(round(time.process_time() - start, 2 ), round(time.process_time() - Rstart, 2 )))
     start=time.process_time()
-    merged_df.astype(str).to_parquet("output/converted_data.parquet") # parquet do not likes mixups of list/scalar 
-    print ( "time for writing the output {} cumulative {} \nAll done".format(round(time.process_time() - start, 2 ), round(time.process_time() - Rstart, 2 )))
+    return merged_df
+
+
+def event_chunks(f_in, df, chunk_size=None):
+    '''
+    yields the merged words of a raw file in chunks of about chunk_size words.
+    the words from the first header with the last L1 counter of a chunk on could belong to an event
+    that continues in the next chunk, they are carried over.
+    only the new words of every chunk are decoded, the headers of the carried words are kept.
+    words without any header (e.g. at the start of a file that starts mid-stream) are
+    carried at most up to chunk_size words, then they are yielded as they are.
+    '''
+    HEADER = df.data_types.index('header')
+    words = np.zeros(0, dtype=np.uint64)
+    headers = np.zeros(0, dtype=np.int64)  # index of the headers in words
+    l1counters = np.zeros(0, dtype=np.int64)  # L1 counter of these headers
+    for chunk in iter_raw(f_in, chunk_size=chunk_size):
+        res = df.read_array(chunk)
+        new_headers = np.flatnonzero(res['data_type'] == HEADER)
+        headers = np.concatenate([headers, new_headers + len(words)])
+        l1counters = np.concatenate([l1counters, res['l1counter'][new_headers]])
+        words = np.concatenate([words, chunk])
+        if len(headers) == 0:
+            if len(words) >= (chunk_size or len(chunk)):
+                yield words
+                words = words[:0]
+            continue
+        last = np.flatnonzero(l1counters != l1counters[-1])
+        cut = headers[last[-1] + 1] if len(last) else headers[0]
+        if cut > 0:
+            yield words[:cut]
+        words = words[cut:].copy()
+        keep = headers >= cut
+        headers = headers[keep] - cut
+        l1counters = l1counters[keep]
+    if len(words) > 0:
+        yield words
+
+
+if __name__ == '__main__':
+
+    argParser = argparse.ArgumentParser(description = "Argument parser")
+    argParser.add_argument('--input', action='store', default='output/output_example.dat', help="Binary file to read from")
+    argParser.add_argument('--memory_budget', action='store', default=256, type=int, help="Approximate memory budget in MB")
+    args = argParser.parse_args() 
+
+    df = DataFrame('ETROC2')
 
+    print("Reading from {}".format(args.input))
+    Rstart = time.process_time()
+    writer = None
+    # the per word unpacking below needs a lot more memory than the event builder
+    for merged_data in event_chunks(args.input, df, chunk_size=chunk_size(args.memory_budget)//8):
+        merged_df = convert(merged_data, df)
+
+        start=time.process_time()
+        if writer is None:
+            columns = list(merged_df.columns)
+        # parquet do not likes mixups of list/scalar
+        table = pa.Table.from_pandas(merged_df.reindex(columns=columns).astype(str))
+        if writer is None:
+            writer = pq.ParquetWriter("output/converted_data.parquet", table.schema)
+        writer.write_table(table.cast(writer.schema))
+        print ( "time for writing the output {} cumulative {}".format(round(time.process_time() - start, 2 ), round(time.process_time() - Rstart, 2 )))
+    if writer is not None:
+        writer.close()
+    print("All done")
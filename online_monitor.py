@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+'''
+Live occupancy and hit rate monitor.
+Attaches to the shared memory ring buffers of a running DAQ (daq.py --ring <name>),
+it only reads from them and can't slow down the readout. If the monitor falls behind
+it skips ahead, the number of skipped words is shown.
+With --input, raw files are replayed instead.
+'''
+import argparse
+import time
+import numpy as np
+from tamalero.monitor import OnlineMonitor
+from tamalero.ring_buffer import RingConsumer
+from tamalero.raw_data import iter_raw
+
+if __name__ == '__main__':
+
+    argParser = argparse.ArgumentParser(description = "Argument parser")
+    argParser.add_argument('--ring', action='store', default='etl_daq', help="Name of the ring buffers, as given to daq.py")
+    argParser.add_argument('--rb', action='store', default='0', help="RB numbers (default 0)")
+    argParser.add_argument('--input', action='store', default=None, help="Comma separated raw files to replay instead of the live data, one per RB")
+    argParser.add_argument('--interval', action='store', default=1, type=float, help="Refresh interval in seconds")
+    argParser.add_argument('--batch', action='store', default=2**18, type=int, help="Maximum number of words decoded at once")
+    argParser.add_argument('--no_maps', action='store_true', help="Don't show the occupancy maps")
+    argParser.add_argument('--save', action='store', default=None, help="Store the histograms in this npz file when done")
+    args = argParser.parse_args()
+
+    rbs = [int(x) for x in args.rb.split(',')]
+    monitor = OnlineMonitor()
+
+    if args.input is not None:
+        for rb, f_in in zip(rbs, args.input.split(',')):
+            for words in iter_raw(f_in, chunk_size=args.batch):
+                monitor.update(rb, words)
+        print(monitor.render(maps=not args.no_maps))
+    else:
+        consumers = {rb: RingConsumer(f"{args.ring}_rb{rb}") for rb in rbs}
+        try:
+            while True:
+                start = time.time()
+                while time.time() - start < args.interval:
+                    n_read = 0
+                    for rb, consumer in consumers.items():
+                        words = consumer.read(max_words=args.batch)
+                        monitor.update(rb, words)
+                        n_read += len(words)
+                    if n_read == 0:
+                        time.sleep(0.01)
+                print("\033[H\033[J", end='')  # clear the terminal
+                print(monitor.render(maps=not args.no_maps))
+                print("Skipped words: " + ", ".join(f"RB {rb}: {c.n_dropped}" for rb, c in consumers.items()))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for consumer in consumers.values():
+                consumer.close()
+
+    if args.save is not None:
+        np.savez(args.save, **monitor.snapshot())
+        print(f"Histograms stored in {args.save}")
@@ -16,16 +16,20 @@ import shutil
 if __name__ == '__main__':
 
 
-    which_root = shutil.which("root")
-    if which_root == "/cvmfs/sft.cern.ch/lcg/releases/LCG_103/ROOT/6.28.00/x86_64-ubuntu2004-gcc9-opt/bin/root":
-        print("Found expected ROOT version")
-    else:
-        print("This script relies on pyROOT, but found unexpected root version.")
-        print(" > In case of issues, run:")
-        print(" > source /cvmfs/sft.cern.ch/lcg/releases/LCG_103/ROOT/6.28.00/x86_64-ubuntu2004-gcc9-opt/ROOT-env.sh")
-
-    from root_dumper import dump_to_root
+    from root_dumper import dump_to_root, has_uproot
+
+    # the root files are written with uproot, PyROOT is only needed without it
+    if not has_uproot:
+        which_root = shutil.which("root")
+        if which_root == "/cvmfs/sft.cern.ch/lcg/releases/LCG_103/ROOT/6.28.00/x86_64-ubuntu2004-gcc9-opt/bin/root":
+            print("Found expected ROOT version")
+        else:
+            print("This script relies on pyROOT, but found unexpected root version.")
+            print(" > In case of issues, run:")
+            print(" > source /cvmfs/sft.cern.ch/lcg/releases/LCG_103/ROOT/6.28.00/x86_64-ubuntu2004-gcc9-opt/ROOT-env.sh")
+
     from data_dumper import data_dumper
+    from tamalero.event_io import event_file
 
     skip_stageout = True
     td02_dir = '/home/daq/ETROC_output/'
@@ -68,10 +72,11 @@ if __name__ == '__main__':
                 except FileNotFoundError:
                     print("Couldn't find log")
 
-                print(f" > Converting binary to json")
+                print(f" > Converting binary to events")
                 n_events, events = data_dumper(
                     f"{data_dir}/output_run_{run}_rb0.dat",
                     skip_trigger_check=True,
+                    memory_budget=256,
                 )
                 continue_processing = n_events==log['nevents']
                 #print("Number of L1A and events in agreement?", continue_processing)
@@ -80,10 +85,10 @@ if __name__ == '__main__':
                     #subprocess.call(f"python3 data_dumper.py --input {run} --rbs 0 --skip_trigger_check", shell=True)
 
                     outfile = f'ETROC_merged_run_{run}.root'
-                    print(f" > Converting json to root")
+                    print(f" > Converting events to root")
                     dump_to_root(
                         f'{data_dir}/{outfile}',
-                        f'{data_dir}/output_run_{run}_rb0.json',
+                        event_file(f'{data_dir}/output_run_{run}_rb0'),
                     )
                 else:
                     print(" ! Data and number of L1As not in agreement, did not further process!")
@@ -7,28 +7,30 @@ import time
 from tamalero.utils import get_kcu
 
 
-def run_qinj(kcu, rb=0, max_pulse_time=4, cycle_time=60, max_pulses=10000):
+def run_qinj(kcu, rb=0, max_pulse_time=4, cycle_time=60, max_pulses=10000, burst=100):
     start_time = time.time()
     qinj_counter = 0
 
     now = time.time()
     while now - start_time < max_pulse_time and qinj_counter < max_pulses:
-        kcu.write_node("READOUT_BOARD_%s.L1A_QINJ_PULSE"%rb, 0x01)
-        qinj_counter += 1
+        n = min(burst, max_pulses - qinj_counter)
+        kcu.send_pulses("READOUT_BOARD_%s.L1A_QINJ_PULSE"%rb, n, burst=n)
+        qinj_counter += n
         now = time.time()
 
     print(f"Sent {qinj_counter} Qinj pulses in {now-start_time} seconds")
     print(f"Sleeping for {cycle_time - now + start_time} seconds now")
     time.sleep(cycle_time - (now - start_time))
 
-def run_trigger(kcu, rb=0, max_pulse_time=4, cycle_time=60, max_pulses=10000):
+def run_trigger(kcu, rb=0, max_pulse_time=4, cycle_time=60, max_pulses=10000, burst=100):
     start_time = time.time()
     qinj_counter = 0
 
     now = time.time()
     while now - start_time < max_pulse_time and qinj_counter < max_pulses:
-        kcu.write_node("READOUT_BOARD_%s.L1A_PULSE"%rb, 0x01)
-        qinj_counter += 1
+        n = min(burst, max_pulses - qinj_counter)
+        kcu.send_pulses("READOUT_BOARD_%s.L1A_PULSE"%rb, n, burst=n)
+        qinj_counter += n
         now = time.time()
 
     print(f"Sent {qinj_counter} L1A in {now-start_time} seconds")
@@ -47,6 +49,7 @@ if __name__ == '__main__':
     argParser.add_argument('--pulses', action='store', default=10000, type=int, help="Number of pulses")
     argParser.add_argument('--pulse_time', action='store', default=4, type=int, help="Maximum pulse time in [s]")
     argParser.add_argument('--trigger', action='store_true', help="Run pure L1A mode")
+    argParser.add_argument('--burst', action='store', default=100, type=int, help="Number of pulses sent per dispatch")
 
     args = argParser.parse_args()
 
@@ -56,4 +59,4 @@ if __name__ == '__main__':
     kcu.write_node("READOUT_BOARD_%s.L1A_INJ_DLY"%rb, 504)
 
     for i in range(args.cycles):
-        run_qinj(kcu, rb=rb, cycle_time=args.cycle_time, max_pulses=args.pulses, max_pulse_time=args.pulse_time)
+        run_qinj(kcu, rb=rb, cycle_time=args.cycle_time, max_pulses=args.pulses, max_pulse_time=args.pulse_time, burst=args.burst)
@@ -1,99 +1,231 @@
 #!/usr/bin/env python3
 import argparse
-import json
-import ROOT as rt
+import awkward as ak
 from array import array
 import numpy as np
 import os
 import re
 import glob
 import time
+from tamalero.event_io import read_events
+try:
+    import uproot
+    has_uproot = True
+except ModuleNotFoundError:
+    print("Package `uproot` not found, falling back to PyROOT.")
+    has_uproot = False
+
+# fields of the events that are written to the pulse tree
+COLUMNS = ['event', 'l1counter', 'row', 'col', 'tot_code', 'toa_code', 'cal_code', 'elink', 'chipid', 'bcid', 'nhits']
+# branches of the pulse tree, all jagged branches are vectors of int
+SCALAR_BRANCHES = ['event', 'l1counter', 'bcid']
+JAGGED_BRANCHES = ['row', 'col', 'tot_code', 'toa_code', 'cal_code', 'elink', 'chipid', 'nhits', 'nhits_trail']
+# names and (uproot) types of the branches written by dump_to_root_pyroot, in order.
+# the merger relies on them, other writers have to produce the same.
+PULSE_BRANCHES = {
+    'event': 'int32_t',
+    'l1counter': 'int32_t',
+    'row': 'std::vector<int32_t>',
+    'col': 'std::vector<int32_t>',
+    'tot_code': 'std::vector<int32_t>',
+    'toa_code': 'std::vector<int32_t>',
+    'cal_code': 'std::vector<int32_t>',
+    'elink': 'std::vector<int32_t>',
+    'chipid': 'std::vector<int32_t>',
+    'bcid': 'int32_t',
+    'nhits': 'std::vector<int32_t>',
+    'nhits_trail': 'std::vector<int32_t>',
+}
 
 def setVector(v_, l_):
     v_.clear()
     for i in l_:
         v_.push_back(i)
 
-def dump_to_root(output, input_file):
+def counter_name(branch):
+    '''
+    name of the branch with the number of entries of a jagged branch written with uproot
+    '''
+    return f'n_{branch}'
+
+def pulse_tree_layout(f_in):
+    '''
+    names and types of the branches of the pulse tree in f_in.
+    uproot can't write std::vector, jagged branches are written as counted arrays (int row[n_row]).
+    They are read like the std::vector<int> of the PyROOT writer by RDataFrame, TTreeReaderArray,
+    TTree::Draw and uproot, so they are listed as such and their counter branches are left out.
+    '''
+    with uproot.open(f_in) as f:
+        tree = f['pulse']
+        if not isinstance(tree, uproot.TTree):
+            raise ValueError(f"pulse in {f_in} is not a TTree")
+        counters = {b.count_branch.name for b in tree.branches if b.count_branch is not None}
+        layout = []
+        for b in tree.branches:
+            if b.name in counters:
+                continue
+            if b.count_branch is not None and b.typename.endswith('[]'):
+                layout.append((b.name, f'std::vector<{b.typename[:-2]}>'))
+            else:
+                layout.append((b.name, b.typename))
+    return layout
+
+def check_pulse_tree(f_in):
+    '''
+    raises a ValueError if the branches of the pulse tree in f_in
+    don't have the names and types of the ones written by dump_to_root_pyroot
+    '''
+    layout = pulse_tree_layout(f_in)
+    expected = list(PULSE_BRANCHES.items())
+    if layout != expected:
+        raise ValueError(f"Branches of the pulse tree in {f_in} don't match the PyROOT writer: {layout} instead of {expected}")
+
+def pulse_branches(events):
+    '''
+    returns the branches of the pulse tree for a chunk of events, as numpy and awkward arrays
+    '''
+    branches = {}
+    for b in PULSE_BRANCHES:
+        if b == 'bcid':
+            # only the BCID of the (first) header is stored
+            branches[b] = ak.to_numpy(ak.fill_none(ak.firsts(events.bcid), 0)).astype(np.int32)
+        elif b in SCALAR_BRANCHES:
+            branches[b] = ak.to_numpy(events[b]).astype(np.int32)
+        elif b in events.fields:
+            branches[b] = ak.values_astype(events[b], np.int32)
+        else:
+            # nhits_trail is not filled, but kept for compatibility
+            branches[b] = ak.unflatten(np.zeros(0, dtype=np.int32), np.zeros(len(events), dtype=np.int64))
+    return branches
+
+
+def dump_to_root(output, input_file, chunk_size=100000):
+    '''
+    write the events of input_file (parquet or json from data dumper) to the pulse tree of output.
+    uses uproot to write whole chunks of events at once, without PyROOT.
+    The jagged branches are counted arrays instead of std::vector, see pulse_tree_layout.
+    PyROOT (dump_to_root_pyroot) is only used if uproot is not available.
+    '''
+    if not has_uproot:
+        return dump_to_root_pyroot(output, input_file)
+
+    filename = os.path.basename(input_file)
+    name, ext = os.path.splitext(filename)
+    if ext not in ['.json', '.parquet']:
+        raise ValueError("Inputted file needs to be parquet or json from data dumper")
+
+    print(output)
+    # Create an empty root file so that the merger step is always happy and does not get stuck
+    with uproot.recreate(output) as f:
+        tree = f.mktree(
+            "pulse",
+            {b: np.int32 if b in SCALAR_BRANCHES else "var * int32" for b in PULSE_BRANCHES},
+            counter_name=counter_name,
+        )
+        n_events = 0
+        if os.path.isfile(input_file):
+            print("Now reading from {}".format(input_file))
+            events = read_events(input_file, columns=COLUMNS)
+            for start in range(0, len(events), chunk_size):
+                tree.extend(pulse_branches(events[start:start+chunk_size]))
+            n_events = len(events)
+
+    check_pulse_tree(output)
+    print(f"Found {n_events} events")
+    print(f"Output written to {output} ...")
+
+
+def dump_to_root_pyroot(output, input_file):
+    import ROOT as rt
+
     # Create an empty root file so that the merger step is always happy and does not get stuck
     filename = os.path.basename(input_file)
     name, ext = os.path.splitext(filename)
-    if ext != '.json':
-        raise ValueError("Inputted file needs to be json from data dumper")
+    if ext not in ['.json', '.parquet']:
+        raise ValueError("Inputted file needs to be parquet or json from data dumper")
 
     f = rt.TFile(output, "RECREATE")
     tree = rt.TTree("pulse", "pulse")
     print(output)
+    n_events = 0
 
     if os.path.isfile(input_file):
-        with open(input_file) as f_in:
-            print("Now reading from {}".format(input_file))
-            jsonString = json.load(f_in)
-            jsonData = json.loads(jsonString)
-
-            event_       = array('I',[0])
-            l1counter_   = array('I',[0])
-            row_         = rt.std.vector[int]()
-            col_         = rt.std.vector[int]()
-            tot_code_    = rt.std.vector[int]()
-            toa_code_    = rt.std.vector[int]()
-            cal_code_    = rt.std.vector[int]()
-            elink_       = rt.std.vector[int]()
-            #raw_         = rt.std.vector[rt.std.string]()
-            #crc_         = rt.std.vector[int]()
-            chipid_      = rt.std.vector[int]()
-            #bcid_        = rt.std.vector[int]()
-            bcid_        = array("I",[0]) # rt.std.vector[int]()
-            #counter_a_   = rt.std.vector[int]()
-            nhits_       = rt.std.vector[int]()
-            nhits_trail_ = rt.std.vector[int]()
-
-            tree.Branch("event",       event_, "event/I")
-            tree.Branch("l1counter",   l1counter_, "l1counter/I")
-            tree.Branch("row",         row_)
-            tree.Branch("col",         col_)
-            tree.Branch("tot_code",    tot_code_)
-            tree.Branch("toa_code",    toa_code_)
-            tree.Branch("cal_code",    cal_code_)
-            tree.Branch("elink",       elink_)
-            #tree.Branch("raw",         raw_)
-            #tree.Branch("crc",         crc_)
-            tree.Branch("chipid",      chipid_)
-            tree.Branch("bcid",        bcid_, "bcid/I")
-            #tree.Branch("counter_a",   counter_a_)
-            # tree.Branch("nhits",       nhits_, "nhits/I")
-            tree.Branch("nhits",       nhits_)
-            tree.Branch("nhits_trail", nhits_trail_)
-
-            for i, event in enumerate(jsonData):
-                # print(event["bcid"])
-                event_[0] =             event["event"]
-                l1counter_[0] =         event["l1counter"]
-                setVector(row_,         event["row"])
-                setVector(col_,         event["col"])
-                setVector(tot_code_,    event["tot_code"])
-                setVector(toa_code_,    event["toa_code"])
-                setVector(cal_code_,    event["cal_code"])
-                setVector(elink_,       event["elink"])
-                # setVector(raw_,         event["raw"])
-                #setVector(crc_,         event["crc"])
-                setVector(chipid_,      event["chipid"])
-                # print(event["bcid"])
-                bcid_[0] =              int(event["bcid"][0])
-                # setVector(bcid_,        event["bcid"])
-                #setVector(counter_a_,   event["counter_a"])
-                setVector(nhits_,           event["nhits"])
-                # setVector(nhits_trail_, event["nhits_trail"])
-
-                tree.Fill()
-    print(f"Found {i+1} events")
+        print("Now reading from {}".format(input_file))
+        events = ak.to_list(read_events(input_file, columns=COLUMNS))
+
+        event_       = array('I',[0])
+        l1counter_   = array('I',[0])
+        row_         = rt.std.vector[int]()
+        col_         = rt.std.vector[int]()
+        tot_code_    = rt.std.vector[int]()
+        toa_code_    = rt.std.vector[int]()
+        cal_code_    = rt.std.vector[int]()
+        elink_       = rt.std.vector[int]()
+        #raw_         = rt.std.vector[rt.std.string]()
+        #crc_         = rt.std.vector[int]()
+        chipid_      = rt.std.vector[int]()
+        #bcid_        = rt.std.vector[int]()
+        bcid_        = array("I",[0]) # rt.std.vector[int]()
+        #counter_a_   = rt.std.vector[int]()
+        nhits_       = rt.std.vector[int]()
+        nhits_trail_ = rt.std.vector[int]()
+
+        tree.Branch("event",       event_, "event/I")
+        tree.Branch("l1counter",   l1counter_, "l1counter/I")
+        tree.Branch("row",         row_)
+        tree.Branch("col",         col_)
+        tree.Branch("tot_code",    tot_code_)
+        tree.Branch("toa_code",    toa_code_)
+        tree.Branch("cal_code",    cal_code_)
+        tree.Branch("elink",       elink_)
+        #tree.Branch("raw",         raw_)
+        #tree.Branch("crc",         crc_)
+        tree.Branch("chipid",      chipid_)
+        tree.Branch("bcid",        bcid_, "bcid/I")
+        #tree.Branch("counter_a",   counter_a_)
+        # tree.Branch("nhits",       nhits_, "nhits/I")
+        tree.Branch("nhits",       nhits_)
+        tree.Branch("nhits_trail", nhits_trail_)
+
+        for i, event in enumerate(events):
+            # print(event["bcid"])
+            event_[0] =             event["event"]
+            l1counter_[0] =         event["l1counter"]
+            setVector(row_,         event["row"])
+            setVector(col_,         event["col"])
+            setVector(tot_code_,    event["tot_code"])
+            setVector(toa_code_,    event["toa_code"])
+            setVector(cal_code_,    event["cal_code"])
+            setVector(elink_,       event["elink"])
+            # setVector(raw_,         event["raw"])
+            #setVector(crc_,         event["crc"])
+            setVector(chipid_,      event["chipid"])
+            # print(event["bcid"])
+            bcid_[0] =              int(event["bcid"][0])
+            # setVector(bcid_,        event["bcid"])
+            #setVector(counter_a_,   event["counter_a"])
+            setVector(nhits_,           event["nhits"])
+            # setVector(nhits_trail_, event["nhits_trail"])
+
+            tree.Fill()
+        n_events = len(events)
+    print(f"Found {n_events} events")
     f.WriteObject(tree, "pulse")
     print(f"Output written to {output} ...")
 
 if __name__ == '__main__':
     argParser = argparse.ArgumentParser(description = "Argument parser")
-    argParser.add_argument('--input_file', action='store', help="Input full path to json file to be dumped") # , default='output_run_10117'
-    argParser.add_argument('--output_file', action='store', help="Input full path to json file to be dumped") # , default='output_run_10117'
+    argParser.add_argument('--input_file', action='store', help="Input full path to parquet or json file to be dumped") # , default='output_run_10117'
+    argParser.add_argument('--output_file', action='store', help="Full path of the root file to be written") # , default='output_run_10117'
+    argParser.add_argument('--pyroot', action='store_true', help="Use the (slow) PyROOT writer, with std::vector branches, instead of uproot")
+    argParser.add_argument('--check', action='store_true', help="Check that the branches of the output are the ones of the PyROOT writer")
     args = argParser.parse_args()
 
-    dump_to_root(args.output_file, args.input_file)
+    if args.pyroot:
+        dump_to_root_pyroot(args.output_file, args.input_file)
+    else:
+        dump_to_root(args.output_file, args.input_file)
+
+    if args.check:
+        check_pulse_tree(args.output_file)
+        print("Branches of the pulse tree are ok")
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import numpy as np
 
 from yaml import load, dump
 
@@ -15,6 +16,7 @@ class DataFrame:
         with open(os.path.expandvars(f'{here}/../configs/dataformat.yaml'), 'r') as f:
             self.format = load(f, Loader=Loader)[version]
         self.type = 0
+        self.data_types = list(self.format['identifiers'].keys())
 
     def get_bytes(self, word, format):
         bytes = []
@@ -75,6 +77,95 @@ class DataFrame:
         #print (res)
         return data_type, res
 
+    def get_field_dtype(self, mask, shift):
+        '''
+        smallest unsigned integer type that can hold a field with given mask and shift
+        '''
+        nbits = (mask >> shift).bit_length()
+        for dtype in [np.uint8, np.uint16, np.uint32]:
+            if nbits <= np.iinfo(dtype).bits:
+                return dtype
+        return np.uint64
+
+    def read_array(self, words):
+        '''
+        vectorized version of read, decoding a whole array of (merged 64 bit) words at once.
+        returns a dictionary of numpy arrays (columnar), with one entry per word:
+        - data_type: index of the identified data type in self.data_types, -1 if unknown
+        - type: the data type of the last header, carried forward to the following data words
+        - raw, raw_full, meta: same as in read, but as integers instead of hex strings
+        - one column for every field in the data format. Fields that are not defined
+          for the data type of a word are set to 0.
+        '''
+        words = np.asarray(words, dtype=np.uint64)
+        res = {}
+
+        # classify the words. The first matching identifier wins, like in read
+        data_type = np.full(len(words), -1, dtype=np.int8)
+        unassigned = np.ones(len(words), dtype=bool)
+        for i, id in enumerate(self.data_types):
+            identifier = self.format['identifiers'][id]
+            match = unassigned & ((words & np.uint64(identifier['mask'])) == np.uint64(identifier['frame']))
+            data_type[match] = i
+            unassigned &= ~match
+        res['data_type'] = data_type
+
+        # carry the type of the last header forward to the following words
+        is_header = data_type == self.data_types.index('header')
+        type_field = self.format['data']['header']['type']
+        header_type = ((words & np.uint64(type_field['mask'])) >> np.uint64(type_field['shift'])).astype(np.uint8)
+        last_header = np.maximum.accumulate(np.where(is_header, np.arange(len(words)), -1))
+        res['type'] = np.where(last_header >= 0, header_type[last_header], self.type).astype(np.uint8)
+        if is_header.any():
+            self.type = int(header_type[last_header[-1]])
+
+        # split the words into categories (data words are split by type)
+        # and collect the categories every field applies to, grouped by mask and shift
+        categories = {}
+        fields = {}
+        for i, id in enumerate(self.data_types):
+            if id == 'data':
+                for t, datatypelist in self.format['types'].items():
+                    if t == 0:
+                        # unknown types fall back to the default, like in read
+                        categories[(id, t)] = (data_type == i) & ~np.isin(res['type'], [x for x in self.format['types'] if x != 0])
+                    else:
+                        categories[(id, t)] = (data_type == i) & (res['type'] == t)
+                    for d in datatypelist:
+                        key = (d, self.format['data'][id][d]['mask'], self.format['data'][id][d]['shift'])
+                        fields.setdefault(key, []).append((id, t))
+            else:
+                categories[(id, None)] = data_type == i
+                for d in self.format['data'][id]:
+                    key = (d, self.format['data'][id][d]['mask'], self.format['data'][id][d]['shift'])
+                    fields.setdefault(key, []).append((id, None))
+
+        # many fields apply to the same set of categories, only select those words once
+        selected = {}
+        for (d, mask, shift), cats in fields.items():
+            cats = tuple(cats)
+            if cats not in selected:
+                sel = np.logical_or.reduce([categories[c] for c in cats])
+                if sel.all():
+                    selected[cats] = (slice(None), words)
+                else:
+                    idx = np.flatnonzero(sel)
+                    selected[cats] = (idx, words[idx])
+            idx, selected_words = selected[cats]
+
+            dtype = self.get_field_dtype(mask, shift)
+            if d not in res:
+                res[d] = np.zeros(len(words), dtype=dtype)
+            elif np.promote_types(res[d].dtype, dtype) != res[d].dtype:
+                res[d] = res[d].astype(np.promote_types(res[d].dtype, dtype))
+            res[d][idx] = (selected_words & np.uint64(mask)) >> np.uint64(shift)
+
+        res['raw'] = words & np.uint64(0xFFFFFFFFFF)
+        res['raw_full'] = words
+        res['meta'] = ((words >> np.uint64(40)) & np.uint64(0xFFFFFF)).astype(np.uint32)
+
+        return res
+
 if __name__ == '__main__':
 
     test_words = [
@@ -89,3 +180,25 @@ if __name__ == '__main__':
     df = DataFrame('ETROC2')
     for word in test_words:
         df.read(word, quiet=False)
+
+    # compare the vectorized decoder to the per word one
+    import time
+    words = np.array(test_words*100000, dtype=np.uint64)
+
+    df.type = 0
+    start = time.time()
+    res_array = df.read_array(words)
+    time_array = time.time() - start
+
+    df.type = 0
+    start = time.time()
+    res_list = list(map(df.read, words.tolist()))
+    time_list = time.time() - start
+
+    for i, (t, r) in enumerate(res_list):
+        assert t == (df.data_types[res_array['data_type'][i]] if res_array['data_type'][i] >= 0 else None)
+        for d in r:
+            if d not in ['raw', 'raw_full', 'meta']:
+                assert r[d] == res_array[d][i], (i, d)
+
+    print(f"Decoded {len(words)} words in {time_array:.3f}s (vectorized) vs {time_list:.3f}s (per word)")
@@ -7,7 +7,7 @@ import os
 
 from tamalero.utils import load_yaml, ffs, bit_count
 from tamalero.ETROC import ETROC
-from crcETROC import mod2div
+from tamalero.crc import get_crc
 
 here = os.path.dirname(os.path.abspath(__file__))
 maxpixel = 256
@@ -144,10 +144,6 @@ class ETROC2_Emulator(ETROC):
         frame = [header] + self.L1Adata + [trailer]
 
         #Computing CRC and adding it to the trailer
-        poly ='100101111' #crc generator polynomial
-        binstr40 = np.vectorize(lambda x: f'{x:040b}') #joining event frames into a string of bits
-        merged_frames = "".join(binstr40(frame)) 
-        crc_val = mod2div(merged_frames,poly) #compute CRC value
-        frame[-1] = trailer +int(crc_val,2) 
+        frame[-1] = trailer + get_crc(frame)
         
         return frame
\ No newline at end of file
@@ -1,11 +1,18 @@
 import struct
 import os
 import time
+import signal
+import threading
 import numpy as np
 from tamalero.utils import chunk
 from yaml import load, dump
 from tamalero.DataFrame import DataFrame
-from uhal._core import exception as uhal_exception
+from tamalero.raw_data import merge_words
+from tamalero.block_size import AdaptiveBlockSize
+try:
+    from uhal._core import exception as uhal_exception
+except ModuleNotFoundError:
+    from tamalero.uhal_mock import exception as uhal_exception
 
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
@@ -15,32 +22,24 @@ except ImportError:
 def revbits(x):
     return int(f'{x:08b}'[::-1],2)
 
-def merge_words(res):
-    '''
-    this function merges 32 bit words from the fifo into 64 bit words (40bit ETROC2 + added meta data in the DAQ)
-    it strips empty entries and removes orphan 32 bit words that could be present at the end of a FIFO read
-    '''
-    if len(res) > 0:
-        # offset is only needed when zero suppression is turned off, and packet boundaries are not defined
-        # it relies on the fact that the second 32 bit word is half empty (8 bit ETROC data + 12 bits meta data)
-        # if we ever add more meta data this has to be revisited
-        #offset = 1 if (res[1] > res[0]) else 0
-        offset = 0
-        #print(f"## Offset is {offset=}")
-        #offset = 0
-        res = res[offset:]
-        #empty_frame_mask = np.array(res[0::2]) > (2**8)  # masking empty fifo entries
-        #print(res)
-        empty_frame_mask = np.array(res[0::2]) > 0  # masking empty fifo entries FIXME verify that this does not cause troubles! remove mask if possible
-        len_cut = min(len(res[0::2]), len(res[1::2]))  # ensuring equal length of arrays downstream
-        return list (np.array(res[0::2])[:len_cut][empty_frame_mask[:len_cut]] | (np.array(res[1::2]) << 32)[:len_cut][empty_frame_mask[:len_cut]])
-    else:
-        return []
-
 class FIFO:
-    def __init__(self, rb, block=255):
+    words_per_occupancy = 4  # not sure where the factor of 4 comes from, but it's needed (same as in daq.py)
+
+    def __init__(self, rb, block=None, batch=None, near_full=None):
+        '''
+        block is the number of words per readBlock, batch the number of words per dispatch.
+        by default they are loaded from configs/daq_tuning.yaml, and the batch adapts to read errors.
+        near_full is the occupancy above which the FIFO is read again after a pipelined read,
+        if None this is only done when the FIFO full flag is set.
+        '''
         self.rb = rb
-        self.block = block
+        self.sizer = AdaptiveBlockSize(
+            block = block,
+            batch = batch,
+            ipb_path = getattr(rb.kcu, 'ipb_path', None) if rb is not None else None,
+        )
+        self.block = self.sizer.block
+        self.near_full = near_full
         if rb != None:
             self.reset()
 
@@ -106,26 +105,22 @@ class FIFO:
         rate = self.rb.kcu.read_node("SYSTEM.L1A_RATE_CNT").value()
         return rate
 
-    def send_l1a(self, count=1, quiet=True):
-        start_time = time.time()
-        for i in range(count):
-            try:
-                self.rb.kcu.write_node("SYSTEM.L1A_PULSE", 1)
-            except:
-                print("Couldn't send pulse.")
-        timediff = time.time() - start_time
-        rate = count/timediff
+    def send_l1a(self, count=1, quiet=True, burst=None, spacing=0):
+        '''
+        send count L1As, in bursts of pulses per dispatch (see KCU.send_pulses)
+        '''
+        rate = self.rb.kcu.send_pulses("SYSTEM.L1A_PULSE", count, burst=burst, spacing=spacing)
         if not quiet:
             print(f"Sent {count} L1As at a rate of {rate}Hz")
         return rate
 
-    def send_QInj(self, count=1, delay=0):
+    def send_QInj(self, count=1, delay=0, burst=None, spacing=0):
+        '''
+        send count charge injection pulses followed by an L1A after delay clock cycles,
+        in bursts of pulses per dispatch (see KCU.send_pulses)
+        '''
         self.rb.kcu.write_node("READOUT_BOARD_%s.L1A_INJ_DLY"%self.rb.rb, delay)
-        for i in range(count):
-            try:
-                self.rb.kcu.write_node("READOUT_BOARD_%s.L1A_QINJ_PULSE" % self.rb.rb, 0x01)
-            except:
-                print("Couldn't send pulse.")
+        return self.rb.kcu.send_pulses("READOUT_BOARD_%s.L1A_QINJ_PULSE" % self.rb.rb, count, burst=burst, spacing=spacing)
 
     def reset(self):
         self.rb.kcu.write_node("READOUT_BOARD_%s.FIFO_RESET" % self.rb.rb, 0x01)
@@ -154,13 +149,63 @@ class FIFO:
                 print(f"uhal UDP error in FIFO.read_block, block size is {block}")
                 raise
 
-    def read(self, dispatch=False, verbose=False):
-        #occupancy = self.get_occupancy()*4 + 2  # FIXME don't know where factor of 4 comes from??
-        #if verbose: print(f"{occupancy=}")
-        #num_blocks_to_read = occupancy // self.block
-        #if verbose: print(f"{num_blocks_to_read=}")
-        #last_block = occupancy % self.block
-        #if verbose: print(f"{last_block=}")
+    def read(self, dispatch=False, verbose=False, pipelined=True):
+        '''
+        read everything that is in the FIFO, returns a list of 32 bit words.
+        uses the pipelined readout of read_words, pipelined=False uses the old loop
+        that checks the occupancy after every block.
+        '''
+        if not pipelined:
+            return self.read_polling(dispatch=dispatch)
+        return self.read_words(verbose=verbose).tolist()
+
+    def read_words(self, verbose=False):
+        '''
+        read everything that is in the FIFO, returns a numpy array of 32 bit words.
+        the occupancy is read once, all the block reads are queued
+        and dispatched in as few dispatches as possible.
+        the occupancy is only checked again if the FIFO was (close to) full,
+        because then more data might have arrived while reading.
+        '''
+        chunks = []
+        while True:
+            occupancy, full = self.get_occupancy_and_full()
+            n_words = occupancy * self.words_per_occupancy
+            if verbose: print(f"{occupancy=}, {n_words=}, {full=}")
+            if n_words == 0:
+                break
+            chunks.append(self.read_n_words(n_words))
+            if not (full or (self.near_full is not None and occupancy >= self.near_full)):
+                break
+
+        if len(chunks) == 1:
+            return chunks[0]
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint32)
+
+    def read_n_words(self, n_words):
+        '''
+        read n_words from the FIFO into a preallocated buffer.
+        the block reads are queued and dispatched in batches, see AdaptiveBlockSize.
+        words of a batch that failed are lost.
+        '''
+        node = self.rb.kcu.hw.getNode(f"DAQ_RB{self.rb.rb}")
+        data = np.empty(n_words, dtype=np.uint32)
+        pos = 0
+        for sizes in self.sizer.dispatches(n_words):
+            reads = [node.readBlock(size) for size in sizes]
+            try:
+                self.rb.kcu.dispatch()
+            except uhal_exception:
+                print(f"uhal UDP error in FIFO.read_n_words, lost {sum(sizes)} words")
+                self.sizer.failure()
+                continue
+            self.sizer.success()
+            for size, read in zip(sizes, reads):
+                data[pos:pos+size] = read.value()
+                pos += size
+        return data[:pos]
+
+    def read_polling(self, dispatch=False):
         data = []
         while self.get_occupancy()>0:
             # FIXME checking get_occupancy all the time is slow, but this is at least not broken.
@@ -168,36 +213,8 @@ class FIFO:
                data += self.read_block(250, dispatch=dispatch).value()
             except:
                print('Data read failed')
-
-        #if (num_blocks_to_read or last_block):
-        #    if dispatch:
-        #        #while self.get_occupancy()>0:
-        #        #    data += self.read_block(255, dispatch=dispatch).value()
-        #        for b in range(num_blocks_to_read):
-        #            #print(b)
-        #            try:
-        #                data += self.read_block(self.block, dispatch=dispatch).value()
-        #            except uhal_exception:
-        #                print("uhal UDP error in daq, full blocks")
-        #                return data
-        #        try:
-        #            data += self.read_block(last_block, dispatch=dispatch).value()
-        #        except uhal_exception:
-        #            print("uhal UDP error in daq, last block")
-        #            return data
-        #    else:
-        #        # FIXME the part below should be faster but is somehow broken now
-        #        reads = num_blocks_to_read * [self.read_block(self.block, dispatch=dispatch)] + [self.read_block(last_block, dispatch=dispatch)]
-        #        try:
-        #            self.rb.kcu.hw.dispatch()
-        #        except:
-        #            print("uhal UDP error in daq")
-
-        #        for read in reads:
-        #            data += read.value()
         return data
 
-
     def get_occupancy(self):
         try:
             return self.rb.kcu.read_node(f"READOUT_BOARD_{self.rb.rb}.RX_FIFO_OCCUPANCY").value()
@@ -206,6 +223,20 @@ class FIFO:
             return self.rb.kcu.read_node(f"READOUT_BOARD_{self.rb.rb}.RX_FIFO_OCCUPANCY").value()
             #raise
 
+    def get_occupancy_and_full(self):
+        '''
+        read occupancy and full flag of the FIFO in a single dispatch
+        '''
+        hw = self.rb.kcu.hw
+        occupancy = hw.getNode(f"READOUT_BOARD_{self.rb.rb}.RX_FIFO_OCCUPANCY").read()
+        full = hw.getNode(f"READOUT_BOARD_{self.rb.rb}.RX_FIFO_FULL").read()
+        try:
+            self.rb.kcu.dispatch()
+        except uhal_exception:
+            print("uhal UDP error in FIFO.get_occupancy_and_full")
+            return 0, False
+        return occupancy.value(), bool(full.value())
+
     def is_full(self):
         try:
             return self.rb.kcu.read_node(f"READOUT_BOARD_{self.rb.rb}.RX_FIFO_FULL").value()
@@ -223,20 +254,76 @@ class FIFO:
         return self.rb.kcu.read_node(f"SYSTEM.L1A_RATE_CNT").value()
 
     def pretty_read(self, df, dispatch=True, raw=False):
-        merged = merge_words(self.read(dispatch=dispatch))
+        merged = merge_words(self.read_words(), threshold=0)
         if raw:
-            return merged
+            return merged.tolist()
         else:
             return list(map(df.read, merged))
 
-    def stream(self, f_out, timeout=10):
-        # FIXME this is WIP
+    def get_event_count(self):
+        try:
+            return self.rb.kcu.read_node(f"READOUT_BOARD_{self.rb.rb}.EVENT_CNT").value()
+        except Exception:
+            return None
+
+    def stream(self, f_out, timeout=10, max_size=2**28, max_time=60, stop=None):
+        '''
+        continuously read the FIFO and write the words to a series of files {f_out}_{i:04d}.dat.
+        a file is closed after max_size bytes or max_time seconds, and added to the index {f_out}_index.yaml
+        with the offset of its first word in the stream, its start and stop time and the event counter,
+        so that closed files can already be processed while the run continues.
+        words of an event can end up in two consecutive files.
+        streaming stops after timeout seconds (never if None), when the threading.Event stop is set,
+        or on SIGINT / SIGTERM. The FIFO is read a last time before the last file is closed.
+        returns the list of files.
+        '''
+        stop = stop if stop is not None else threading.Event()
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for sig in [signal.SIGINT, signal.SIGTERM]:
+                handlers[sig] = signal.signal(sig, lambda *args: stop.set())
+
+        f_index = f"{f_out}_index.yaml"
+        index = {'files': [], 'complete': False}
+        offset = 0
+
+        def open_file():
+            entry = {
+                'file': f"{f_out}_{len(index['files']):04d}.dat",
+                'offset': offset,
+                'start_time': time.time(),
+                'start_events': self.get_event_count(),
+            }
+            return entry, open(entry['file'], mode="wb")
+
+        def close_file(entry, f, complete=False):
+            f.close()
+            entry['words'] = offset - entry['offset']
+            entry['stop_time'] = time.time()
+            entry['stop_events'] = self.get_event_count()
+            index['files'].append(entry)
+            index['complete'] = complete
+            # replace the index in one go, so that readers never see a partial file
+            with open(f_index + '.tmp', 'w') as fi:
+                dump(index, fi, Dumper=Dumper)
+            os.replace(f_index + '.tmp', f_index)
+
         start = time.time()
-        with open(f_out, mode="wb") as f:
-            while True:
-                data = self.read()
-                f.write(struct.pack('<{}I'.format(len(data)), *data))
-
-                timediff = time.time() - start
-                if timediff > timeout:
-                    break
+        entry, f = open_file()
+        try:
+            while not stop.is_set() and (timeout is None or time.time() - start < timeout):
+                data = self.read_words()
+                data.tofile(f)
+                offset += len(data)
+                if f.tell() >= max_size or time.time() - entry['start_time'] >= max_time:
+                    close_file(entry, f)
+                    entry, f = open_file()
+            data = self.read_words()
+            data.tofile(f)
+            offset += len(data)
+        finally:
+            close_file(entry, f, complete=True)
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+
+        return [entry['file'] for entry in index['files']]
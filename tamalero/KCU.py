@@ -5,8 +5,30 @@ try:
     import uhal
 except ModuleNotFoundError:
     print("Running without uhal (ipbus not installed with correct python bindings)")
+    from tamalero import uhal_mock as uhal
+from tamalero import uhal_mock
 from tamalero.colors import red, green
+from tamalero.block_size import max_block
+from contextlib import contextmanager
+import numpy as np
+import threading
 import time
+import re
+
+CLOCKS = (('FW_INFO.CLK125_FREQ', 125000000),
+          ('FW_INFO.CLK320_FREQ', 320640000),
+          ('FW_INFO.CLK_40_FREQ',  40080000),
+          ('FW_INFO.REFCLK_FREQ', 320640000),
+          ('FW_INFO.RXCLK0_FREQ', 320640000),
+          ('FW_INFO.RXCLK1_FREQ', 320640000),
+          ('FW_INFO.TXCLK0_FREQ', 320640000),
+          ('FW_INFO.TXCLK1_FREQ', 320640000))
+
+LINK_STATUS = ('.*LPGBT.*DOWNLINK.*READY',
+               '.*LPGBT.*UPLINK_0.*READY',
+               '.*LPGBT.*UPLINK_0.*FEC_ERR_CNT',
+               '.*LPGBT.*UPLINK_1.*READY',
+               '.*LPGBT.*UPLINK_1.*FEC_ERR_CNT')
 
 class KCU:
 
@@ -17,14 +39,18 @@ class KCU:
                  dummy=False):
 
         uhal.disableLogging()
-        self.auto_dispatch = True  # default -> True
 
         self.dummy = dummy
+        self.ipb_path = ipb_path
 
         self.max_retries = 10
+        self.nodes = {}  # id -> uhal node, resolved once
+        self.node_ids = None  # all ids of the address table
+        self.lock = threading.RLock()  # one thread at a time queues and dispatches transactions
+        self.batch_state = threading.local()
         if not self.dummy:
             try:
-                self.hw = uhal.getDevice("my_device", ipb_path, "file://" + adr_table)
+                self.load_address_table(adr_table)
             except:
                 raise Exception("uhal can't get device at"+adr_table)
             self.firmware_version = self.get_firmware_version(string=False, verbose=False)
@@ -32,29 +58,133 @@ class KCU:
             self.hw = None
         self.readout_boards = []
 
-    def toggle_dispatch(self):
-        self.auto_dispatch = False
+    def load_address_table(self, adr_table):
+        '''
+        (re)connect to the device with the given address table,
+        e.g. the full table after reading the firmware version with the bootstrap table
+        '''
+        # mock:// paths use the software emulation of the KCU, see tamalero/uhal_mock.py
+        device = uhal_mock if self.ipb_path.startswith("mock://") else uhal
+        with self.lock:
+            self.hw = device.getDevice("my_device", self.ipb_path, "file://" + adr_table)
+            self.adr_table = adr_table
+            self.nodes = {}
+            self.node_ids = None
 
     def dispatch(self):
         i = 0
         while i<self.max_retries:
             try:
                 self.hw.dispatch()
-                self.auto_dispatch = True
                 break
             except:
                 if i > (self.max_retries-2):
                     raise
                 i+=1
 
+    @property
+    def in_batch(self):
+        return getattr(self.batch_state, 'depth', 0) > 0
+
+    def dispatch_now(self):
+        '''
+        dispatch unless this thread is in a batch
+        '''
+        if not self.in_batch:
+            self.dispatch()
+
+    @contextmanager
+    def batch(self):
+        '''
+        queue all reads, writes and actions of the block and send them with a single dispatch at the end:
+
+        with kcu.batch():
+            kcu.write_node("READOUT_BOARD_0.SC.TX_REGISTER_ADDR", adr)
+            val = kcu.read_node("READOUT_BOARD_0.SC.RX_DATA_FROM_GBTX")
+        print(val.value())
+
+        the values of reads are only valid after the outermost batch has ended.
+        batches can be nested, and other threads wait until the batch is dispatched.
+        '''
+        with self.lock:
+            self.batch_state.depth = getattr(self.batch_state, 'depth', 0) + 1
+            try:
+                yield self
+            finally:
+                self.batch_state.depth -= 1
+                if self.batch_state.depth == 0 and self.hw is not None:
+                    self.dispatch()
+
+    def get_node(self, id):
+        '''
+        uhal node of id, the nodes are cached
+        '''
+        try:
+            return self.nodes[id]
+        except KeyError:
+            self.nodes[id] = self.hw.getNode(id)
+            return self.nodes[id]
+
+    def get_node_ids(self):
+        if self.node_ids is None:
+            self.node_ids = list(self.hw.getNodes())
+            self.node_set = set(self.node_ids)
+        return self.node_ids
+
+    def is_readable(self, id):
+        '''
+        True for registers that can be read with a single read, without side effects
+        '''
+        reg = self.get_node(id)
+        return reg.getPermission() != uhal.NodePermission.WRITE and reg.getMode() == uhal.BlockReadWriteMode.SINGLE
+
+    def resolve(self, patterns):
+        '''
+        node ids for a list of node names and regular expressions, in the given order.
+        regular expressions only match registers that are readable with a single read.
+        '''
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        ids = self.get_node_ids()
+        res = []
+        for pattern in patterns:
+            if pattern in self.node_set:
+                res.append(pattern)
+            elif re.fullmatch(r'[\w.]+', pattern):
+                raise Exception(f"Failed finding node {pattern} in resolve")
+            else:
+                regex = re.compile(pattern)
+                res += [id for id in ids if regex.fullmatch(id) and self.is_readable(id)]
+        return list(dict.fromkeys(res))
+
+    def snapshot(self, patterns, array=False):
+        '''
+        read all registers given by node names or regular expressions at once.
+        the reads are queued and sent with as few dispatches as fit into the IPbus packets.
+        returns a dictionary id -> value, or a structured array with name, address and value if array is set.
+        '''
+        ids = self.resolve(patterns)
+        n_reads = max(max_block(self.ipb_path) // 2, 1)  # a read is 2 words in the request and in the reply
+        values = {}
+        for i in range(0, len(ids), n_reads):
+            with self.batch():
+                reads = [(id, self.get_node(id).read()) for id in ids[i:i+n_reads]]
+            values.update((id, int(read.value())) for id, read in reads)
+        if array:
+            res = np.zeros(len(ids), dtype=[('name', 'U128'), ('address', 'u4'), ('value', 'u4')])
+            for i, id in enumerate(ids):
+                res[i] = (id, self.get_node(id).getAddress(), values[id])
+            return res
+        return values
+
     def write_node(self, id, value):
-        reg = self.hw.getNode(id)
-        if (reg.getPermission() == uhal.NodePermission.WRITE):
-            self.action_reg(reg)
-        else:
-            reg.write(value)
-            if self.auto_dispatch:
-                self.dispatch()
+        with self.lock:
+            reg = self.get_node(id)
+            if (reg.getPermission() == uhal.NodePermission.WRITE):
+                self.action_reg(reg)
+            else:
+                reg.write(value)
+                self.dispatch_now()
 
     def rd_lpgbt_adr(self, rb=0):
         '''
@@ -72,32 +202,35 @@ class KCU:
 
     def read_node(self, id):
         try:
-            reg = self.hw.getNode(id)
+            reg = self.get_node(id)
         except:
             raise Exception(f"Failed finding node {id} in read_node")
-        ret = reg.read()
-        if self.auto_dispatch:
-            self.dispatch()
+        with self.lock:
+            ret = reg.read()
+            self.dispatch_now()
         return ret
 
     def action_reg(self, reg):
         addr = reg.getAddress()
         mask = reg.getMask()
-        self.hw.getClient().write(addr, mask)
-        if self.auto_dispatch:
-            self.dispatch()
+        with self.lock:
+            self.hw.getClient().write(addr, mask)
+            self.dispatch_now()
 
     def action(self, id):
-        reg = self.hw.getNode(id)
+        reg = self.get_node(id)
         self.action_reg(reg)
 
-    def print_regs(self):
-
-        for id in self.hw.getNodes():
-            reg = self.hw.getNode(id)
+    def print_regs(self, values=False):
+        '''
+        print all registers, with their current values if values is set
+        '''
+        vals = self.snapshot('.*') if values else {}
+        for id in self.get_node_ids():
+            reg = self.get_node(id)
             # if (reg.getModule() == ""):
             if (reg.getMode() != uhal.BlockReadWriteMode.HIERARCHICAL):
-                print(self.format_reg(reg.getAddress(), reg.getPath()[4:], -1,
+                print(self.format_reg(reg.getAddress(), reg.getPath()[4:], vals.get(id, -1),
                                 self.format_permission(reg.getPermission())))
 
     def get_firmware_version(self, verbose=False, string=True):
@@ -107,7 +240,8 @@ class KCU:
                  "FW_INFO.HOG_INFO.GLOBAL_VER",
                  "FW_INFO.HOG_INFO.GLOBAL_SHA",)
 
-        (date, time, ver, sha) = (map (lambda x : self.read_node(x).value(), nodes))
+        values = self.snapshot(nodes)
+        (date, time, ver, sha) = (values[x] for x in nodes)
 
         if verbose:
             print("Firmware version: %04x/%02x/%02x %02x:%02x:%02x v%x.%x.%x sha=%07x" % (
@@ -141,24 +275,20 @@ class KCU:
         return "000000"
 
     def status(self):
+        locked = [f"READOUT_BOARD_{rb.rb}.ETROC_LOCKED{x}" for rb in self.readout_boards for x in ['', '_SLAVE']]
+        values = self.snapshot(list(LINK_STATUS) + [clock for clock, _ in CLOCKS] + locked)
+
         print("LPGBT Link Status from KCU:")
-        for id in self.hw.getNodes(".*LPGBT.*DOWNLINK.*READY"):
-            self.print_reg(self.hw.getNode(id), use_color=True, threshold=1)
-        for id in self.hw.getNodes(".*LPGBT.*UPLINK_0.*READY"):
-            self.print_reg(self.hw.getNode(id), use_color=True, threshold=1)
-        for id in self.hw.getNodes(".*LPGBT.*UPLINK_0.*FEC_ERR_CNT"):
-            self.print_reg(self.hw.getNode(id), use_color=True, threshold=1, invert=True)
-        for id in self.hw.getNodes(".*LPGBT.*UPLINK_1.*READY"):
-            self.print_reg(self.hw.getNode(id), use_color=True, threshold=1)
-        for id in self.hw.getNodes(".*LPGBT.*UPLINK_1.*FEC_ERR_CNT"):
-            self.print_reg(self.hw.getNode(id), use_color=True, threshold=1, invert=True)
-
-        self.check_clock_frequencies()
-        
+        for pattern in LINK_STATUS:
+            for id in self.resolve(pattern):
+                self.print_reg_value(id, values[id], use_color=True, threshold=1, invert=('FEC_ERR_CNT' in pattern))
+
+        self.check_clock_frequencies(values=values)
+
         for rb in self.readout_boards:
             print(f'Checking Readout Board {rb.rb}')
-            locked = self.read_node(f"READOUT_BOARD_{rb.rb}.ETROC_LOCKED").value()
-            locked_slave = self.read_node(f"READOUT_BOARD_{rb.rb}.ETROC_LOCKED_SLAVE").value()
+            locked = values[f"READOUT_BOARD_{rb.rb}.ETROC_LOCKED"]
+            locked_slave = values[f"READOUT_BOARD_{rb.rb}.ETROC_LOCKED_SLAVE"]
 
             for l in range(28):
                 if (locked >> l) & 1:
@@ -177,10 +307,16 @@ class KCU:
 
 
     def print_reg(self, reg, threshold=1, maxval=0xFFFFFFFF, use_color=False, invert=False):
-        from tamalero.colors import green, red, dummy
         val = reg.read()
-        id = reg.getPath()
         self.dispatch()
+        self.print_reg_value(reg.getPath()[4:], val, threshold=threshold, maxval=maxval, use_color=use_color, invert=invert)
+
+    def print_reg_value(self, id, val, threshold=1, maxval=0xFFFFFFFF, use_color=False, invert=False):
+        '''
+        print a register with a value that has been read already, e.g. with snapshot
+        '''
+        from tamalero.colors import green, red, dummy
+        reg = self.get_node(id)
         if use_color:
             if invert:
                 colored = green if (val < threshold and val < maxval) else red
@@ -188,7 +324,7 @@ class KCU:
                 colored = green if (val >= threshold and val < maxval) else red
         else:
             colored = dummy
-        print(colored(self.format_reg(reg.getAddress(), id[4:], val,
+        print(colored(self.format_reg(reg.getAddress(), id, val,
                               self.format_permission(reg.getPermission()))))
 
     def format_reg(self, address, name, val, permission=""):
@@ -205,42 +341,66 @@ class KCU:
         if perm == uhal.NodePermission.WRITE:
             return "w"
 
-    def check_clock_frequencies(self, verbose=False):
-        clocks = (('FW_INFO.CLK125_FREQ', 125000000),
-                  ('FW_INFO.CLK320_FREQ', 320640000),
-                  ('FW_INFO.CLK_40_FREQ',  40080000),
-                  ('FW_INFO.REFCLK_FREQ', 320640000),
-                  ('FW_INFO.RXCLK0_FREQ', 320640000),
-                  ('FW_INFO.RXCLK1_FREQ', 320640000),
-                  ('FW_INFO.TXCLK0_FREQ', 320640000),
-                  ('FW_INFO.TXCLK1_FREQ', 320640000))
-
+    def check_clock_frequencies(self, verbose=False, values=None):
+        '''
+        values: snapshot that contains the clock frequencies, they are read if not given
+        '''
         # freq = int(rd) / 1000000.0
         # print("%s = %6.2f MHz" % (id, freq))
 
+        if values is None:
+            values = self.snapshot([clock for clock, _ in CLOCKS])
+
         errs = 0
         tolerance = 3000  # increased tolerance to 3.0kHz (from 2kHz)
-        for clock in clocks:
-            freq = self.read_node(clock[0]).value()
+        for clock in CLOCKS:
+            freq = values[clock[0]]
             expect = clock[1]
             err = freq > expect + tolerance or freq < expect-tolerance
             errs = errs + err
             if (err or verbose):
-                self.print_reg(self.hw.getNode(clock[0]), use_color=True, threshold=clock[1] - tolerance, maxval=clock[1] + tolerance)
+                self.print_reg_value(clock[0], freq, use_color=True, threshold=clock[1] - tolerance, maxval=clock[1] + tolerance)
 
         return errs
 
-    def send_l1a(self, count=1, quiet=True, max_rate=-1):
-        sleeper = 1./max_rate if max_rate>0 else 0
+    def send_pulses(self, id, count=1, burst=None, spacing=0):
+        '''
+        send count pulses of the action register id, e.g. SYSTEM.L1A_PULSE.
+        the writes are queued and sent in bursts of `burst` pulses per dispatch,
+        by default as many as fit into one IPbus packet. Within a burst the pulses are sent back to back,
+        spacing is the minimum time in seconds between the start of two bursts.
+        returns the rate of pulses in Hz.
+        '''
+        reg = self.get_node(id)
+        addr = reg.getAddress()
+        mask = reg.getMask()
+        client = self.hw.getClient()
+        if burst is None:
+            burst = max(max_block(self.ipb_path) // 3, 1)  # a write transaction is 3 words
+
         start_time = time.time()
-        for i in range(count):
-            time.sleep(sleeper)
-            try:
-                self.write_node("SYSTEM.L1A_PULSE", 1)
-            except:
-                print("Couldn't send pulse.")
+        sent = 0
+        while sent < count:
+            burst_start = time.time()
+            n = min(burst, count - sent)
+            with self.lock:
+                for i in range(n):
+                    client.write(addr, mask)
+                try:
+                    self.dispatch()
+                except:
+                    print("Couldn't send pulse.")
+            sent += n
+            if spacing > 0 and sent < count:
+                time.sleep(max(spacing - (time.time() - burst_start), 0))
         timediff = time.time() - start_time
-        rate = count/timediff
+        return count/timediff if timediff > 0 else 0
+
+    def send_l1a(self, count=1, quiet=True, max_rate=-1):
+        if max_rate > 0:
+            rate = self.send_pulses("SYSTEM.L1A_PULSE", count, burst=1, spacing=1./max_rate)
+        else:
+            rate = self.send_pulses("SYSTEM.L1A_PULSE", count)
         if not quiet:
             print(f"Sent {count} L1As at a rate of {rate}Hz")
         return rate
@@ -297,13 +297,14 @@ class ReadoutBoard:
                       "UPLINK_0.FEC_ERR_CNT",
                       "UPLINK_1.READY",
                       "UPLINK_1.FEC_ERR_CNT",)))
+        values = self.kcu.snapshot(nodes)
         for node in nodes:
-            val = self.kcu.read_node(node)
+            val = values[node]
             err = 0
             err |= ("READY" in node and val != 1)
             err |= ("FEC_ERR_CNT" in node and val != 0)
             if err:
-                self.kcu.print_reg(self.kcu.hw.getNode(node), use_color=True, invert=True)
+                self.kcu.print_reg_value(node, val, use_color=True, invert=True)
 
     def check_data_integrity(self, channel=0, etroc='ETROC1', trigger=False):
         '''
@@ -340,14 +341,16 @@ class ReadoutBoard:
 
 
     def get_FEC_error_count(self, quiet=False):
+        nodes = {
+            'DAQ': "READOUT_BOARD_%s.LPGBT.UPLINK_0.FEC_ERR_CNT" % self.rb,
+            'TRIGGER': "READOUT_BOARD_%s.LPGBT.UPLINK_1.FEC_ERR_CNT" % self.rb,
+        }
+        values = self.kcu.snapshot(list(nodes.values()))
         if not quiet:
             print("{:<8}{:<8}{:<50}{:<8}".format("Address", "Perm.", "Name", "Value"))
-            self.kcu.print_reg(self.kcu.hw.getNode("READOUT_BOARD_%s.LPGBT.UPLINK_0.FEC_ERR_CNT" % self.rb), use_color=True, invert=True)
-            self.kcu.print_reg(self.kcu.hw.getNode("READOUT_BOARD_%s.LPGBT.UPLINK_1.FEC_ERR_CNT" % self.rb), use_color=True, invert=True)
-        return {
-            'DAQ': self.kcu.read_node("READOUT_BOARD_%s.LPGBT.UPLINK_0.FEC_ERR_CNT" % self.rb).value(),
-            'TRIGGER': self.kcu.read_node("READOUT_BOARD_%s.LPGBT.UPLINK_1.FEC_ERR_CNT" % self.rb).value()
-        }
+            for node in nodes.values():
+                self.kcu.print_reg_value(node, values[node], use_color=True, invert=True)
+        return {link: values[node] for link, node in nodes.items()}
 
     def reset_FEC_error_count(self, quiet=False):
         if not quiet:
@@ -1,25 +1,77 @@
 import xml.etree.ElementTree as xml
+import operator
+import hashlib
+import pickle
+import ast
 import os
+from bisect import bisect_left
+from types import MappingProxyType
+
+NO_CHILDREN = MappingProxyType({})
+
+# parsed address tables are cached in this process and on disk, keyed by the hash of the xml file.
+# increase CACHE_VERSION when the parsing or the Node class changes, to invalidate the files on disk.
+CACHE_VERSION = 1
+PARSED_TABLES = {}  # key -> (nodes, address_index, sorted_names), shared read-only by all RegParsers
+
+OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.FloorDiv: operator.floordiv,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+    ast.BitOr: operator.or_,
+    ast.BitAnd: operator.and_,
+}
+
+
+def eval_expression(expr):
+    '''
+    integer value of an address expression like "0x0174-0x16f", without using eval
+    '''
+    def _eval(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, int):
+            return node.value
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            return OPERATORS[type(node.op)](_eval(node.left), _eval(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return -_eval(node.operand)
+        raise ValueError(f"Unsupported expression {expr}")
+    return _eval(ast.parse(expr.strip(), mode='eval').body)
 
 
 class Node:
-    name = ''
-    vhdlname = ''
-    address = 0x0
-    real_address = 0x0
-    permission = ''
-    mask = 0x0
-    lsb_pos = 0x0
-    is_module = False
-    parent = None
-    level = 0
-    mode = None
+    __slots__ = ('name', 'vhdlname', 'address', 'real_address', 'permission', 'mask', 'lsb_pos',
+                 'is_module', 'parent', 'level', 'mode', 'top_node_name', 'children')
 
     def __init__(self, top_node_name):
         self.top_node_name = top_node_name
-        self.children = {}
+        self.children = NO_CHILDREN  # replaced by a dict when the first child is added
+        self.name = ''
+        self.vhdlname = ''
+        self.address = 0x0
+        self.real_address = 0x0
+        self.permission = ''
+        self.mask = 0x0
+        self.lsb_pos = 0x0
+        self.is_module = False
+        self.parent = None
+        self.level = 0
+        self.mode = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) if slot != 'children' or self.children is not NO_CHILDREN else None for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+        if self.children is None:
+            self.children = NO_CHILDREN
 
     def addChild(self, child):
+        if self.children is NO_CHILDREN:
+            self.children = {}
         self.children[child.name] = child
 
     def getVhdlName(self):
@@ -44,6 +96,10 @@ class RegParser(object):
 
     # Functions related to parsing registers.xml
     def parse_xml(self, ver=0, address_table='default', top_node_name="LPGBT", verbose=False):
+        '''
+        the parsed table is taken from the cache of this process, or from the cache on disk,
+        and the xml is only parsed if neither has this version of the table.
+        '''
         self.top_node_name = top_node_name
         if address_table == 'default':
             if ver == 0:
@@ -52,21 +108,66 @@ class RegParser(object):
                 self.address_table = os.path.abspath('./address_table/lpgbt_v1.xml')
         else:
             self.address_table = address_table
+        key = self.table_key()
+        if key not in PARSED_TABLES:
+            PARSED_TABLES[key] = self.load_table(key, verbose=verbose)
+        self.nodes, self.address_index, self.sorted_names = PARSED_TABLES[key]
+        self.containing_cache = {}
+
+    def table_key(self):
+        with open(self.address_table, 'rb') as f:
+            sha = hashlib.sha256(f.read())
+        sha.update(f"{self.top_node_name}:{CACHE_VERSION}".encode())
+        return sha.hexdigest()
+
+    def cache_file(self, key):
+        name = os.path.splitext(os.path.basename(self.address_table))[0]
+        return os.path.join(os.path.dirname(os.path.abspath(self.address_table)), 'cache', f'{name}_{key[:16]}.pkl')
+
+    def load_table(self, key, verbose=False):
+        '''
+        parsed table from the cache file, parses the xml and writes the cache file if needed
+        '''
+        f_cache = self.cache_file(key)
+        if os.path.isfile(f_cache):
+            try:
+                with open(f_cache, 'rb') as f:
+                    return pickle.load(f)
+            except Exception:
+                print(f"Could not load the cached address table {f_cache}, parsing the xml again.")
+
         if verbose:
             print('Parsing', self.address_table, '...')
-        self.tree = xml.parse(self.address_table)
-        root = self.tree.getroot()[0]
+        self.nodes = {}
+        tree = xml.parse(self.address_table)
+        root = tree.getroot()[0]
         self.vars = {}
+        self.address_cache = {}
         self.make_tree(root, '', 0x0, self.nodes, None, self.vars, False)
+        self.build_index()
+        table = (self.nodes, self.address_index, self.sorted_names)
 
-    def make_tree(self, node, base_name, base_address, nodes, parent_node, vars, is_generated):
-        if ((is_generated is None or is_generated is False) and
-            node.get('generate') is not None and
-            node.get('generate') == 'true'):
+        f_tmp = f"{f_cache}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(f_cache), exist_ok=True)
+            with open(f_tmp, 'wb') as f:
+                pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f_tmp, f_cache)  # atomic, other processes never see a partial file
+        except Exception as e:
+            # e.g. a read-only directory, or a PicklingError if this module was imported under another name
+            print(f"Could not write the address table cache {f_cache}: {e!r}")
+            try:
+                os.remove(f_tmp)
+            except OSError:
+                pass
+        return table
 
-            generate_size = self.parse_int(node.get('generate_size'))
-            generate_step = self.parse_int(node.get('generate_address_step'))
-            generate_var = node.get('generate_idx_var')
+    def make_tree(self, node, base_name, base_address, nodes, parent_node, vars, is_generated):
+        attrib = node.attrib
+        if not is_generated and attrib.get('generate') == 'true':
+            generate_size = self.parse_int(attrib.get('generate_size'))
+            generate_step = self.parse_int(attrib.get('generate_address_step'))
+            generate_var = attrib.get('generate_idx_var')
 
             for i in range(0, generate_size):
                 vars[generate_var] = i
@@ -75,23 +176,22 @@ class RegParser(object):
             return
 
         new_node = Node(self.top_node_name)
-        name = base_name
+        name = attrib.get('id')
         if base_name != '':
-            name += '.'
-        name += node.get('id')
-        name = self.substitute_vars(name, vars)
+            name = base_name + '.' + name
+        if '${' in name:
+            name = self.substitute_vars(name, vars)
         new_node.name = name
         address = base_address
-        if node.get('address') is not None:
-            address = base_address + self.parse_int(eval(node.get('address')))
+        if 'address' in attrib:
+            address = base_address + self.parse_address(attrib['address'])
         new_node.address = address
         new_node.real_address = address
-        new_node.permission = node.get('permission')
-        new_node.mask = self.parse_int(node.get('mask'))
+        new_node.permission = attrib.get('permission')
+        new_node.mask = self.parse_int(attrib.get('mask'))
         new_node.lsb_pos = self.mask_to_lsb(new_node.mask)
-        new_node.is_module = node.get('fw_is_module') is not None and node.get('fw_is_module') == 'true'
-        if node.get('mode') is not None:
-            new_node.mode = node.get('mode')
+        new_node.is_module = attrib.get('fw_is_module') == 'true'
+        new_node.mode = attrib.get('mode')
         nodes[name] = new_node
         if parent_node is not None:
             parent_node.addChild(new_node)
@@ -100,6 +200,22 @@ class RegParser(object):
         for child in node:
             self.make_tree(child, name, address, self.nodes, new_node, vars, False)
 
+    def parse_address(self, expr):
+        if expr not in self.address_cache:
+            self.address_cache[expr] = eval_expression(expr)
+        return self.address_cache[expr]
+
+    def build_index(self):
+        '''
+        address -> node (the first one with this address, like the order of self.nodes), and the sorted names for prefix lookups
+        '''
+        self.address_index = {}
+        for node in self.nodes.values():
+            if node.real_address not in self.address_index:
+                self.address_index[node.real_address] = node
+        self.sorted_names = sorted(self.nodes)
+        self.containing_cache = {}
+
     def dump(self, nMax=99999):
         for i, nodename in enumerate(list(self.nodes.keys())[:nMax]):
             if i > 0:
@@ -118,32 +234,34 @@ class RegParser(object):
         return thisnode
 
     def get_node_from_address(self, nodeAddress):
-        for key in self.nodes:
-            if self.nodes[key].real_address == nodeAddress:
-                return self.nodes[key]
+        return self.address_index.get(nodeAddress)
+
+    def get_nodes_with_prefix(self, prefix):
+        '''
+        all nodes whose name starts with prefix, in alphabetical order
+        '''
+        names = self.sorted_names
+        res = []
+        for i in range(bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            res.append(self.nodes[names[i]])
+        return res
 
     def get_nodes_containing(self, nodeString):
 
-        nodelist = []
-
-        for key in self.nodes:
-            node = self.nodes[key]
-            if (nodeString in node.name):
-                nodelist.append(node)
+        if nodeString not in self.containing_cache:
+            self.containing_cache[nodeString] = [node for name, node in self.nodes.items() if nodeString in name]
+        nodelist = self.containing_cache[nodeString]
 
         if len(nodelist):
-            return nodelist
+            return list(nodelist)
         else:
             return None
 
     def get_regs_containing(self, nodeString):
 
-        nodelist = []
-
-        for key in self.nodes:
-            node = self.nodes[key]
-            if (nodeString in node.name and node.permission is not None and 'r' in node.permission):
-                nodelist.append(node)
+        nodelist = [node for node in (self.get_nodes_containing(nodeString) or []) if node.permission is not None and 'r' in node.permission]
 
         if len(nodelist):
             return nodelist
@@ -202,17 +320,9 @@ class RegParser(object):
         return ret
 
     def mask_to_lsb(self, mask):
-        if mask is None:
+        if not mask:
             return 0
-        if (mask & 0x1):
-            return 0
-        else:
-            idx = 1
-            while (True):
-                mask = mask >> 1
-                if (mask & 0x1):
-                    return idx
-                idx = idx+1
+        return (mask & -mask).bit_length() - 1
 
     def parse_int(self, s):
         if s is None:
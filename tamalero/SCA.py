@@ -201,18 +201,13 @@ class SCA:
             print(f"transid={transid}, channel={channel}, cmd={cmd}, adr={adr}, data={data}")
 
 
-        self.kcu.toggle_dispatch()
-
-        self.kcu.write_node("READOUT_BOARD_%d.SC.TX_CHANNEL" % self.rb, channel)
-        self.kcu.write_node("READOUT_BOARD_%d.SC.TX_CMD" % self.rb, cmd)
-        self.kcu.write_node("READOUT_BOARD_%d.SC.TX_ADDRESS" % self.rb, adr)
-    
-        self.kcu.write_node("READOUT_BOARD_%d.SC.TX_TRANSID" % self.rb, transid)
-    
-        self.kcu.write_node("READOUT_BOARD_%d.SC.TX_DATA" % self.rb, data)
-        self.kcu.action("READOUT_BOARD_%d.SC.START_COMMAND" % self.rb)
-
-        self.kcu.dispatch()
+        with self.kcu.batch():
+            self.kcu.write_node("READOUT_BOARD_%d.SC.TX_CHANNEL" % self.rb, channel)
+            self.kcu.write_node("READOUT_BOARD_%d.SC.TX_CMD" % self.rb, cmd)
+            self.kcu.write_node("READOUT_BOARD_%d.SC.TX_ADDRESS" % self.rb, adr)
+            self.kcu.write_node("READOUT_BOARD_%d.SC.TX_TRANSID" % self.rb, transid)
+            self.kcu.write_node("READOUT_BOARD_%d.SC.TX_DATA" % self.rb, data)
+            self.kcu.action("READOUT_BOARD_%d.SC.START_COMMAND" % self.rb)
     
         # reply packet structure
         # sof
@@ -246,13 +241,12 @@ class SCA:
             if (err & 0x40):
                 print("SCA Read Error :: Command In Treatment")
 
-        self.kcu.toggle_dispatch()
-        rx_rec  = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_RECEIVED" % self.rb)  # flag pulse
-        rx_ch   = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_CHANNEL" % self.rb)  # channel reply
-        rx_len  = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_LEN" % self.rb)
-        rx_ad   = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_ADDRESS" % self.rb)
-        rx_ctrl = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_CONTROL" % self.rb)
-        self.kcu.dispatch()
+        with self.kcu.batch():
+            rx_rec  = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_RECEIVED" % self.rb)  # flag pulse
+            rx_ch   = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_CHANNEL" % self.rb)  # channel reply
+            rx_len  = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_LEN" % self.rb)
+            rx_ad   = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_ADDRESS" % self.rb)
+            rx_ctrl = self.kcu.read_node("READOUT_BOARD_%d.SC.RX.RX_CONTROL" % self.rb)
 
         # dispatch and get the read values
         rx_rec  = rx_rec.value()  # flag pulse
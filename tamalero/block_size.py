@@ -0,0 +1,129 @@
+'''
+Block sizes for reading the DAQ FIFOs.
+AdaptiveBlockSize splits the occupancy of a FIFO into readBlocks and dispatches,
+growing the number of words per dispatch while reads succeed and shrinking it after uhal errors.
+The starting point is loaded from configs/daq_tuning.yaml, which is written by block_size_scan.py.
+'''
+import os
+import re
+import time
+from collections import deque
+from yaml import load, dump
+try:
+    from yaml import CLoader as Loader, CDumper as Dumper
+except ImportError:
+    from yaml import Loader, Dumper
+
+here = os.path.dirname(os.path.abspath(__file__))
+TUNING_FILE = os.path.join(here, '../configs/daq_tuning.yaml')
+
+DEFAULT_PAYLOAD = 1500  # bytes, standard ethernet MTU
+PACKET_OVERHEAD = 36  # bytes, IP and UDP headers, IPbus packet and transaction header
+
+
+def max_payload(ipb_path=None):
+    '''
+    max payload in bytes of an IPbus packet, as given by max_payload_size in the ipb_path
+    '''
+    if ipb_path is not None:
+        match = re.search(r'max_payload_size=(\d+)', ipb_path)
+        if match:
+            return int(match.group(1))
+    return DEFAULT_PAYLOAD
+
+
+def max_block(ipb_path=None):
+    '''
+    number of 32 bit words that can be read with a single IPbus packet.
+    larger readBlocks are split into several packets by uhal.
+    '''
+    return (max_payload(ipb_path) - PACKET_OVERHEAD) // 4
+
+
+def load_tuning(ipb_path=None, f_in=TUNING_FILE):
+    '''
+    block and batch size for the KCU at ipb_path, or the default ones if it hasn't been characterised
+    '''
+    with open(f_in, 'r') as f:
+        tuning = load(f, Loader=Loader)
+    res = dict(tuning['default'])
+    if ipb_path is not None and ipb_path in tuning:
+        res.update(tuning[ipb_path])
+    return res
+
+
+def save_tuning(ipb_path, settings, f_out=TUNING_FILE):
+    '''
+    store the settings (block, batch, throughput) for the KCU at ipb_path
+    '''
+    with open(f_out, 'r') as f:
+        tuning = load(f, Loader=Loader)
+    tuning[ipb_path] = settings
+    with open(f_out, 'w') as f:
+        dump(tuning, f, Dumper=Dumper)
+
+
+class AdaptiveBlockSize:
+    '''
+    block is the number of words per readBlock, it is capped by what fits in one IPbus packet.
+    batch is the number of words that are read in a single dispatch.
+    the batch grows by a factor `grow` after `n_grow` successful dispatches in a row,
+    and is halved after every uhal exception, staying between min_batch and max_batch.
+    with adaptive=False the sizes stay fixed.
+    '''
+    def __init__(self, block=None, batch=None, min_batch=None, max_batch=2**14, grow=2, n_grow=10, ipb_path=None, adaptive=True):
+        tuning = load_tuning(ipb_path) if (block is None or batch is None) else {}
+        self.block = min(block if block is not None else tuning['block'], max_block(ipb_path))
+        self.batch = batch if batch is not None else tuning['batch']
+        self.min_batch = min_batch if min_batch is not None else self.block
+        self.max_batch = max(max_batch, self.batch)
+        self.grow = grow
+        self.n_grow = n_grow
+        self.adaptive = adaptive
+
+        self.n_success = 0
+        self.n_failed = 0
+        self.n_dispatches = 0
+        self.history = deque([(time.time(), self.batch)], maxlen=1000)  # the last changes of the batch size
+
+    def dispatches(self, occupancy, remainder=True):
+        '''
+        split occupancy words into dispatches, every dispatch is a list of block sizes.
+        only full blocks are read, unless remainder is set.
+        '''
+        n_words = occupancy if remainder else occupancy - occupancy % self.block
+        res = []
+        while n_words > 0:
+            n_batch = min(n_words, max(self.batch // self.block, 1) * self.block)
+            res.append([self.block] * (n_batch // self.block) + ([n_batch % self.block] if n_batch % self.block else []))
+            n_words -= n_batch
+        return res
+
+    def set_batch(self, batch):
+        batch = min(max(batch, self.min_batch), self.max_batch)
+        if batch != self.batch:
+            self.batch = batch
+            self.history.append((time.time(), batch))
+
+    def success(self):
+        self.n_dispatches += 1
+        self.n_success += 1
+        if self.adaptive and self.n_success >= self.n_grow:
+            self.set_batch(self.batch * self.grow)
+            self.n_success = 0
+
+    def failure(self):
+        self.n_dispatches += 1
+        self.n_failed += 1
+        self.n_success = 0
+        if self.adaptive:
+            self.set_batch(self.batch // 2)
+
+    def stats(self):
+        return {
+            'block': self.block,
+            'batch': self.batch,
+            'dispatches': self.n_dispatches,
+            'failed_dispatches': self.n_failed,
+            'batch_history': [[t, b] for t, b in self.history],
+        }
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+'''
+Table driven CRC-8 of ETROC2 events.
+The CRC in the trailer is the remainder of the modulo-2 division of all 40 bit
+words of an event (header, data, trailer with the CRC bits set to 0) by the
+generator polynomial 100101111.
+'''
+import numpy as np
+
+POLY = 0b100101111
+NBITS = 40
+
+
+def _poly_mod(val, poly=POLY):
+    '''
+    remainder of the modulo-2 division of val by poly, bit by bit.
+    only used to build the tables.
+    '''
+    deg = poly.bit_length() - 1
+    while val.bit_length() > deg:
+        val ^= poly << (val.bit_length() - poly.bit_length())
+    return val
+
+
+def _gf2_mul(a, b):
+    res = 0
+    while b:
+        if b & 1:
+            res ^= a
+        a <<= 1
+        b >>= 1
+    return res
+
+
+def _make_tables(poly=POLY, nbits=NBITS):
+    # byte wise table: remainder of byte * x^8
+    byte_table = np.array([_poly_mod(i << 8, poly) for i in range(256)], dtype=np.uint8)
+
+    # the remainder of x^nbits repeats with a period, find it
+    x_n = _poly_mod(1 << nbits, poly)
+    powers = [1]
+    while True:
+        nxt = _poly_mod(_gf2_mul(powers[-1], x_n), poly)
+        if nxt == 1:
+            break
+        powers.append(nxt)
+
+    # multiplication table: remainder of r * x^(k*nbits), for every k within the period
+    shift_table = np.array(
+        [[_poly_mod(_gf2_mul(r, p), poly) for r in range(256)] for p in powers],
+        dtype=np.uint8,
+    )
+    return byte_table, shift_table
+
+
+BYTE_TABLE, SHIFT_TABLE = _make_tables()
+
+
+def word_remainder(words):
+    '''
+    remainder of every single 40 bit word, vectorized with the byte wise table
+    '''
+    words = np.asarray(words, dtype=np.uint64) & np.uint64(2**NBITS - 1)
+    rem = np.zeros(len(words), dtype=np.uint8)
+    for shift in range(NBITS - 8, 0, -8):
+        rem = BYTE_TABLE[rem ^ ((words >> np.uint64(shift)) & np.uint64(0xFF)).astype(np.uint8)]
+    return rem ^ (words & np.uint64(0xFF)).astype(np.uint8)
+
+
+def get_crc(frames, event_offsets=None):
+    '''
+    remainder of the modulo-2 division of every event by the generator polynomial.
+    frames are the (merged 64 bit) words of one or more events, only the 40 bit ETROC2 data is used.
+    event_offsets are the indices of the first word of every event, followed by len(frames).
+    if no offsets are given, frames are treated as a single event and a single int is returned.
+    For a trailer with the CRC bits set to 0 this is the CRC, for a complete event it is 0 if the CRC is correct.
+    '''
+    frames = np.asarray(frames, dtype=np.uint64)
+    single = event_offsets is None
+    if single:
+        event_offsets = [0, len(frames)]
+    event_offsets = np.asarray(event_offsets, dtype=np.int64)
+    frames = frames[event_offsets[0]:event_offsets[-1]]
+    event_offsets = event_offsets - event_offsets[0]
+
+    counts = np.diff(event_offsets)
+    crc = np.zeros(len(counts), dtype=np.uint8)
+    if len(frames) > 0:
+        # the contribution of every word depends on the number of words that follow it in its event
+        event_end = np.repeat(event_offsets[1:], counts)
+        following = event_end - 1 - np.arange(len(frames))
+        shifted = SHIFT_TABLE[following % len(SHIFT_TABLE), word_remainder(frames)]
+        not_empty = counts > 0
+        crc[not_empty] = np.bitwise_xor.reduceat(shifted, event_offsets[:-1][not_empty])
+
+    if single:
+        return int(crc[0])
+    return crc
+
+
+def verify_crc(frames, event_offsets):
+    '''
+    check the CRC of every event.
+    returns an array with True for every event with a correct CRC
+    '''
+    return get_crc(frames, event_offsets) == 0
+
+
+def verify_crc_stream(words, data_type, data_types):
+    '''
+    check the CRC of every event in a stream of words, classified with DataFrame.read_array.
+    filler and unknown words are dropped, events are cut at the headers.
+    returns the per event pass/fail array and the index of the header of every event in words
+    '''
+    is_frame = np.isin(data_type, [data_types.index(x) for x in ['header', 'data', 'trailer']])
+    frame_idx = np.flatnonzero(is_frame)
+    headers = np.flatnonzero(data_type[frame_idx] == data_types.index('header'))
+    event_offsets = np.append(headers, len(frame_idx))
+    return verify_crc(words[frame_idx], event_offsets), frame_idx[headers]
+
+
+def iter_crc(chunks, df):
+    '''
+    check the CRC of every event in a stream of chunks of merged words, e.g. from raw_data.iter_raw.
+    the words after the last header of a chunk could belong to an event that continues
+    in the next chunk, they are carried over.
+    yields the per event pass/fail array, the index of the header of every event
+    counted from the start of the stream, and the header words, for every chunk.
+    '''
+    HEADER = df.data_types.index('header')
+    words = np.zeros(0, dtype=np.uint64)
+    data_type = np.zeros(0, dtype=np.int8)
+    offset = 0  # index of the first carried word in the stream
+    for chunk in chunks:
+        words = np.concatenate([words, chunk])
+        data_type = np.concatenate([data_type, df.read_array(chunk)['data_type']])
+        headers = np.flatnonzero(data_type == HEADER)
+        # words before the first header of the stream don't belong to any event
+        cut = headers[-1] if len(headers) else len(words)
+        crc_checks, header_idx = verify_crc_stream(words[:cut], data_type[:cut], df.data_types)
+        yield crc_checks, header_idx + offset, words[header_idx]
+        words = words[cut:].copy()
+        data_type = data_type[cut:].copy()
+        offset += cut
+
+    crc_checks, header_idx = verify_crc_stream(words, data_type, df.data_types)
+    yield crc_checks, header_idx + offset, words[header_idx]
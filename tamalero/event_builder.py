@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+'''
+Columnar event builder for ETROC2 data.
+Builds the events record of data_dumper from an array of merged 64 bit words,
+working on whole columns of classified words instead of one word at a time.
+'''
+import numpy as np
+import awkward as ak
+from tamalero.DataFrame import DataFrame
+
+ADDITIONAL = 0  # header with the same L1 counter as the last event
+ACCEPTED = 1  # header that starts a new event
+SKIPPED = 2  # header of a double triggered or duplicate event
+
+MAX_HITS = 256
+MAX_HISTORY = 50  # number of kept words that are checked for duplicates
+
+
+def duplicate_mask(words, candidates, window=MAX_HISTORY, history=None):
+    '''
+    mask of words that are identical to one of the last `window` candidate words that were kept.
+    only words selected by `candidates` are considered, all other words are never masked.
+    history are the last kept candidate words before words, if words continue a stream.
+    '''
+    cand_idx = np.flatnonzero(candidates)
+    n_history = 0 if history is None else len(history)
+    vals = words[cand_idx] if history is None else np.concatenate([history, words[cand_idx]])
+    n = len(vals)
+
+    # index of the previous candidate with the same value
+    order = np.argsort(vals, kind='stable')
+    same = vals[order[1:]] == vals[order[:-1]]
+    prev_same = np.full(n, -1, dtype=np.int64)
+    prev_same[order[1:][same]] = order[:-1][same]
+    distance = np.where(prev_same >= 0, np.arange(n) - prev_same, n + window + 1)
+    distance[:n_history] = n + window + 1  # the history has been kept already
+
+    # words can only be dropped if the same word showed up within the window,
+    # widened by the number of words that could have been dropped in between
+    n_suspects = 0
+    while True:
+        suspects = np.flatnonzero(distance <= window + n_suspects)
+        if len(suspects) == n_suspects:
+            break
+        n_suspects = len(suspects)
+
+    # resolve the (rare) suspects in order, the window only counts kept words
+    dropped = []
+    is_dropped = set()
+    for k in suspects.tolist():
+        n_dropped = len(dropped)
+        prev = prev_same[k]
+        while prev >= 0:
+            n_between = n_dropped - np.searchsorted(dropped, prev, side='right')
+            if (k - prev) - n_between > window:
+                break
+            if prev not in is_dropped:
+                dropped.append(k)
+                is_dropped.add(k)
+                break
+            prev = prev_same[prev]
+
+    mask = np.zeros(len(words), dtype=bool)
+    mask[cand_idx[np.array(dropped, dtype=np.int64) - n_history]] = True
+    return mask
+
+
+def is_double_trigger(bcid, bcid_t):
+    return ((abs(bcid - bcid_t) < 150) | (abs(bcid + 3564 - bcid_t) < 50)) & (bcid != bcid_t)
+
+
+def initial_state():
+    '''
+    state of the event builder at the start of a stream.
+    l1a and bcid_t are the L1 counter and BCID of the last accepted event, i the number of accepted events.
+    uuid holds the position of every (L1 counter, BCID) pair in the list of uuids, which has n_uuid entries.
+    last_missing is the entry of missing_l1counter that still waits for the BCID of the next header.
+    history are the last header and data words that were kept.
+    '''
+    return {
+        'l1a': -1,
+        'bcid_t': 9999,
+        'i': 0,
+        'uuid': {},
+        'n_uuid': 0,
+        'last_missing': None,
+        'history': np.zeros(0, dtype=np.uint64),
+    }
+
+
+def copy_state(state):
+    state = dict(state)
+    state['uuid'] = dict(state['uuid'])
+    if state['last_missing'] is not None:
+        state['last_missing'] = list(state['last_missing'])
+    return state
+
+
+def resolve_headers_loop(l1counter, bcid, skip_trigger_check=False, verbose=False, state=None, quiet=False):
+    '''
+    decide for every header if it starts a new event, is an additional header
+    of the last event, or belongs to an event that is skipped.
+    a header is compared to the last accepted event, so this has to be done in order.
+    returns the kind of every header, the new entries of missing_l1counter,
+    the number of skipped events and the state after the last header.
+    '''
+    state = initial_state() if state is None else state
+    kind = np.empty(len(l1counter), dtype=np.int8)
+    missing_l1counter = []
+    skip_counter = 0
+
+    l1a = state['l1a']
+    bcid_t = state['bcid_t']
+    i = state['i']
+    last_missing = state['last_missing']
+    uuid = dict(state['uuid'])  # last position of every uuid
+    n_uuid = state['n_uuid']
+    for j, (l1, bc) in enumerate(zip(l1counter.tolist(), bcid.tolist())):
+        if bc != bcid_t and last_missing is not None:
+            last_missing.append(bc)
+            last_missing = None
+
+        if l1 == l1a:
+            kind[j] = ADDITIONAL
+            continue
+
+        if abs(l1a - l1) not in [1,255] and l1a>=0:
+            missing_l1counter.append([l1, bc, i, l1 - l1a])  # this checks if we miss any event according to the counter
+            last_missing = missing_l1counter[-1]
+
+        uuid_tmp = l1 | bc<<8
+        if uuid_tmp in uuid and abs(i - uuid[uuid_tmp]) < 150:
+            if not quiet:
+                print("Skipping duplicate event")
+            skip_counter += 1
+            kind[j] = SKIPPED
+            continue
+        uuid[uuid_tmp] = n_uuid
+        n_uuid += 1
+
+        if is_double_trigger(bc, bcid_t) and not skip_trigger_check:
+            if not quiet:
+                print("Skipping event", l1, bc, bcid_t)
+            skip_counter += 1
+            kind[j] = SKIPPED
+            continue
+
+        sus = (abs(l1a - l1)>1) and abs(l1a - l1)!=255 and verbose
+        if sus and not quiet:
+            print("SUS")
+        bcid_t = bc
+        l1a = l1
+        kind[j] = ACCEPTED
+        i += 1
+        if (verbose or sus) and not quiet:
+            print("New event:", l1a, i, bc)
+
+    state = dict(state, l1a=l1a, bcid_t=bcid_t, i=i, uuid=uuid, n_uuid=n_uuid, last_missing=last_missing)
+    return kind, missing_l1counter, skip_counter, state
+
+
+def resolve_headers(l1counter, bcid, skip_trigger_check=False, verbose=False, state=None, quiet=False):
+    '''
+    vectorized version of resolve_headers_loop.
+    as long as no event has to be skipped, every change of the L1 counter starts a new event.
+    if the masks find any duplicate or double triggered event, the headers are resolved in order.
+    '''
+    state = initial_state() if state is None else state
+    l1counter = l1counter.astype(np.int64)
+    bcid = bcid.astype(np.int64)
+    loop_args = dict(skip_trigger_check=skip_trigger_check, verbose=verbose, state=state, quiet=quiet)
+    if len(l1counter) == 0 or verbose:
+        return resolve_headers_loop(l1counter, bcid, **loop_args)
+
+    new = np.ones(len(l1counter), dtype=bool)
+    new[0] = l1counter[0] != state['l1a']
+    new[1:] = l1counter[1:] != l1counter[:-1]
+    new_idx = np.flatnonzero(new)
+    n_new = len(new_idx)
+    if n_new == 0:
+        return resolve_headers_loop(l1counter, bcid, **loop_args)
+    new_l1 = l1counter[new_idx]
+    new_bcid = bcid[new_idx]
+
+    # duplicate events: same L1 counter and BCID within the last 150 events.
+    # the position in the list of uuids is compared to the event number, they differ by the double triggered events
+    uuid = new_l1 | new_bcid<<8
+    event_number = state['i'] + np.arange(n_new)
+    position = state['n_uuid'] + np.arange(n_new)
+    order = np.argsort(uuid, kind='stable')
+    same = uuid[order[1:]] == uuid[order[:-1]]
+    prev_position = np.full(n_new, -1, dtype=np.int64)
+    prev_position[order[1:][same]] = position[order[:-1][same]]
+    if len(state['uuid']) > 0:
+        known = np.array(list(state['uuid'].items()), dtype=np.int64)
+        known = known[np.argsort(known[:, 0])]
+        first = np.ones(n_new, dtype=bool)
+        first[order[1:][same]] = False
+        k = np.minimum(np.searchsorted(known[:, 0], uuid), len(known) - 1)
+        from_state = first & (known[k, 0] == uuid)
+        prev_position[from_state] = known[k[from_state], 1]
+    duplicate = (prev_position >= 0) & (abs(event_number - prev_position) < 150)
+
+    # double triggered events: BCID close to the BCID of the previous event
+    double_trigger = is_double_trigger(new_bcid, np.append(state['bcid_t'], new_bcid[:-1]))
+
+    if duplicate.any() or (double_trigger.any() and not skip_trigger_check):
+        return resolve_headers_loop(l1counter, bcid, **loop_args)
+
+    kind = np.where(new, ACCEPTED, ADDITIONAL).astype(np.int8)
+
+    # events with an irregular increase of the L1 counter
+    step = new_l1 - np.append(state['l1a'], new_l1[:-1])
+    missing = np.flatnonzero((abs(step) != 1) & (abs(step) != 255))
+    if state['l1a'] < 0:
+        missing = missing[missing > 0]
+
+    # the BCID of the next header with a different BCID is added to the missing event,
+    # and to the one that was still waiting for it at the start
+    bcid_change = np.flatnonzero(bcid != np.append(state['bcid_t'], bcid[:-1]))
+    missing_l1counter = []
+    waiting = [(state['last_missing'], -1)] if state['last_missing'] is not None else []
+    waiting += [([int(new_l1[m]), int(new_bcid[m]), int(event_number[m]), int(step[m])], new_idx[m]) for m in missing]
+    missing_l1counter = [entry for entry, _ in waiting[len(waiting) - len(missing):]]
+    last_missing = None
+    for (entry, h), next_h in zip(waiting, [h for _, h in waiting[1:]] + [None]):
+        k = np.searchsorted(bcid_change, h, side='right')
+        if k < len(bcid_change) and (next_h is None or bcid_change[k] <= next_h):
+            entry.append(int(bcid[bcid_change[k]]))
+        elif next_h is None:
+            last_missing = entry
+
+    new_uuid = dict(state['uuid'])
+    new_uuid.update(zip(uuid.tolist(), position.tolist()))
+    state = dict(
+        state,
+        l1a = int(new_l1[-1]),
+        bcid_t = int(new_bcid[-1]),
+        i = state['i'] + n_new,
+        uuid = new_uuid,
+        n_uuid = state['n_uuid'] + n_new,
+        last_missing = last_missing,
+    )
+    return kind, missing_l1counter, 0, state
+
+
+def segment_count(mask, segment):
+    '''
+    running count (starting at 1) of the words in mask within their segment.
+    segment has to be non-decreasing.
+    '''
+    cnt = np.cumsum(mask)
+    if len(mask) == 0:
+        return cnt
+    start = np.flatnonzero(np.diff(segment, prepend=segment[0]-1) != 0)
+    offset = np.zeros(len(mask), dtype=cnt.dtype)
+    offset[start] = cnt[start] - mask[start]
+    offset = np.maximum.accumulate(offset)
+    return cnt - offset
+
+
+def last_index(mask):
+    '''
+    for every position, the index of the last position at or before it where mask is set (-1 if none)
+    '''
+    return np.maximum.accumulate(np.where(mask, np.arange(len(mask)), -1))
+
+
+def collect(n_events, *sources):
+    '''
+    combine the entries from different sources into one list per event.
+    every source is a tuple of (position, event, values), the entries are ordered by position.
+    '''
+    pos = np.concatenate([s[0] for s in sources])
+    event = np.concatenate([s[1] for s in sources])
+    values = np.concatenate([np.asarray(s[2]) for s in sources])
+    order = np.argsort(pos, kind='stable')
+    return ak.unflatten(values[order], np.bincount(event, minlength=n_events))
+
+
+def build_events(words, df=None, skip_trigger_check=False, verbose=False):
+    '''
+    build the events from an array of merged 64 bit words.
+    returns the events and a report with the header and trailer counts,
+    the list of missing L1 counters, the elink report and the number of skipped events.
+    '''
+    if df is None:
+        df = DataFrame('ETROC2')
+    words = np.asarray(words, dtype=np.uint64)
+    events, report, _, _ = build_chunk(
+        words,
+        df.read_array(words),
+        df,
+        skip_trigger_check = skip_trigger_check,
+        verbose = verbose,
+    )
+    return events, report
+
+
+def build_chunk(words, res, df, skip_trigger_check=False, verbose=False, state=None, final=True):
+    '''
+    build the events from a chunk of a stream of words, classified with DataFrame.read_array.
+    state is the state after the previous chunk, see initial_state.
+    unless this is the final chunk, the last event could continue in the next chunk, so only the
+    words before the last header that starts a new event are used.
+    returns the events, the report, the state after the used words and the number of used words.
+    '''
+    state = initial_state() if state is None else state
+    data_type = res['data_type']
+    HEADER, DATA, TRAILER = (df.data_types.index(x) for x in ['header', 'data', 'trailer'])
+
+    # identical header and data words within a short window are only read once
+    candidates = (data_type != TRAILER) & (data_type != df.data_types.index('filler'))
+    keep = ~duplicate_mask(words, candidates, history=state['history'])
+    kept_idx = np.flatnonzero(keep)
+    res_all = res
+    res = {k: v[keep] for k, v in res.items()}
+    header_idx = np.flatnonzero(res['data_type'] == HEADER)
+
+    n_used = len(words)
+    if not final:
+        kind, _, _, _ = resolve_headers(
+            res['l1counter'][header_idx],
+            res['bcid'][header_idx],
+            skip_trigger_check = skip_trigger_check,
+            state = copy_state(state),
+            quiet = True,
+        )
+        accepted_idx = header_idx[kind == ACCEPTED]
+        cut = accepted_idx[-1] if len(accepted_idx) else 0
+        n_used = kept_idx[cut] if len(accepted_idx) else 0
+        res = {k: v[:cut] for k, v in res.items()}
+        header_idx = header_idx[header_idx < cut]
+
+    data_type = res['data_type']
+    n_words = len(data_type)
+    is_header = data_type == HEADER
+    is_data = data_type == DATA
+    is_trailer = data_type == TRAILER
+
+    elink_report = {}
+    elinks, first = np.unique(res_all['elink'][:n_used], return_index=True)
+    for e in elinks[np.argsort(first)].tolist():
+        is_elink = res['elink'] == e
+        elink_report[e] = {
+            'nheader': int(np.count_nonzero(is_header & is_elink)),
+            'nhits': int(np.count_nonzero(is_data & is_elink)),
+            'ntrailer': int(np.count_nonzero(is_trailer & is_elink)),
+        }
+
+    # decide which headers start new events
+    kind, missing_l1counter, skip_counter, new_state = resolve_headers(
+        res['l1counter'][header_idx],
+        res['bcid'][header_idx],
+        skip_trigger_check = skip_trigger_check,
+        verbose = verbose,
+        state = state,
+    )
+    accepted_idx = header_idx[kind == ACCEPTED]
+    additional_idx = header_idx[kind == ADDITIONAL]
+    n_events = len(accepted_idx)
+
+    # event every word belongs to, and whether the last new event was skipped
+    is_accepted = np.zeros(n_words, dtype=bool)
+    is_accepted[accepted_idx] = True
+    event = np.cumsum(is_accepted) - 1
+    is_new = np.zeros(n_words, dtype=bool)
+    is_new[header_idx[kind != ADDITIONAL]] = True
+    last_new = last_index(is_new)
+    skipped = (last_new >= 0) & ~is_accepted[np.maximum(last_new, 0)]
+
+    # events with too many hits are cut after the first hit above the limit
+    hit = is_data & ~skipped & (event >= 0)
+    if np.any(is_data & ~skipped & (event < 0)):
+        print("Data stream started with data words, ignoring them.")
+    hit_number = segment_count(hit, last_new)
+    overflow = hit & (hit_number == MAX_HITS + 1)
+    for i in range(np.count_nonzero(overflow)):
+        print("This event already has more than 256 hits. Skipping event.")
+    overflowed = segment_count(overflow, last_new) - overflow > 0
+    hit &= hit_number <= MAX_HITS + 1
+    skip_event = skipped | overflowed
+
+    for i in np.flatnonzero(skip_event[additional_idx]).tolist():
+        h = additional_idx[i]
+        print("Skipping event (same l1a counter)", res['l1counter'][h], res['bcid'][h], res['bcid'][accepted_idx[event[h]]])
+
+    # only the first of consecutive trailers is counted.
+    # words that were skipped in the middle of processing don't break up trailers
+    processed = np.ones(n_words, dtype=bool)
+    processed[header_idx[kind == SKIPPED]] = False
+    processed[additional_idx[skip_event[additional_idx]]] = False
+    processed[overflow] = False
+    last_processed = np.full(n_words, -1, dtype=np.int64)
+    last_processed[1:] = last_index(processed)[:-1]
+    counted_trailer = is_trailer & ~((last_processed >= 0) & is_trailer[np.maximum(last_processed, 0)])
+    trailer_counter = int(np.count_nonzero(counted_trailer))
+    if np.any(counted_trailer & ~skip_event & (event < 0)):
+        print("Data stream started with a trailer, that is weird.")
+    trailer = counted_trailer & ~skip_event & (event >= 0)
+    trailer_idx = np.flatnonzero(trailer)
+
+    # hits since the last header, every trailer adds one chip ID per hit
+    hit_counter = np.cumsum(hit)
+    last_header = last_index(is_header)
+    hit_counter = hit_counter - np.where(last_header >= 0, hit_counter[np.maximum(last_header, 0)], 0)
+
+    hit_idx = np.flatnonzero(hit)
+    hit_type = res['type'][hit_idx]
+    tdc_idx = hit_idx[(hit_type != 1) & (hit_type != 2)]
+    counter_idx = hit_idx[hit_type == 1]
+
+    def per_event(idx, field):
+        return ak.unflatten(res[field][idx].astype(np.int64), np.bincount(event[idx], minlength=n_events))
+
+    def to_hex(idx, field):
+        return np.array([hex(x) for x in res[field][idx].tolist()], dtype=str)
+
+    header_bcid = res['bcid'][accepted_idx].astype(np.int64)
+    chipid_idx = np.repeat(trailer_idx, hit_counter[trailer_idx])
+
+    events = ak.Array({
+        'event': state['i'] + np.arange(n_events),
+        'l1counter': res['l1counter'][accepted_idx].astype(np.int64),
+        'nheaders': 1 + np.bincount(event[additional_idx], minlength=n_events),
+        'ntrailers': np.bincount(event[trailer_idx], minlength=n_events),
+        'row': per_event(hit_idx, 'row_id'),
+        'col': per_event(hit_idx, 'col_id'),
+        'tot_code': per_event(tdc_idx, 'tot'),
+        'toa_code': per_event(tdc_idx, 'toa'),
+        'cal_code': per_event(tdc_idx, 'cal'),
+        'elink': per_event(hit_idx, 'elink'),
+        'raw': collect(
+            n_events,
+            (accepted_idx, event[accepted_idx], to_hex(accepted_idx, 'raw_full')),
+            (additional_idx, event[additional_idx], to_hex(additional_idx, 'raw_full')),
+            (hit_idx, event[hit_idx], to_hex(hit_idx, 'raw_full')),
+            (trailer_idx, event[trailer_idx], to_hex(trailer_idx, 'raw')),
+        ),
+        'crc': per_event(trailer_idx, 'crc'),
+        'chipid': per_event(chipid_idx, 'chipid'),
+        'bcid': collect(
+            n_events,
+            (accepted_idx, np.arange(n_events), header_bcid),
+            (counter_idx, event[counter_idx], res['bcid'][counter_idx].astype(np.int64)),
+        ),
+        'counter_a': per_event(counter_idx, 'counter_a'),
+        'nhits': ak.singletons(np.bincount(event[hit_idx], minlength=n_events)),
+        'nhits_trail': np.bincount(event[trailer_idx], weights=res['hits'][trailer_idx], minlength=n_events).astype(np.int64),
+    })
+
+    report = {
+        'header_counter': len(header_idx),
+        'trailer_counter': trailer_counter,
+        'missing_l1counter': missing_l1counter,
+        'elink_report': elink_report,
+        'skip_counter': skip_counter,
+    }
+
+    # the last kept header and data words, and the uuids that can still be duplicated
+    history = words[:n_used][keep[:n_used] & candidates[:n_used]][-MAX_HISTORY:]
+    new_state['history'] = np.concatenate([state['history'], history])[-MAX_HISTORY:]
+    new_state['uuid'] = {u: p for u, p in new_state['uuid'].items() if p > new_state['i'] - 150}
+    return events, report, new_state, n_used
+
+
+def merge_reports(total, report):
+    '''
+    add the report of a chunk to the report of the whole stream
+    '''
+    if total is None:
+        return report
+    for k in ['header_counter', 'trailer_counter', 'skip_counter']:
+        total[k] += report[k]
+    total['missing_l1counter'] += report['missing_l1counter']
+    for e, counts in report['elink_report'].items():
+        if e not in total['elink_report']:
+            total['elink_report'][e] = {'nheader':0, 'nhits':0, 'ntrailer':0}
+        for k, v in counts.items():
+            total['elink_report'][e][k] += v
+    return total
+
+
+def iter_events(chunks, df=None, skip_trigger_check=False, verbose=False):
+    '''
+    build the events from a stream of chunks of merged 64 bit words, e.g. from raw_data.iter_raw.
+    the words of the last event of a chunk, which could continue in the next one, are carried over.
+    yields the events and the report of every chunk, see build_events.
+    '''
+    if df is None:
+        df = DataFrame('ETROC2')
+    state = initial_state()
+    words = np.zeros(0, dtype=np.uint64)
+    res = df.read_array(words)
+    chunks = iter(chunks)
+    chunk = next(chunks, words)
+    while chunk is not None:
+        next_chunk = next(chunks, None)
+        chunk = np.asarray(chunk, dtype=np.uint64)
+        chunk_res = df.read_array(chunk)
+        words = np.concatenate([words, chunk])
+        res = {k: np.concatenate([res[k], chunk_res[k]]) for k in chunk_res}
+        events, report, state, n_used = build_chunk(
+            words,
+            res,
+            df,
+            skip_trigger_check = skip_trigger_check,
+            verbose = verbose,
+            state = state,
+            final = next_chunk is None,
+        )
+        # copy, so that the rest of the chunk can be freed
+        words = words[n_used:].copy()
+        res = {k: v[n_used:].copy() for k, v in res.items()}
+        chunk = next_chunk
+        yield events, report
+
+def match_events(ref_event, ref_bcid, event, bcid, bcid_offset=1, window=100):
+    '''
+    find the matching event of another layer for every reference event.
+    an event matches if its BCID plus bcid_offset equals the reference BCID and its event number
+    is within the window of the reference event number. If several events match, the one
+    with the lowest event number is taken.
+    returns the index of the matching event, -1 for reference events without a match.
+    '''
+    ref_event = np.asarray(ref_event, dtype=np.int64)
+    ref_bcid = np.asarray(ref_bcid, dtype=np.int64)
+    event = np.asarray(event, dtype=np.int64)
+    bcid = np.asarray(bcid, dtype=np.int64) + bcid_offset
+    if len(event) == 0:
+        return np.full(len(ref_event), -1, dtype=np.int64)
+
+    # sort by (bcid, event), then look up the first candidate inside the window.
+    # event numbers are well below 2**31, so both fit into a single sort key
+    key = (bcid << 32) + event
+    order = np.argsort(key, kind='stable')
+    pos = np.searchsorted(key[order], (ref_bcid << 32) + ref_event - window + 1)
+
+    found = pos < len(order)
+    match = order[np.minimum(pos, len(order) - 1)]
+    found &= (bcid[match] == ref_bcid) & (abs(event[match] - ref_event) < window)
+    return np.where(found, match, -1)
+
+
+def merge_events(events_all_rb, fields=None, window=100):
+    '''
+    merge the events of several layers (readout boards) into the events of the first one.
+    the hits of the matching event of every other layer are appended to the hits
+    of the first layer, see match_events.
+    '''
+    if fields is None:
+        fields = ['row', 'col', 'tot_code', 'toa_code', 'cal_code', 'elink', 'chipid', 'nhits']
+    ref = events_all_rb[0]
+    ref_bcid = ak.to_numpy(ak.firsts(ref.bcid))
+    merged = {f: [ref[f]] for f in fields}
+
+    for events in events_all_rb[1:]:
+        match = match_events(
+            ak.to_numpy(ref.event),
+            ref_bcid,
+            ak.to_numpy(events.event),
+            ak.to_numpy(ak.firsts(events.bcid)),
+            window = window,
+        )
+        matched = match >= 0
+        for f in fields:
+            counts = np.zeros(len(ref), dtype=np.int64)
+            counts[matched] = ak.to_numpy(ak.num(events[f]))[match[matched]]
+            merged[f].append(ak.unflatten(ak.flatten(events[f][match[matched]]), counts))
+
+    return {f: ak.concatenate(merged[f], axis=1) for f in fields}
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+'''
+Reading and writing of the event records built by data_dumper.
+Events are stored as (zstd compressed) Parquet files, so that single columns can be
+loaded without reading the whole file.
+The old format, a JSON string of the events stored in a JSON file, can still be read and written.
+'''
+import os
+import json
+import numpy as np
+import awkward as ak
+
+# signed, so that differences of e.g. BCIDs or event numbers don't wrap around
+EVENT_DTYPES = {
+    'event': 'int64',
+    'l1counter': 'int16',
+    'nheaders': 'int16',
+    'ntrailers': 'int16',
+    'row': 'int8',
+    'col': 'int8',
+    'tot_code': 'int16',
+    'toa_code': 'int16',
+    'cal_code': 'int16',
+    'elink': 'int16',
+    'crc': 'int16',
+    'chipid': 'int32',
+    'bcid': 'int16',
+    'counter_a': 'int32',
+    'nhits': 'int32',
+    'nhits_trail': 'int32',
+}
+
+# fields with a list of values per event
+JAGGED_FIELDS = ['row', 'col', 'tot_code', 'toa_code', 'cal_code', 'elink', 'crc', 'chipid', 'bcid', 'counter_a', 'nhits']
+
+FORMATS = ['parquet', 'json']
+
+
+def empty_events():
+    '''
+    zero events, with all fields of EVENT_DTYPES so that columns can still be selected
+    '''
+    return ak.Array({
+        f: ak.unflatten(np.zeros(0, dtype=dtype), np.zeros(0, dtype=np.int64)) if f in JAGGED_FIELDS else np.zeros(0, dtype=dtype)
+        for f, dtype in EVENT_DTYPES.items()
+    })
+
+
+def compact_events(events):
+    '''
+    cast the fields of the events to the smallest integer type that holds them
+    '''
+    return ak.zip(
+        {f: ak.values_astype(events[f], EVENT_DTYPES[f]) if f in EVENT_DTYPES else events[f] for f in events.fields},
+        depth_limit = 1,
+    )
+
+
+def event_file(base, formats=FORMATS):
+    '''
+    returns the existing file of the events with file name base (without extension),
+    trying the formats in order. If there's none, the name for the first format is returned.
+    '''
+    for fmt in formats:
+        if os.path.isfile(f"{base}.{fmt}"):
+            return f"{base}.{fmt}"
+    return f"{base}.{formats[0]}"
+
+
+def write_events(events, f_out, compression='zstd'):
+    '''
+    write the events to f_out, the format is given by the extension (.parquet or .json).
+    compression can be any Parquet compression supported by pyarrow, or None.
+    '''
+    if os.path.splitext(f_out)[1] == '.json':
+        with open(f_out, "w") as f:
+            json.dump(ak.to_json(events), f)
+    else:
+        ak.to_parquet(compact_events(events), f_out, compression=compression)
+
+
+def read_events(f_in, columns=None):
+    '''
+    read the events from f_in, the format is given by the extension (.parquet or .json).
+    columns is an optional list of fields to load, for Parquet files only these are read from disk.
+    '''
+    if os.path.splitext(f_in)[1] == '.json':
+        with open(f_in, "r") as f:
+            events = ak.from_json(json.load(f))
+        if len(events) == 0:
+            # JSON doesn't keep the fields of an empty array
+            events = empty_events()
+        if columns is not None:
+            events = events[columns]
+        return events
+    return ak.from_parquet(f_in, columns=columns)
+
+
+class EventWriter:
+    '''
+    writes events chunk by chunk, every chunk becomes a row group of the Parquet file.
+    the old JSON format can't be written incrementally, the events are collected and written on close.
+    '''
+    def __init__(self, f_out, compression='zstd'):
+        self.f_out = f_out
+        self.compression = compression
+        self.is_json = os.path.splitext(f_out)[1] == '.json'
+        self.chunks = []
+        self.writer = None
+        self.n_events = 0
+
+    def write(self, events):
+        if len(events) == 0:
+            return
+        self.n_events += len(events)
+        if self.is_json:
+            self.chunks.append(events)
+            return
+        import pyarrow.parquet as pq
+        table = ak.to_arrow_table(compact_events(events))
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.f_out, table.schema, compression=self.compression)
+        if not table.schema.equals(self.writer.schema):
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.is_json:
+            write_events(ak.concatenate(self.chunks) if self.chunks else empty_events(), self.f_out)
+        elif self.writer is None:
+            # no events at all
+            ak.to_parquet(empty_events(), self.f_out, compression=self.compression)
+        else:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class EventReader:
+    '''
+    reads the events of a file row group by row group, so that only part of the file is in memory.
+    rows(start, stop) returns a range of events (None if it is empty), keeping the row groups
+    around it cached as long as the requested ranges move forward.
+    JSON files are read as a single row group.
+    '''
+    def __init__(self, f_in, columns=None):
+        self.f_in = f_in
+        self.columns = columns
+        if os.path.splitext(f_in)[1] == '.json':
+            self.file = None
+            self.events = read_events(f_in, columns=columns)
+            sizes = [len(self.events)]
+        else:
+            import pyarrow.parquet as pq
+            self.file = pq.ParquetFile(f_in)
+            sizes = [self.file.metadata.row_group(i).num_rows for i in range(self.file.num_row_groups)]
+        self.offsets = [0]
+        for size in sizes:
+            self.offsets.append(self.offsets[-1] + size)
+        self.cache = {}
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def row_group(self, i):
+        if self.file is None:
+            return self.events
+        return ak.from_arrow(self.file.read_row_group(i, columns=self.columns))
+
+    def __iter__(self):
+        for i in range(len(self.offsets) - 1):
+            yield self.row_group(i)
+
+    def rows(self, start, stop):
+        start, stop = max(start, 0), min(stop, len(self))
+        if start >= stop:
+            return None
+        groups = [i for i in range(len(self.offsets) - 1) if self.offsets[i] < stop and self.offsets[i+1] > start]
+        self.cache = {i: self.cache[i] if i in self.cache else self.row_group(i) for i in groups}
+        events = ak.concatenate([self.cache[i] for i in groups])
+        return events[start - self.offsets[groups[0]]:stop - self.offsets[groups[0]]]
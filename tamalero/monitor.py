@@ -0,0 +1,120 @@
+'''
+Online monitoring of the raw data stream: occupancy, TOA/TOT and L1 counter gaps per chip.
+The words are decoded in batches with DataFrame.read_array, chips are identified by RB and elink.
+'''
+import time
+import numpy as np
+from tamalero.DataFrame import DataFrame
+
+LEVELS = ' .:-=+*#%@'
+
+
+class ChipMonitor:
+    def __init__(self):
+        self.occupancy = np.zeros((16, 16), dtype=np.int64)
+        self.toa = np.zeros(1024, dtype=np.int64)
+        self.tot = np.zeros(512, dtype=np.int64)
+        self.l1_gaps = np.zeros(256, dtype=np.int64)  # histogram of the step of the L1 counter between events
+        self.last_l1 = None
+        self.n_hits = 0
+        self.n_events = 0
+        self.n_hits_last = 0  # hits at the last call of rate
+
+    def rate(self, dt):
+        rate = (self.n_hits - self.n_hits_last) / dt if dt > 0 else 0
+        self.n_hits_last = self.n_hits
+        return rate
+
+    @property
+    def missing_events(self):
+        '''
+        number of L1 counter values that were skipped
+        '''
+        return int(np.dot(self.l1_gaps[2:], np.arange(1, 255)))
+
+
+class OnlineMonitor:
+    '''
+    keeps the histograms for every chip, the words of every RB have to be given in order.
+    '''
+    def __init__(self, df=None):
+        self.df = df if df is not None else DataFrame('ETROC2')
+        self.HEADER = self.df.data_types.index('header')
+        self.DATA = self.df.data_types.index('data')
+        self.chips = {}  # (rb, elink) -> ChipMonitor
+        self.n_words = {}
+        self.start = time.time()
+        self.last_render = self.start
+
+    def chip(self, rb, elink):
+        if (rb, elink) not in self.chips:
+            self.chips[(rb, elink)] = ChipMonitor()
+        return self.chips[(rb, elink)]
+
+    def update(self, rb, words):
+        '''
+        add a batch of merged 64 bit words of one RB
+        '''
+        if len(words) == 0:
+            return
+        self.n_words[rb] = self.n_words.get(rb, 0) + len(words)
+        res = self.df.read_array(words)
+        is_hit = res['data_type'] == self.DATA
+        has_time = res['type'] == 0  # TOA and TOT are only there in normal data, not for the test types
+        is_header = res['data_type'] == self.HEADER
+
+        for elink in np.unique(res['elink'][is_hit | is_header]).tolist():
+            chip = self.chip(rb, elink)
+            hit = is_hit & (res['elink'] == elink)
+            np.add.at(chip.occupancy, (res['row_id'][hit], res['col_id'][hit]), 1)
+            chip.toa += np.bincount(res['toa'][hit & has_time], minlength=1024)[:1024]
+            chip.tot += np.bincount(res['tot'][hit & has_time], minlength=512)[:512]
+            chip.n_hits += int(np.count_nonzero(hit))
+
+            l1 = res['l1counter'][is_header & (res['elink'] == elink)].astype(np.int64)
+            if len(l1) == 0:
+                continue
+            if chip.last_l1 is not None:
+                l1 = np.concatenate([[chip.last_l1], l1])
+            gaps = np.diff(l1) % 256
+            gaps = gaps[gaps > 0]  # additional headers of the same event
+            chip.l1_gaps += np.bincount(gaps, minlength=256)[:256]
+            chip.n_events += len(gaps) + (1 if chip.last_l1 is None else 0)
+            chip.last_l1 = int(l1[-1])
+
+    def ascii_map(self, occupancy):
+        scaled = np.ceil(occupancy / max(occupancy.max(), 1) * (len(LEVELS) - 1)).astype(int)
+        return [''.join(LEVELS[x] for x in row) for row in scaled]
+
+    def render(self, maps=True):
+        '''
+        returns a text summary of all chips, with the occupancy maps if maps is set
+        '''
+        now = time.time()
+        dt = now - self.last_render
+        self.last_render = now
+        lines = [f"Running for {now - self.start:.0f}s, words per RB: {self.n_words}"]
+        lines.append(f"{'RB':>3} {'elink':>5} {'events':>9} {'hits':>10} {'rate [Hz]':>10} {'missing L1A':>11} {'mean TOA':>8} {'mean TOT':>8}")
+        for (rb, elink), chip in sorted(self.chips.items()):
+            n = max(chip.toa.sum(), 1)
+            lines.append(
+                f"{rb:>3} {elink:>5} {chip.n_events:>9} {chip.n_hits:>10} {chip.rate(dt):>10.1f} {chip.missing_events:>11} "
+                f"{np.dot(chip.toa, np.arange(1024))/n:>8.1f} {np.dot(chip.tot, np.arange(512))/n:>8.1f}"
+            )
+        if maps:
+            for (rb, elink), chip in sorted(self.chips.items()):
+                if chip.n_hits == 0:
+                    continue
+                lines.append(f"\nRB {rb}, elink {elink}, max {chip.occupancy.max()} hits per pixel")
+                lines += ['  |' + row + '|' for row in self.ascii_map(chip.occupancy)]
+        return '\n'.join(lines)
+
+    def snapshot(self):
+        '''
+        all histograms as a dictionary of numpy arrays, e.g. for np.savez
+        '''
+        res = {}
+        for (rb, elink), chip in self.chips.items():
+            for h in ['occupancy', 'toa', 'tot', 'l1_gaps']:
+                res[f'rb{rb}_elink{elink}_{h}'] = getattr(chip, h)
+        return res
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+'''
+Helpers to read the raw binary files written by the DAQ (output_run_*_rb*.dat).
+The files are a stream of little endian 32 bit words, two of which form one
+64 bit word (40 bit ETROC2 data + meta data added in the DAQ).
+'''
+import os
+import numpy as np
+
+BYTES_PER_WORD = 768  # approximate peak memory used for decoding and building events, per 64 bit word
+
+
+def merge_words(res, threshold=2**8, out=None, return_orphan=False):
+    '''
+    this function merges 32 bit words from the fifo into 64 bit words (40bit ETROC2 + added meta data in the DAQ)
+    it strips empty entries, i.e. words where the first 32 bit word is not above threshold.
+
+    res can be a list of 32 bit words or a (memory mapped) numpy array.
+    out is an optional preallocated uint64 buffer the merged words are written to.
+    returns a contiguous uint64 array, which is a view of res or out if possible.
+
+    an orphan 32 bit word at the end of res can't be merged. It is dropped, or returned
+    as second return value (None if there is none) if return_orphan is set, so that
+    it can be prepended to the next read.
+    '''
+    res = np.ascontiguousarray(res, dtype='<u4')
+    n_words = len(res) // 2
+    orphan = int(res[-1]) if len(res) % 2 else None
+
+    # offset is not needed as long as zero suppression is turned on and packet boundaries are defined.
+    # little endian: the first 32 bit word ends up in the lower half of the 64 bit word
+    words = res[:2*n_words].view('<u8')
+
+    empty_frame_mask = res[0:2*n_words:2] > threshold  # masking empty fifo entries
+    n_keep = n_words if empty_frame_mask.all() else np.count_nonzero(empty_frame_mask)
+
+    if out is None:
+        merged = words if n_keep == n_words else words[empty_frame_mask]
+    else:
+        if len(out) < n_keep:
+            raise ValueError(f"Output buffer of length {len(out)} too small for {n_keep} words")
+        merged = out[:n_keep]
+        if n_keep == n_words:
+            np.copyto(merged, words, casting='unsafe')
+        else:
+            np.compress(empty_frame_mask, words, out=merged)
+
+    if return_orphan:
+        return merged, orphan
+    return merged
+
+
+def open_raw(f_in):
+    '''
+    memory map a raw DAQ file as an array of 32 bit words.
+    nothing is read from disk until the data is actually accessed.
+    '''
+    if os.path.getsize(f_in) < 4:
+        # np.memmap can't map empty files
+        return np.zeros(0, dtype='<u4')
+    return np.memmap(f_in, dtype='<u4', mode='r')
+
+
+def read_raw(f_in, threshold=2**8):
+    '''
+    returns the merged 64 bit words of a raw DAQ file.
+    the words are a zero-copy view of the memory mapped file, unless empty fifo entries
+    have to be stripped. An orphan 32 bit word at the end of the file is dropped.
+    '''
+    return merge_words(open_raw(f_in), threshold=threshold)
+
+
+def iter_raw(f_in, chunk_size=None, threshold=2**8):
+    '''
+    yields the merged 64 bit words of a raw DAQ file in chunks of (at most) chunk_size 64 bit words,
+    so that only one chunk of the memory mapped file has to be in memory at a time.
+    the whole file is a single chunk if chunk_size is None.
+    '''
+    raw = open_raw(f_in)
+    n_raw = len(raw) - len(raw) % 2
+    step = n_raw if chunk_size is None else 2*chunk_size
+    for start in range(0, n_raw, max(step, 2)):
+        yield merge_words(raw[start:min(start+step, n_raw)], threshold=threshold)
+
+
+def chunk_size(memory_budget):
+    '''
+    number of 64 bit words per chunk for a memory budget in MB (None for no limit).
+    every word needs about BYTES_PER_WORD bytes while it is decoded and built into events.
+    '''
+    if memory_budget is None:
+        return None
+    return max(int(memory_budget * 2**20) // BYTES_PER_WORD, 1)
+
+
+if __name__ == '__main__':
+
+    import time
+
+    def merge_words_list(res):
+        # the list based implementation merge_words replaces, kept for benchmarking
+        empty_frame_mask = np.array(res[0::2]) > (2**8)
+        len_cut = min(len(res[0::2]), len(res[1::2]))
+        if len(res) > 0:
+            return list (np.array(res[0::2])[:len_cut][empty_frame_mask[:len_cut]] | (np.array(res[1::2]) << 32)[:len_cut][empty_frame_mask[:len_cut]])
+        else:
+            return []
+
+    n_words = 2_000_001
+    raw = np.random.randint(0, 2**32, size=n_words, dtype=np.uint64).astype(np.uint32)
+    raw[0:n_words:2][::100] = 0  # some empty fifo entries
+    raw_list = raw.tolist()  # this is what uhal returns
+
+    start = time.time()
+    merged_list = merge_words_list(raw_list)
+    time_list = time.time() - start
+
+    start = time.time()
+    merged = merge_words(raw_list)
+    time_from_list = time.time() - start
+
+    start = time.time()
+    merged = merge_words(raw)
+    time_array = time.time() - start
+
+    buffer = np.empty(n_words//2, dtype=np.uint64)
+    start = time.time()
+    merged_buffer, orphan = merge_words(raw, out=buffer, return_orphan=True)
+    time_buffer = time.time() - start
+
+    assert np.array_equal(np.array(merged_list, dtype=np.uint64), merged)
+    assert np.array_equal(merged, merged_buffer)
+    assert orphan == raw[-1]
+
+    print(f"Merged {n_words} 32 bit words into {len(merged)} 64 bit words:")
+    print(f" - list version:          {time_list:.3f}s")
+    print(f" - array version, list:   {time_from_list:.3f}s")
+    print(f" - array version, array:  {time_array:.3f}s")
+    print(f" - array version, buffer: {time_buffer:.3f}s")
@@ -0,0 +1,184 @@
+'''
+Ring buffer in shared memory, to get the raw data from the DAQ to online consumers
+(live decoding, occupancy maps, CRC checks) without going through the disk.
+There is a single producer (the DAQ writer) and any number of consumers in other processes.
+The producer never waits for the consumers: it overwrites the oldest words, and consumers
+that fall behind skip ahead to the oldest word that is still in the buffer and count what they missed.
+
+The shared memory holds a small header followed by the data:
+header[0]: magic number, header[1]: capacity in words, header[2]: number of words written so far,
+header[3]: number of words written once the write in progress is done.
+The producer increases header[3] before copying new words and header[2] after,
+so a consumer only reads words below header[2], and checks header[3] after copying
+to drop the words that were overwritten in the meantime. No locks are needed,
+this relies on aligned 64 bit stores being atomic and not reordered (true on x86-64).
+'''
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+MAGIC = 0x45544c52494e4721  # "ETLRING!"
+HEADER_WORDS = 8
+POS = 2
+WPOS = 3
+
+
+class RingBuffer:
+    '''
+    producer side. capacity is the number of 64 bit words kept in the buffer.
+    '''
+    def __init__(self, name, capacity=2**24):
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=8*(HEADER_WORDS + capacity))
+        except FileExistsError:
+            # left over from a run that crashed before it could remove the buffer
+            print(f"Removing stale shared memory {name}")
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=8*(HEADER_WORDS + capacity))
+        self.name = self.shm.name
+        self.capacity = capacity
+        self.header = np.ndarray(HEADER_WORDS, dtype=np.uint64, buffer=self.shm.buf)
+        self.data = np.ndarray(capacity, dtype=np.uint64, buffer=self.shm.buf, offset=8*HEADER_WORDS)
+        self.header[:] = 0
+        self.header[1] = capacity
+        self.header[0] = MAGIC
+        self.pos = 0
+        self.orphan = None
+
+    def publish(self, words):
+        '''
+        append 64 bit words to the buffer
+        '''
+        words = np.asarray(words, dtype=np.uint64)
+        if len(words) > self.capacity:
+            # only the last words would survive anyway
+            self.pos += len(words) - self.capacity
+            words = words[-self.capacity:]
+        # announce the words first, consumers drop what this write overwrites
+        self.header[WPOS] = self.pos + len(words)
+        start = self.pos % self.capacity
+        n_first = min(len(words), self.capacity - start)
+        self.data[start:start+n_first] = words[:n_first]
+        self.data[:len(words)-n_first] = words[n_first:]
+        self.pos += len(words)
+        self.header[POS] = self.pos
+
+    def publish_raw(self, data):
+        '''
+        append 32 bit words as read from the FIFO, they are merged in pairs to 64 bit words
+        like in the raw files. A 32 bit word without partner is kept for the next call.
+        '''
+        data = np.asarray(data, dtype='<u4')
+        if self.orphan is not None:
+            data = np.concatenate([[self.orphan], data]).astype('<u4')
+        self.orphan = data[-1] if len(data) % 2 else None
+        self.publish(data[:len(data) - len(data) % 2].view('<u8'))
+
+    def close(self):
+        del self.header, self.data
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RingConsumer:
+    '''
+    consumer side, attaches to the buffer of a running producer.
+    starts with the words that are published after attaching, unless from_start is set.
+    '''
+    def __init__(self, name, from_start=False):
+        # the producer owns the memory, the resource tracker of this process must not remove it
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)  # python>=3.13
+        except TypeError:
+            self.shm = shared_memory.SharedMemory(name=name)
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.header = np.ndarray(HEADER_WORDS, dtype=np.uint64, buffer=self.shm.buf)
+        if self.header[0] != MAGIC:
+            raise ValueError(f"Shared memory {name} is not a ring buffer")
+        self.capacity = int(self.header[1])
+        self.data = np.ndarray(self.capacity, dtype=np.uint64, buffer=self.shm.buf, offset=8*HEADER_WORDS)
+        pos = int(self.header[POS])
+        self.pos = max(pos - self.capacity, 0) if from_start else pos
+        self.n_read = 0
+        self.n_dropped = 0
+        self.n_skips = 0
+
+    @property
+    def lag(self):
+        '''
+        number of words that have been published but not read yet
+        '''
+        return int(self.header[POS]) - self.pos
+
+    def skip(self, pos):
+        if pos > self.pos:
+            self.n_dropped += pos - self.pos
+            self.n_skips += 1
+            self.pos = pos
+
+    def skip_to_latest(self):
+        self.skip(int(self.header[POS]))
+
+    def read(self, max_words=None):
+        '''
+        returns the words published since the last read (at most max_words), as a new array.
+        words that were overwritten before they could be read are counted in n_dropped.
+        '''
+        end = int(self.header[POS])
+        self.skip(int(self.header[WPOS]) - self.capacity)
+        if max_words is not None:
+            end = min(end, self.pos + max_words)
+        if end <= self.pos:
+            return np.zeros(0, dtype=np.uint64)
+
+        idx = np.arange(self.pos, end) % self.capacity
+        words = self.data[idx]
+
+        # words that the producer overwrote (or started to) while we were copying
+        overwritten = int(self.header[WPOS]) - self.capacity - self.pos
+        if overwritten > 0:
+            words = words[overwritten:]
+            self.skip(self.pos + overwritten)
+        self.pos = max(self.pos, end)
+        self.n_read += len(words)
+        return words
+
+    def stats(self):
+        return {'read': self.n_read, 'dropped': self.n_dropped, 'skips': self.n_skips, 'lag': self.lag}
+
+    def close(self):
+        del self.header, self.data
+        self.shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_ring(name, poll=0.01, timeout=None, from_start=False):
+    '''
+    yields the new words of a ring buffer as they come in.
+    stops after timeout seconds without new data (never if None).
+    '''
+    with RingConsumer(name, from_start=from_start) as consumer:
+        last = time.time()
+        while True:
+            words = consumer.read()
+            if len(words):
+                last = time.time()
+                yield words
+            elif timeout is not None and time.time() - last > timeout:
+                break
+            else:
+                time.sleep(poll)
@@ -0,0 +1,527 @@
+'''
+In-process stand-in for uhal and the KCU firmware, to run the DAQ without hardware.
+It loads the uhal address table and serves all registers from memory. The firmware
+behaviour the DAQ relies on is emulated: FIFO reset, occupancy, full flag and lost words,
+L1A pulses and the L1A rate generator, and the DAQ_RB* FIFOs that are filled with
+ETROC2_Emulator data at the configured L1A rate and occupancy.
+
+Use it with get_kcu('mock') or KCU(ipb_path='mock://?l1a_rate=1000&occupancy=0.05', ...).
+Options of the mock:// path:
+- rbs: comma separated RBs that have data (default all)
+- elinks: comma separated elinks of the emulated ETROCs on every RB (default 2)
+- occupancy: fraction of pixels with a hit in every event (default 0.05)
+- l1a_rate: L1A rate in Hz at the start (default 0), the DAQ sets it through SYSTEM.L1A_RATE
+- depth: FIFO depth in 32 bit words (default 2**17)
+- latency: time in seconds per IPbus packet of a dispatch, to emulate the network (default 0)
+- max_payload_size: bytes per IPbus packet (default 1500)
+- error_rate: probability for a dispatch to fail with a uhal exception (default 0)
+- seed: seed of the random numbers (default 0)
+Like uhal, values of reads are only valid after the dispatch.
+'''
+import os
+import re
+import time
+import numpy as np
+import xml.etree.ElementTree as xml
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import uhal as _uhal
+    # use the uhal classes, so that code catching uhal exceptions works the same with the mock
+    exception = _uhal._core.exception
+    NodePermission = _uhal.NodePermission
+    BlockReadWriteMode = _uhal.BlockReadWriteMode
+except ModuleNotFoundError:
+    class exception(Exception):
+        pass
+
+    class NodePermission:
+        READ = 1
+        WRITE = 2
+        READWRITE = 3
+
+    class BlockReadWriteMode:
+        SINGLE = 0
+        INCREMENTAL = 1
+        NON_INCREMENTAL = 2
+        HIERARCHICAL = 3
+
+
+class _core:
+    exception = exception
+
+
+def disableLogging():
+    pass
+
+
+def getDevice(name, uri, address_file):
+    if not uri.startswith('mock://'):
+        raise exception(f"Only mock:// devices are available without uhal, got {uri}")
+    return MockHwInterface(name, uri, address_file)
+
+
+PERMISSIONS = {
+    'r': NodePermission.READ,
+    'w': NodePermission.WRITE,
+    'rw': NodePermission.READWRITE,
+    'wr': NodePermission.READWRITE,
+}
+
+MODES = {
+    'single': BlockReadWriteMode.SINGLE,
+    'incremental': BlockReadWriteMode.INCREMENTAL,
+    'block': BlockReadWriteMode.INCREMENTAL,
+    'non-incremental': BlockReadWriteMode.NON_INCREMENTAL,
+    'port': BlockReadWriteMode.NON_INCREMENTAL,
+    'hierarchical': BlockReadWriteMode.HIERARCHICAL,
+}
+
+# registers of newer firmware versions that are not in the local address table, but used by the DAQ.
+# the addresses are unused ones of the READOUT_BOARD module.
+EXTRA_NODES = {
+    'EVENT_CNT': (0x50A, 0xffffffff, 'r'),
+    'EVENT_CNT_RESET': (0x50B, 0x1, 'w'),
+}
+
+# L1A rate setting of SYSTEM.L1A_RATE, see daq.stream_daq
+RATE_SCALE = 25E-9 * 0xffffffff / 10000
+FILLER = 0x3C5C800000  # ETROC2 filler frame
+
+
+class NodeInfo:
+    def __init__(self, path, address, mask=0xffffffff, permission='rw', mode='single', size=1, description=''):
+        self.path = path
+        self.address = address
+        self.mask = mask
+        self.lsb = (mask & -mask).bit_length() - 1
+        self.permission = permission
+        self.mode = mode
+        self.size = size
+        self.description = description
+
+
+def parse_int(s, default=0):
+    return int(s, 0) if s is not None else default
+
+
+def parse_address_table(f_in):
+    '''
+    returns a dictionary of all nodes of a uhal address table, following the modules
+    '''
+    nodes = {}
+
+    def parse(element, path, address, f_dir):
+        address += parse_int(element.get('address'))
+        module = element.get('module')
+        if path != '':
+            nodes[path] = NodeInfo(
+                path,
+                address,
+                mask = parse_int(element.get('mask'), 0xffffffff),
+                permission = element.get('permission', 'rw'),
+                mode = element.get('mode', 'hierarchical' if (module is not None or len(element)) else 'single'),
+                size = parse_int(element.get('size'), 1),
+                description = element.get('description', ''),
+            )
+        if module is not None:
+            f_module = os.path.join(f_dir, module.replace('file://', ''))
+            root = xml.parse(f_module).getroot()
+            for child in root:
+                parse(child, f"{path}.{child.get('id')}" if path else child.get('id'), address, os.path.dirname(f_module))
+        for child in element:
+            parse(child, f"{path}.{child.get('id')}" if path else child.get('id'), address, f_dir)
+
+    f_in = f_in.replace('file://', '')
+    root = xml.parse(f_in).getroot()
+    for child in root:
+        parse(child, child.get('id'), 0, os.path.dirname(os.path.abspath(f_in)))
+    return nodes
+
+
+class ValWord:
+    def __init__(self, value=None):
+        self._value = value
+
+    def valid(self):
+        return self._value is not None
+
+    def value(self):
+        if self._value is None:
+            raise exception("Value not valid, dispatch first")
+        return self._value
+
+    def __int__(self):
+        return self.value()
+
+    def __index__(self):
+        return self.value()
+
+    def __eq__(self, other):
+        return self.value() == int(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.value())
+
+    def __repr__(self):
+        return str(self._value)
+
+
+class ValVector(ValWord):
+    def value(self):
+        if self._value is None:
+            raise exception("Value not valid, dispatch first")
+        return self._value.tolist()
+
+    def __len__(self):
+        return len(self.value())
+
+    def __iter__(self):
+        return iter(self.value())
+
+    def __getitem__(self, i):
+        return self.value()[i]
+
+
+class MockFIFO:
+    '''
+    FIFO of 32 bit words with a fixed depth, words that don't fit are lost
+    '''
+    def __init__(self, depth):
+        self.depth = depth
+        self.buf = np.zeros(depth, dtype=np.uint32)
+        self.head = 0
+        self.count = 0
+        self.lost = 0
+
+    def __len__(self):
+        return self.count
+
+    def free(self):
+        return self.depth - self.count
+
+    def reset(self):
+        self.head = 0
+        self.count = 0
+
+    def push(self, words):
+        n = min(len(words), self.free())
+        self.lost += len(words) - n
+        start = (self.head + self.count) % self.depth
+        n_first = min(n, self.depth - start)
+        self.buf[start:start+n_first] = words[:n_first]
+        self.buf[:n-n_first] = words[n_first:n]
+        self.count += n
+
+    def pop(self, n):
+        '''
+        returns n words, an empty FIFO returns zeros
+        '''
+        res = np.zeros(n, dtype=np.uint32)
+        k = min(n, self.count)
+        n_first = min(k, self.depth - self.head)
+        res[:n_first] = self.buf[self.head:self.head+n_first]
+        res[n_first:k] = self.buf[:k-n_first]
+        self.head = (self.head + k) % self.depth
+        self.count -= k
+        return res
+
+
+class EventSource:
+    '''
+    raw data of one RB, a pool of events of ETROC2_Emulators that is replayed.
+    the pool has a multiple of 256 events, so that the L1 counter continues when it starts over.
+    '''
+    def __init__(self, elinks=[2], occupancy=0.05, n_events=512, rng=None):
+        from tamalero.ETROC_Emulator import ETROC2_Emulator
+        rng = rng if rng is not None else np.random.default_rng()
+        emulators = [ETROC2_Emulator(elink=elink) for elink in elinks]
+        events = []
+        for i in range(n_events):
+            words = []
+            for emu in emulators:
+                emu.data['hits'] = 0
+                emu.L1Adata = []
+                emu.data['l1counter'] = (emu.data['l1counter'] + 1) % 256
+                for pixel in np.flatnonzero(rng.random(256) < occupancy):
+                    emu.add_hit(pixel // 16, pixel % 16)
+                frame = emu.get_data()
+                # the DAQ adds the elink and start / end of frame bits
+                meta = [emu.elink << 40 | 1 << 48] + [emu.elink << 40] * (len(frame) - 2) + [emu.elink << 40 | 1 << 49]
+                words += [w | m for w, m in zip(frame, meta)]
+            if len(words) % 2:
+                # the occupancy counts 128 bit words, fill up the last one with an ETROC2 filler
+                words.append(FILLER | emulators[-1].elink << 40)
+            events.append(np.array(words, dtype='<u8').view('<u4'))
+        self.pool = np.concatenate(events)
+        self.offsets = np.concatenate([[0], np.cumsum([len(e) for e in events])])
+        self.n_events = n_events
+        self.next = 0
+
+    def words(self, n_events, max_words):
+        '''
+        the words of the next n_events, at most max_words (whole events only).
+        returns the words and the number of words of the events that didn't fit.
+        '''
+        res = []
+        n_words = 0
+        lost = 0
+        for i in range(n_events):
+            start, stop = self.offsets[self.next], self.offsets[self.next + 1]
+            if lost == 0 and n_words + stop - start <= max_words:
+                res.append(self.pool[start:stop])
+                n_words += stop - start
+            else:
+                lost += stop - start
+            self.next = (self.next + 1) % self.n_events
+            if lost and i < n_events - 1:
+                # no need to go through all lost events one by one
+                remaining = n_events - i - 1
+                cycles, rest = divmod(remaining, self.n_events)
+                lost += cycles * len(self.pool)
+                for j in range(rest):
+                    lost += self.offsets[self.next + 1] - self.offsets[self.next]
+                    self.next = (self.next + 1) % self.n_events
+                break
+        return (np.concatenate(res) if res else np.zeros(0, dtype=np.uint32)), lost
+
+
+class MockFirmware:
+    '''
+    register memory and the firmware blocks that the DAQ uses
+    '''
+    def __init__(self, nodes, rbs=None, elinks=[2], occupancy=0.05, l1a_rate=0, depth=2**17, seed=0):
+        self.nodes = nodes
+        self.memory = {}
+        self.read_handlers = {}  # address -> function returning the value of the register
+        self.write_handlers = {}  # address -> list of (mask, function called when a bit of mask is written)
+        self.block_handlers = {}  # address -> function(n) returning n words
+
+        rng = np.random.default_rng(seed)
+        all_rbs = sorted(int(p.split('_')[-1]) for p in nodes if re.fullmatch(r'READOUT_BOARD_\d+', p))
+        self.rbs = all_rbs if rbs is None else rbs
+        self.fifos = {rb: MockFIFO(depth) for rb in all_rbs}
+        self.sources = {rb: EventSource(elinks=elinks, occupancy=occupancy, rng=rng) for rb in self.rbs}
+        self.event_cnt = {rb: 0 for rb in all_rbs}
+        self.last_update = time.time()
+        self.pending = 0.  # fraction of an L1A that is still to come
+
+        self.memory[nodes['FW_INFO.HOG_INFO.GLOBAL_VER'].address] = 0x03000000
+        if 'SYSTEM' not in nodes:
+            # e.g. the bootstrap table, that only has the firmware info
+            return
+        self.set('SYSTEM.L1A_RATE', int(l1a_rate / RATE_SCALE))
+
+        self.read_handlers[nodes['SYSTEM.L1A_RATE_CNT'].address] = lambda: int(self.l1a_rate)
+        self.on_write('SYSTEM.L1A_PULSE', lambda: self.l1a(self.rbs))
+        for rb in all_rbs:
+            base = nodes[f'READOUT_BOARD_{rb}'].address
+            for name, (address, mask, permission) in EXTRA_NODES.items():
+                path = f'READOUT_BOARD_{rb}.{name}'
+                if path not in nodes:
+                    nodes[path] = NodeInfo(path, base + address, mask=mask, permission=permission)
+            fifo = self.fifos[rb]
+            self.read_handlers[nodes[f'READOUT_BOARD_{rb}.RX_FIFO_OCCUPANCY'].address] = lambda fifo=fifo: len(fifo) // 4
+            self.read_handlers[nodes[f'READOUT_BOARD_{rb}.RX_FIFO_FULL'].address] = lambda fifo=fifo: int(fifo.free() == 0)
+            self.read_handlers[nodes[f'READOUT_BOARD_{rb}.RX_FIFO_LOST_WORD_CNT'].address] = lambda fifo=fifo: fifo.lost
+            self.read_handlers[nodes[f'READOUT_BOARD_{rb}.PACKET_RX_RATE'].address] = lambda: int(self.l1a_rate)
+            self.read_handlers[nodes[f'READOUT_BOARD_{rb}.EVENT_CNT'].address] = lambda rb=rb: self.event_cnt[rb]
+            self.on_write(f'READOUT_BOARD_{rb}.FIFO_RESET', fifo.reset)
+            self.on_write(f'READOUT_BOARD_{rb}.EVENT_CNT_RESET', lambda rb=rb: self.event_cnt.update({rb: 0}))
+            if rb in self.rbs:
+                self.on_write(f'READOUT_BOARD_{rb}.L1A_PULSE', lambda rb=rb: self.l1a([rb]))
+                self.on_write(f'READOUT_BOARD_{rb}.L1A_QINJ_PULSE', lambda rb=rb: self.l1a([rb]))
+            self.block_handlers[nodes[f'DAQ_RB{rb}'].address] = fifo.pop
+
+    def on_write(self, path, fun):
+        node = self.nodes[path]
+        self.write_handlers.setdefault(node.address, []).append((node.mask, fun))
+
+    def set(self, path, value):
+        node = self.nodes[path]
+        self.write(node.address, (value << node.lsb) & node.mask, node.mask)
+
+    @property
+    def l1a_rate(self):
+        if 'SYSTEM.L1A_RATE' not in self.nodes:
+            return 0
+        return self.memory.get(self.nodes['SYSTEM.L1A_RATE'].address, 0) * RATE_SCALE
+
+    def l1a(self, rbs, n=1):
+        for rb in rbs:
+            fifo = self.fifos[rb]
+            words, lost = self.sources[rb].words(n, fifo.free())
+            fifo.push(words)
+            fifo.lost += lost
+            self.event_cnt[rb] += n
+
+    def update(self):
+        '''
+        send the L1As of the rate generator since the last update
+        '''
+        now = time.time()
+        self.pending += (now - self.last_update) * self.l1a_rate
+        self.last_update = now
+        n = int(self.pending)
+        if n > 0:
+            self.pending -= n
+            self.l1a(self.rbs, n)
+
+    def read(self, address):
+        self.update()
+        if address in self.read_handlers:
+            return self.read_handlers[address]() & 0xffffffff
+        return self.memory.get(address, 0)
+
+    def write(self, address, value, mask=0xffffffff):
+        self.update()
+        pulses = self.write_handlers.get(address, [])
+        pulse_mask = 0
+        for pulse, fun in pulses:
+            if value & pulse & mask:
+                fun()
+            pulse_mask |= pulse
+        # pulse bits don't keep their value
+        keep = mask & ~pulse_mask
+        self.memory[address] = (self.memory.get(address, 0) & ~keep) | (value & keep)
+
+    def read_block(self, address, n):
+        self.update()
+        if address in self.block_handlers:
+            return self.block_handlers[address](n)
+        return np.array([self.memory.get(address + i, 0) for i in range(n)], dtype=np.uint32)
+
+
+class MockNode:
+    def __init__(self, hw, info):
+        self.hw = hw
+        self.info = info
+
+    def getId(self):
+        return self.info.path.split('.')[-1]
+
+    def getPath(self):
+        return 'TOP.' + self.info.path
+
+    def getAddress(self):
+        return self.info.address
+
+    def getMask(self):
+        return self.info.mask
+
+    def getPermission(self):
+        return PERMISSIONS[self.info.permission]
+
+    def getMode(self):
+        return MODES[self.info.mode]
+
+    def getSize(self):
+        return self.info.size
+
+    def getDescription(self):
+        return self.info.description
+
+    def getNode(self, id):
+        return self.hw.getNode(f"{self.info.path}.{id}")
+
+    def getNodes(self, regex=None):
+        return [p[len(self.info.path)+1:] for p in self.hw.getNodes(regex) if p.startswith(self.info.path + '.')]
+
+    def read(self):
+        res = ValWord()
+        info = self.info
+        self.hw.queue(lambda fw: setattr(res, '_value', (fw.read(info.address) & info.mask) >> info.lsb), 1)
+        return res
+
+    def write(self, value):
+        info = self.info
+        self.hw.queue(lambda fw: fw.write(info.address, (value << info.lsb) & info.mask, info.mask), 1)
+
+    def readBlock(self, n):
+        res = ValVector()
+        address = self.info.address
+        self.hw.queue(lambda fw: setattr(res, '_value', fw.read_block(address, n)), n)
+        return res
+
+
+class MockClient:
+    def __init__(self, hw):
+        self.hw = hw
+
+    def write(self, address, value):
+        self.hw.queue(lambda fw: fw.write(address, value), 1)
+
+    def read(self, address):
+        res = ValWord()
+        self.hw.queue(lambda fw: setattr(res, '_value', fw.read(address)), 1)
+        return res
+
+    def dispatch(self):
+        self.hw.dispatch()
+
+
+class MockHwInterface:
+    '''
+    uhal.HwInterface of the mock, transactions are queued and executed on dispatch
+    '''
+    def __init__(self, name, uri, address_file):
+        self.name = name
+        self._uri = uri
+        options = {k: v[0] for k, v in parse_qs(urlparse(uri).query).items()}
+        self.nodes = parse_address_table(address_file)
+        self.firmware = MockFirmware(
+            self.nodes,
+            rbs = [int(x) for x in options['rbs'].split(',')] if 'rbs' in options else None,
+            elinks = [int(x) for x in options.get('elinks', '2').split(',')],
+            occupancy = float(options.get('occupancy', 0.05)),
+            l1a_rate = float(options.get('l1a_rate', 0)),
+            depth = int(options.get('depth', 2**17)),
+            seed = int(options.get('seed', 0)),
+        )
+        self.latency = float(options.get('latency', 0))
+        self.error_rate = float(options.get('error_rate', 0))
+        self.words_per_packet = (int(options.get('max_payload_size', 1500)) - 36) // 4
+        self.rng = np.random.default_rng(int(options.get('seed', 0)))
+        self.transactions = []
+        self.n_words = 0
+        self.n_dispatches = 0
+        self.n_packets = 0
+        self.client = MockClient(self)
+
+    def id(self):
+        return self.name
+
+    def uri(self):
+        return self._uri
+
+    def getClient(self):
+        return self.client
+
+    def getNode(self, id):
+        if id not in self.nodes:
+            raise exception(f"No node {id} in the address table")
+        return MockNode(self, self.nodes[id])
+
+    def getNodes(self, regex=None):
+        return [p for p in self.nodes if regex is None or re.fullmatch(regex, p)]
+
+    def queue(self, transaction, n_words):
+        self.transactions.append(transaction)
+        self.n_words += n_words + 2  # transaction header and address
+
+    def dispatch(self):
+        transactions = self.transactions
+        n_packets = -(-self.n_words // self.words_per_packet)
+        self.transactions = []
+        self.n_words = 0
+        self.n_dispatches += 1
+        self.n_packets += n_packets
+        if self.latency > 0:
+            time.sleep(self.latency * max(n_packets, 1))
+        if self.error_rate > 0 and self.rng.random() < self.error_rate:
+            raise exception("Emulated UDP error in dispatch")
+        for transaction in transactions:
+            transaction(self.firmware)
@@ -14,6 +14,11 @@ except ImportError:
 
 here = os.path.dirname(os.path.abspath(__file__))
 
+ADDRESS_TABLE_DIR = os.path.join(here, '../address_table')
+BOOTSTRAP_TABLE = os.path.join(ADDRESS_TABLE_DIR, 'bootstrap.xml')  # just what is needed to read the firmware version
+GENERIC_TABLE = os.path.join(ADDRESS_TABLE_DIR, 'generic/etl_test_fw.xml')
+TABLE_INDEX = os.path.join(ADDRESS_TABLE_DIR, 'index.yaml')  # XML SHA -> directory and firmware version of the local tables
+
 def get_temp(v_out, v_ref, r_ref, t_1, r_1, b, celcius=True, thermistor=None):
     """
     Calculate the temperature of a thermistor, given the voltage measured on it.
@@ -229,44 +234,108 @@ def get_last_commit_sha(version):
     last_commit_sha = log[0]['id'][:7]
     return last_commit_sha
 
+def is_offline():
+    '''
+    set TAMALERO_OFFLINE=1 on computers without network access
+    '''
+    return os.environ.get('TAMALERO_OFFLINE', '0') not in ['', '0']
+
 def download_address_table(version, quiet=False):
     import os
     import requests
     import json
     import urllib.parse
 
-    if not os.path.isdir(f"address_table/{version}"):
+    if not os.path.isdir(os.path.join(ADDRESS_TABLE_DIR, version)):
         last_commit_sha = get_last_commit_sha(version)
-        r = requests.get(f"https://gitlab.cern.ch/api/v4/projects/107856/repository/tree?ref={version}&&path=address_tables&&recursive=True")
+        r = requests.get(f"https://gitlab.cern.ch/api/v4/projects/107856/repository/tree?ref={version}&&path=address_tables&&recursive=True", timeout=10)
         tree = json.loads(r.content)
         if isinstance(tree, list):
             if not quiet:
                 print ("Successfully got list of address table files from gitlab.")
         else:
             version = last_commit_sha
-            if os.path.isdir(f'address_table/{version}/'):
+            if os.path.isdir(os.path.join(ADDRESS_TABLE_DIR, version)):
                 # already downloaded.
                 return version
-            r = requests.get(f"https://gitlab.cern.ch/api/v4/projects/107856/repository/tree?ref=devel&&path=address_tables&&recursive=True")
+            r = requests.get(f"https://gitlab.cern.ch/api/v4/projects/107856/repository/tree?ref=devel&&path=address_tables&&recursive=True", timeout=10)
             tree = json.loads(r.content)
             print (f"Local firmware version detected. Will download address table corresponding to commit {version}.")
 
         if not quiet:
             print (f"Downloading latest firmware version address table to address_table/{version}")
             print(f"Making directory: address_table/{version}")
-        os.makedirs(f"address_table/{version}")
+        # download to a temporary directory, so that an interrupted download doesn't leave an incomplete table
+        tmp_dir = os.path.join(ADDRESS_TABLE_DIR, f"{version}.partial")
+        os.makedirs(tmp_dir, exist_ok=True)
         for f in tree:
             if f['type'] == 'tree':
-                os.makedirs(f"address_table/{version}/{f['name']}")
+                os.makedirs(f"{tmp_dir}/{f['name']}", exist_ok=True)
             elif f['type'] == 'blob':
                 # needs URL encode: https://www.w3schools.com/tags/ref_urlencode.ASP
                 path = urllib.parse.quote_plus(f['path']).replace('.', '%2E')  # python thinks . is fine, so we replace it manually
-                res = requests.get(f"https://gitlab.cern.ch/api/v4/projects/107856/repository/files/{path}/raw?ref={version}")
+                res = requests.get(f"https://gitlab.cern.ch/api/v4/projects/107856/repository/files/{path}/raw?ref={version}", timeout=10)
                 local_path = f['path'].replace('address_tables/', '')
-                open(f"address_table/{version}/{local_path}", 'wb').write(res.content)
+                open(f"{tmp_dir}/{local_path}", 'wb').write(res.content)
+        os.replace(tmp_dir, os.path.join(ADDRESS_TABLE_DIR, version))
 
     return version
 
+def load_table_index():
+    if not os.path.isfile(TABLE_INDEX):
+        return {}
+    with open(TABLE_INDEX, 'r') as f:
+        return load(f, Loader=Loader) or {}
+
+def register_address_table(xml_sha, directory, fw_version=None):
+    index = load_table_index()
+    index[xml_sha] = {'dir': directory, 'version': fw_version}
+    f_tmp = f"{TABLE_INDEX}.{os.getpid()}.tmp"
+    with open(f_tmp, 'w') as f:
+        dump(index, f, Dumper=Dumper)
+    os.replace(f_tmp, TABLE_INDEX)
+
+def find_address_table(xml_sha):
+    '''
+    path of the local address table for xml_sha, or None. Doesn't need network access.
+    '''
+    index = load_table_index()
+    directories = [index[xml_sha]['dir']] if xml_sha in index else []
+    for directory in directories + [xml_sha]:
+        f_table = os.path.join(ADDRESS_TABLE_DIR, directory, 'etl_test_fw.xml')
+        if os.path.isfile(f_table):
+            return f_table
+    return None
+
+def get_address_table(xml_sha, fw_version=None, offline=None, quiet=False):
+    '''
+    path of the address table for xml_sha. Tables in address_table/ are used without network access,
+    missing ones are downloaded unless offline. If that's not possible, a local table of the same
+    firmware version or the generic table is used.
+    '''
+    from tamalero.colors import red
+    f_table = find_address_table(xml_sha)
+    if f_table is not None:
+        return f_table
+
+    offline = is_offline() if offline is None else offline
+    if not offline:
+        try:
+            directory = download_address_table(xml_sha, quiet=quiet)
+            register_address_table(xml_sha, directory, fw_version=fw_version)
+            return os.path.join(ADDRESS_TABLE_DIR, directory, 'etl_test_fw.xml')
+        except Exception as e:
+            print(red(f"Could not download the address table {xml_sha}: {e}"))
+
+    for sha, entry in load_table_index().items():
+        f_table = os.path.join(ADDRESS_TABLE_DIR, entry['dir'], 'etl_test_fw.xml')
+        if fw_version is not None and entry.get('version') == fw_version and os.path.isfile(f_table):
+            print(red(f"Address table {xml_sha} is not available, using {sha} of the same firmware version {fw_version}."))
+            return f_table
+
+    print(red(f"Address table {xml_sha} is not available, using the generic address table."))
+    return GENERIC_TABLE
+
 def check_repo_status(kcu_version=None):
     import requests
     import json
@@ -275,8 +344,16 @@ def check_repo_status(kcu_version=None):
     from tamalero.colors import red, green
     from emoji import emojize
 
+    if is_offline():
+        print("Offline, not checking the status of the tamalero repository.")
+        return
+
     # get remote repo log
-    r = requests.get(f"https://gitlab.cern.ch/api/v4/projects/110883/repository/commits")
+    try:
+        r = requests.get(f"https://gitlab.cern.ch/api/v4/projects/110883/repository/commits", timeout=5)
+    except requests.exceptions.RequestException:
+        print(red("Could not reach gitlab, not checking the status of the tamalero repository."))
+        return
     log = json.loads(r.content)
     last_commit_sha = log[0]['id']
 
@@ -300,7 +377,13 @@ def check_repo_status(kcu_version=None):
         else:
             print (red("Please pull a more recent version from gitlab.\n"))
 
-def get_kcu(kcu_address, control_hub=True, host='localhost', verbose=False, quiet=False):
+def get_kcu(kcu_address, control_hub=True, host='localhost', verbose=False, quiet=False, offline=None, timing=False):
+    '''
+    connect to the KCU and load the address table of its firmware.
+    The firmware version is read with the bootstrap table, the full table is taken from address_table/
+    and only downloaded if it's not there (never with offline=True or TAMALERO_OFFLINE=1).
+    With timing (or verbose) the time of each step is printed, it is also stored in kcu.startup_timing.
+    '''
     # Get the current firmware version number
     if verbose:
         if control_hub:
@@ -308,6 +391,15 @@ def get_kcu(kcu_address, control_hub=True, host='localhost', verbose=False, quie
         else:
             print(f"NOT using control hub on host={host}, kcu_address={kcu_address}")
 
+    if kcu_address.startswith('mock'):
+        # software emulation of the KCU (tamalero/uhal_mock.py), options are given as mock://?l1a_rate=1000&...
+        kcu = KCU(name="my_device",
+                  ipb_path=kcu_address if kcu_address.startswith('mock://') else 'mock://',
+                  adr_table=GENERIC_TABLE)
+        if not quiet:
+            print(f"Using emulated KCU {kcu.ipb_path}")
+        return kcu
+
     import uhal
     import time
     if control_hub:
@@ -317,12 +409,22 @@ def get_kcu(kcu_address, control_hub=True, host='localhost', verbose=False, quie
     if not quiet:
         print (f"IPBus address: {ipb_path}")
 
+    start_time = time.time()
+    timings = {}
+    last = start_time
+
+    def step(name):
+        nonlocal last
+        now = time.time()
+        timings[name] = now - last
+        last = now
+
     trycnt = 0
     while (True):
         try:
-            kcu_tmp = KCU(name="tmp_kcu",
-                        ipb_path=ipb_path,
-                        adr_table="address_table/generic/etl_test_fw.xml")
+            kcu = KCU(name="my_device",
+                      ipb_path=ipb_path,
+                      adr_table=BOOTSTRAP_TABLE)
             break
         except uhal.exception or uhal._core.exception:
             if control_hub:
@@ -347,29 +449,35 @@ def get_kcu(kcu_address, control_hub=True, host='localhost', verbose=False, quie
                 raise RuntimeError(f"Could not establish connection with KCU board {ipb_path}")
 
         #raise
-    xml_sha     = kcu_tmp.get_xml_sha()
+    step('connect and read firmware version')
+
+    xml_sha     = kcu.get_xml_sha()
     if verbose:
         print (f"Address table hash: {xml_sha}")
+    step('read XML SHA')
 
-    #last_commit = get_last_commit_sha(xml_sha)
-    #if not os.path.isdir(f"address_table/{last_commit}"):
-    xml_sha = download_address_table(xml_sha, quiet=quiet)
-    #else:
-    #    xml_sha = last_commit
+    fw_version = f"{kcu.firmware_version['major']}.{kcu.firmware_version['minor']}.{kcu.firmware_version['patch']}"
+    adr_table = get_address_table(xml_sha, fw_version=fw_version, offline=offline, quiet=quiet)
+    step('find address table')
 
-    kcu = KCU(name="my_device",
-              ipb_path=ipb_path,
-              adr_table=f"address_table/{xml_sha}/etl_test_fw.xml")
+    kcu.load_address_table(adr_table)
+    step('load address table')
 
     data = 0xabcd1234
     kcu.write_node("LOOPBACK.LOOPBACK", data)
     if (data != kcu.read_node("LOOPBACK.LOOPBACK")):
         raise RuntimeError(f"No communication with KCU board {ipb_path} established.")
+    step('loopback check')
 
-    kcu.get_firmware_version(string=False)
+    timings['total'] = time.time() - start_time
+    kcu.startup_timing = timings
+    if timing or verbose:
+        print("KCU startup timing:")
+        for name, t in timings.items():
+            print(f"  {name:<36}{1000*t:8.1f} ms")
 
     if not quiet:
-        print(f"KCU firmware version: {kcu.firmware_version['major']}.{kcu.firmware_version['minor']}.{kcu.firmware_version['patch']}")
+        print(f"KCU firmware version: {fw_version}")
 
     return kcu
 
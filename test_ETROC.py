@@ -1250,8 +1250,8 @@ if __name__ == '__main__':
             with open(f"{out_dir}/output_qinj_{args.charge}fC.dat", mode="wb") as f:
                 for i in range(50):
                     fifo.send_QInj(1000, delay=etroc.QINJ_delay)
-                    data = fifo.read(dispatch=True)
-                    f.write(struct.pack('<{}I'.format(len(data)), *data))
+                    data = fifo.read_words()
+                    data.tofile(f)
 
         if args.qinj_scan:
 
@@ -74,16 +74,13 @@ def sigmoid_fit(x_axis, y_axis):
 
 # parse ETROC dataformat into 1D list of # of hits per pixel
 def parse_data(data, N_pix):
-    results = np.zeros(N_pix)
     pix_w = int(round(np.sqrt(N_pix)))
 
-    for word in data:
-        datatype, res = DF.read(word)
-        if datatype == 'data':
-            pix = toPixNum(res['row_id'], res['col_id'], pix_w)
-            results[pix] += 1
+    res = DF.read_array(data)
+    is_data = res['data_type'] == DF.data_types.index('data')
+    pix = toPixNum(res['row_id'][is_data].astype(int), res['col_id'][is_data].astype(int), pix_w)
 
-    return results
+    return np.bincount(pix, minlength=N_pix).astype(float)
 
 
 def vth_scan(ETROC2, vth_min=693, vth_max=709, vth_step=1, decimal=False, fifo=None, absolute=False):
@@ -11,7 +11,7 @@ from tamalero.DataFrame import DataFrame
 
 from cocina.PowerSupply import PowerSupply
 
-from daq import stream_daq, stream_daq_multi
+from daq import DAQEngine
 
 if __name__ == '__main__':
 
@@ -67,19 +67,10 @@ if __name__ == '__main__':
     rb_1.modules[0].show_status()
 
 
-    stream_0 = stream_daq_multi(
-        stream_daq,
-        {'kcu':kcu, 'rb':0, 'l1a_rate':l1a_rate, 'run_time':run_time, 'run':run, 'ext_l1a':True},
-    )
-
-    stream_1 = stream_daq_multi(
-        stream_daq,
-        {'kcu':kcu, 'rb':1, 'l1a_rate':l1a_rate, 'run_time':run_time+0.2, 'run':run, 'ext_l1a':True},
-    )
+    engine = DAQEngine(kcu, [0, 1], run=run)
 
     print("Taking data")
-    while stream_0._running or stream_1._running:
-        time.sleep(1)
+    engine.stream(l1a_rate=l1a_rate, run_time=run_time, ext_l1a=True)
     print("Done with all streams")
 
     if power_down: